@@ -0,0 +1,143 @@
+"""
+附近接口的geo格子缓存
+
+地图拖动时同一片街区的用户查询的是几乎相同的附近单位, 这里把半径量化到档位, 查询点量化到该档位的格子
+(经纬度等分的网格, 边长为档位 * NEARBY_TILE_SIZE_RATIO), 按(格子, 半径档位)缓存候选集:
+以格子中心为圆心、半径档位加上格子半对角线为半径查出的所有单位,
+所以格子内任意一点在该档位内的结果都是候选集的子集, 每个用户的距离过滤和排序在本地对候选集计算
+
+失效: add_user_location/add_activity_location等写入位置时, 每个档位只删除候选范围真正覆盖该位置的格子
+(格子中心到该位置的距离不超过格子的查询半径); 另外缓存只保存NEARBY_TILE_EXPIRE秒
+
+代价(NEARBY_TILE_SIZE_RATIO = 1, 北京附近的纬度):
+- 读: 候选集查询半径为档位的1.63倍, 面积是查询范围的2.66倍(半径正好是档位时, 默认半径7km就是这种情况);
+  半径刚超过下一档的下限时更多, 例如1.1km用3km档位约20倍, 7.1km用15km档位约12倍
+- 写: 每个档位删除11个格子左右(最多14个), 7个档位一次DEL约77个key, 大部分key并不存在
+- 比例减半时读约1.7倍, 写每个档位约28个格子; 比例加倍时读约5倍, 写每个档位约5个格子
+
+命中率: nearby_tile_hit_counter.get_stats(), 或staff访问 /api/cache_stats/
+"""
+import math
+import pickle
+
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import CacheHitCounter
+from utilities.geo import distances_from, METERS_PER_LAT_DEGREE
+
+NEARBY_TILE_KEY = 'nearby_tile:{}:{}'
+NEARBY_TILE_EXPIRE = 60
+# 半径档位, 单位km, 超过最大档位的查询不缓存
+NEARBY_RADIUS_BUCKETS = (1, 3, 7, 15, 30, 50, 100)
+# 格子边长与档位的比例, 越小候选集越接近查询范围, 但写入时要删除的格子越多
+NEARBY_TILE_SIZE_RATIO = 1
+
+nearby_tile_hit_counter = CacheHitCounter('nearby_tile')
+
+
+def get_radius_bucket(radius):
+    """
+    :return: 不小于radius的最小档位, 超过最大档位时返回None
+    """
+    for bucket in NEARBY_RADIUS_BUCKETS:
+        if radius <= bucket:
+            return bucket
+    return None
+
+
+def _get_tile_size(bucket):
+    """
+    :return: 格子的边长, 单位度, 经纬度方向相同
+    """
+    # 边长只由档位决定, 与纬度无关, 否则写入位置与查询位置纬度不同时算出的格子对不上
+    return bucket * 1000 * NEARBY_TILE_SIZE_RATIO / METERS_PER_LAT_DEGREE
+
+
+def _get_tile_center(row, col, size):
+    return (row + 0.5) * size - 90, (col + 0.5) * size - 180
+
+
+def _get_query_radius(center_lat, center_lon, size, bucket):
+    """
+    :return: 格子的候选集查询半径km, 即档位加上格子半对角线
+    """
+    half_size = size / 2
+    corners = [(center_lat - half_size, center_lon - half_size), (center_lat + half_size, center_lon + half_size)]
+    return bucket + max(distances_from(center_lat, center_lon, corners)) / 1000
+
+
+def get_tile(lon, lat, bucket):
+    """
+    :return: (格子, 中心经度, 中心纬度, 候选集查询半径km)
+    """
+    size = _get_tile_size(bucket)
+    row, col = int(math.floor((lat + 90) / size)), int(math.floor((lon + 180) / size))
+    center_lat, center_lon = _get_tile_center(row, col, size)
+    return '{}:{}'.format(row, col), center_lon, center_lat, _get_query_radius(center_lat, center_lon, size, bucket)
+
+
+def _filter_candidates(candidates, lon, lat, radius):
+    """
+    :param candidates: [(id, lon, lat)]
+    :return: [(id, [lon, lat], distance)], 按距离由近到远排序, distance单位米
+    """
+    distances = distances_from(lat, lon, [(item_lat, item_lon) for _, item_lon, item_lat in candidates])
+    result = [(item_id, [item_lon, item_lat], distance)
+              for (item_id, item_lon, item_lat), distance in zip(candidates, distances) if distance <= radius * 1000]
+    return sorted(result, key=lambda item: item[2])
+
+
+def get_nearby_candidates(lon, lat, radius, loader, use_cache=True):
+    """
+    获取附近的足迹和活动, 优先使用格子缓存
+    :param loader: loader(lon, lat, radius) -> {'footprints': [(id, lon, lat)], 'activities': [(id, lon, lat)]},
+                   缓存未命中时调用
+    :param use_cache: 为False时直接调用loader, 只做距离过滤和排序
+    :return: {'footprints': [(id, [lon, lat], distance)], 'activities': [...]}, 按距离由近到远排序
+    """
+    bucket = get_radius_bucket(radius) if use_cache else None
+    if bucket is None:
+        candidates = loader(lon, lat, radius)
+    else:
+        tile, center_lon, center_lat, query_radius = get_tile(lon, lat, bucket)
+        key = NEARBY_TILE_KEY.format(bucket, tile)
+        value = redis.get(key)
+        nearby_tile_hit_counter.record(hit=int(value is not None), miss=int(value is None))
+        if value is not None:
+            candidates = pickle.loads(value)
+        else:
+            candidates = loader(center_lon, center_lat, query_radius)
+            redis.setex(key, NEARBY_TILE_EXPIRE, pickle.dumps(candidates, pickle.HIGHEST_PROTOCOL))
+    return {name: _filter_candidates(items, lon, lat, radius) for name, items in candidates.items()}
+
+
+def _get_affected_tiles(lon, lat, bucket):
+    """
+    候选范围覆盖(lon, lat)的所有格子: 格子中心到该位置的距离不超过格子的候选集查询半径
+    """
+    size = _get_tile_size(bucket)
+    row, col = int(math.floor((lat + 90) / size)), int(math.floor((lon + 180) / size))
+    # 半对角线不超过边长, 查询半径不超过max_radius; 先按max_radius圈出行列范围, 经度方向按范围内离赤道最远的纬度放大
+    max_radius = bucket * (1 + NEARBY_TILE_SIZE_RATIO) * 1000
+    lat_steps = int(math.ceil(max_radius / (size * METERS_PER_LAT_DEGREE)))
+    lon_scale = max(math.cos(math.radians(min(abs(lat) + (lat_steps + 1) * size, 90))), 0.01)
+    lon_steps = int(math.ceil(max_radius / (size * METERS_PER_LAT_DEGREE * lon_scale)))
+    tile_cols = range(col - lon_steps, col + lon_steps + 1)
+    tiles = []
+    for tile_row in range(row - lat_steps, row + lat_steps + 1):
+        centers = [_get_tile_center(tile_row, tile_col, size) for tile_col in tile_cols]
+        # 同一行的格子查询半径相同
+        query_radius = _get_query_radius(centers[0][0], centers[0][1], size, bucket) * 1000
+        distances = distances_from(lat, lon, centers)
+        tiles.extend('{}:{}'.format(tile_row, tile_col)
+                     for tile_col, distance in zip(tile_cols, distances) if distance <= query_radius)
+    return tiles
+
+
+def invalidate_nearby_tiles(lon, lat):
+    """
+    位置写入后删除受影响的格子缓存, 所有档位一次DEL
+    """
+    lon, lat = float(lon), float(lat)
+    keys = [NEARBY_TILE_KEY.format(bucket, tile) for bucket in NEARBY_RADIUS_BUCKETS
+            for tile in _get_affected_tiles(lon, lat, bucket)]
+    redis.delete(*keys)
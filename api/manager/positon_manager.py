@@ -1,10 +1,44 @@
 """
 管理距离相关
+
+位置以redis geo为准; redis中的位置数据缺失时(冷启动、数据丢失), 用*_db函数直接从数据库查找附近的单位:
+先用geohash前缀(有索引)和经纬度矩形在SQL中粗筛, 再对候选集精确计算距离
+足迹的位置按天分桶, 只保留最近FOOTPRINT_LOCATION_RETENTION_DAYS天, 数据库中查找时也只查这段时间内的足迹;
+另有一个集合只保存每个用户最新的一条可见足迹, 成员为"user_id:footprint_id", 附近接口per_user模式使用;
+重建: python manage.py rebuild_user_locations
+
+两个足迹索引是否完整由USER_LOCATION_READY_KEY标记: 标记不存在(分桶上线前的数据只在旧的单个集合
+LEGACY_USER_LOCATION_KEY中, 或redis数据丢失)时足迹从数据库查找, 同时投递一次celery任务重建索引,
+重建完成后删除旧集合, 不需要上线时手动执行重建
 """
-from redis_utils.container.api_geo import RedisGeo
+import datetime
+
+from django.conf import settings
+from django.db.models import Max
+
+from api.manager.nearby_tile_manager import invalidate_nearby_tiles
+from commercial.models import CommercialActivity
+from footprint.consts import AuditStatus
+from footprint.models import Footprint
+from redis_utils.container.api_geo import RedisGeo, ShardedRedisGeo
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import DAY_SECONDS
+from redis_utils.container.consts import GeoSortEnum
+from utilities.geo import bounding_box_filter, distances_from, geohash_filter, get_viewport_size
 
 activity_location_container = RedisGeo('activity_location')
-user_location_container = RedisGeo('user_location')
+user_location_container = ShardedRedisGeo('user_location', DAY_SECONDS, settings.FOOTPRINT_LOCATION_RETENTION_DAYS)
+user_latest_location_container = ShardedRedisGeo('user_latest_location', DAY_SECONDS,
+                                                 settings.FOOTPRINT_LOCATION_RETENTION_DAYS)
+# 用户当前在user_latest_location_container中的成员: user_id -> "user_id:footprint_id"
+USER_LATEST_MEMBER_KEY = 'user_latest_location_member'
+USER_LOCATION_REBUILD_BATCH = 500
+USER_LOCATION_READY_KEY = 'user_location:_READY'
+USER_LOCATION_REBUILD_LOCK_KEY = 'user_location:_REBUILDING'
+# 重建任务的最长耗时, 超过后允许再次投递
+USER_LOCATION_REBUILD_TIMEOUT = 10 * 60
+# 分桶之前所有足迹位置所在的集合
+LEGACY_USER_LOCATION_KEY = 'redis_geo_user_location'
 
 
 def add_user_location(footprint_id, lon, lat):
@@ -13,6 +47,17 @@ def add_user_location(footprint_id, lon, lat):
     """
 
     user_location_container.add(lon, lat, footprint_id)
+    invalidate_nearby_tiles(lon, lat)
+
+
+def add_footprint_location(footprint):
+    """
+    足迹加入附近, 隐藏的足迹不作为用户的最新位置
+    """
+    if footprint.lat and footprint.lon:
+        add_user_location(footprint.id, footprint.lon, footprint.lat)
+        if not footprint.hide:
+            set_user_latest_location(footprint.user_id, footprint.id, footprint.lon, footprint.lat)
 
 
 def remove_user_location(footprint_id):
@@ -21,7 +66,143 @@ def remove_user_location(footprint_id):
     :param footprint_id:
     :return:
     """
-    user_location_container.redis.zrem(user_location_container.cache_key, footprint_id)
+    position = user_location_container.get_position(footprint_id)[0]
+    user_location_container.remove(footprint_id)
+    if position:
+        invalidate_nearby_tiles(*position)
+
+
+def _build_latest_member(user_id, footprint_id):
+    return '{}:{}'.format(user_id, footprint_id)
+
+
+def get_footprint_id(member):
+    """
+    :param member: 足迹位置集合的成员footprint_id, 或每个用户最新足迹集合的成员"user_id:footprint_id"
+    """
+    member = member.decode('utf-8') if isinstance(member, bytes) else str(member)
+    return int(member.rsplit(':', 1)[-1])
+
+
+def set_user_latest_location(user_id, footprint_id, lon, lat, timestamp=None):
+    """
+    更新用户最新的足迹位置, 替换掉之前的
+    WATCH + MULTI, 同一个用户同时发多条足迹时不会都读到同一个旧位置、留下两个标记;
+    WATCH的是所有用户共用的hash, 其他用户同时写入时重试, 发足迹的频率很低, 重试的代价可以接受
+    """
+    member = _build_latest_member(user_id, footprint_id)
+
+    def replace(pipeline):
+        old_member = pipeline.hget(USER_LATEST_MEMBER_KEY, user_id)
+        pipeline.multi()
+        if old_member:
+            user_latest_location_container.remove(old_member, pipeline=pipeline)
+        user_latest_location_container.add(lon, lat, member, timestamp=timestamp, pipeline=pipeline)
+        pipeline.hset(USER_LATEST_MEMBER_KEY, user_id, member)
+
+    redis.transaction(replace, USER_LATEST_MEMBER_KEY)
+
+
+def remove_user_latest_location(user_id, footprint_id):
+    """
+    足迹删除后, 如果是用户最新的足迹, 换成用户保留期内的上一条可见足迹
+    """
+    member = _build_latest_member(user_id, footprint_id)
+
+    def remove(pipeline):
+        current_member = pipeline.hget(USER_LATEST_MEMBER_KEY, user_id)
+        if not current_member or current_member.decode('utf-8') != member:
+            return False
+        pipeline.multi()
+        user_latest_location_container.remove(member, pipeline=pipeline)
+        pipeline.hdel(USER_LATEST_MEMBER_KEY, user_id)
+        return True
+
+    if not redis.transaction(remove, USER_LATEST_MEMBER_KEY, value_from_callable=True):
+        return
+    footprint = get_retained_footprints_db().filter(user_id=user_id, hide=False, latitude__isnull=False).exclude(
+        id=footprint_id).order_by('-created_time', '-id').first()
+    if footprint:
+        set_user_latest_location(user_id, footprint.id, footprint.longitude, footprint.latitude,
+                                 footprint.created_time.timestamp())
+
+
+def on_footprint_deleted(footprint_id, user_id):
+    """
+    足迹删除后从位置索引中删除
+    """
+    remove_user_location(footprint_id)
+    remove_user_latest_location(user_id, footprint_id)
+
+
+def _add_by_bucket(container, items):
+    """
+    按创建时间批量写入分桶的集合
+    :param items: iterable of (timestamp, lon, lat, member)
+    :return: 写入的数量
+    """
+    count, bucket_2_args = 0, {}
+    for timestamp, lon, lat, member in items:
+        bucket = int(timestamp // container.bucket_seconds)
+        args = bucket_2_args.setdefault(bucket, [timestamp])
+        args.extend([lon, lat, member])
+        if len(args) > USER_LOCATION_REBUILD_BATCH * 3:
+            container.add(*args[1:], timestamp=args[0])
+            bucket_2_args.pop(bucket)
+        count += 1
+    for args in bucket_2_args.values():
+        container.add(*args[1:], timestamp=args[0])
+    return count
+
+
+def rebuild_user_locations():
+    """
+    从数据库重建保留期内足迹的位置索引和每个用户最新足迹的位置索引, 按创建时间放入对应的桶
+    :return: 写入的足迹数量
+    """
+    fields = ('id', 'user_id', 'latitude', 'longitude', 'created_time')
+    footprints = get_retained_footprints_db().filter(latitude__isnull=False).only(*fields)
+    count = _add_by_bucket(user_location_container, (
+        (footprint.created_time.timestamp(), footprint.longitude, footprint.latitude, footprint.id)
+        for footprint in footprints.iterator()))
+
+    latest_footprints = list(get_user_latest_footprints_db().only(*fields))
+    _add_by_bucket(user_latest_location_container, (
+        (footprint.created_time.timestamp(), footprint.longitude, footprint.latitude,
+         _build_latest_member(footprint.user_id, footprint.id)) for footprint in latest_footprints))
+    for index in range(0, len(latest_footprints), USER_LOCATION_REBUILD_BATCH):
+        redis.hmset(USER_LATEST_MEMBER_KEY, {
+            footprint.user_id: _build_latest_member(footprint.user_id, footprint.id)
+            for footprint in latest_footprints[index: index + USER_LOCATION_REBUILD_BATCH]})
+    redis.set(USER_LOCATION_READY_KEY, 1)
+    redis.delete(LEGACY_USER_LOCATION_KEY)
+    return count
+
+
+def is_user_location_ready():
+    return bool(redis.exists(USER_LOCATION_READY_KEY))
+
+
+def _rebuild_user_locations_if_missing():
+    """
+    足迹索引还没有重建过时投递重建任务, 同一时刻只投递一次
+    """
+    if redis.set(USER_LOCATION_REBUILD_LOCK_KEY, 1, nx=True, ex=USER_LOCATION_REBUILD_TIMEOUT):
+        # api.tasks引用了本模块
+        from api.tasks import rebuild_user_locations_task
+        rebuild_user_locations_task.delay()
+
+
+def _is_footprint_index_missing(container, footprints):
+    """
+    redis中的足迹位置是否不可用, 不可用时需要从数据库查找
+    :param footprints: 本次在redis中查到的足迹
+    """
+    if not is_user_location_ready():
+        _rebuild_user_locations_if_missing()
+        return True
+    # 结果为空时才需要区分是附近没有还是redis数据缺失
+    return not footprints and not container.cache_exists()
 
 
 def get_user_location(user_id):
@@ -43,11 +224,15 @@ def add_activity_location(activity_id, lon, lat):
     :return:
     """
     activity_location_container.add(lon, lat, activity_id)
+    invalidate_nearby_tiles(lon, lat)
 
 
 def remove_activity_location(activity_id):
     # 删除活动
+    position = activity_location_container.get_position(activity_id)[0]
     activity_location_container.redis.zrem(activity_location_container.cache_key, activity_id)
+    if position:
+        invalidate_nearby_tiles(*position)
 
 
 def get_activity_location(activity_id):
@@ -58,7 +243,132 @@ def get_activity_location(activity_id):
     position = activity_location_container.get_position(activity_id)[0]
     return position if position else [None, None]
 
-#################################################################################
 
+def filter_nearby_db(queryset, lon, lat, radius, lat_field='latitude', lon_field='longitude'):
+    """
+    在数据库中查找半径radius内的记录
+    :param queryset: 带geohash字段的QuerySet
+    :param radius: 半径, 单位km, 与RedisGeo一致
+    :param lat_field: 数值纬度字段
+    :param lon_field: 数值经度字段
+    :return: [(id, [lon, lat], distance)], 按距离由近到远排序, distance单位米
+    """
+    lon, lat, radius = float(lon), float(lat), float(radius) * 1000
+    rows = list(queryset.filter(geohash_filter(lat, lon, radius))
+                .filter(bounding_box_filter(lat, lon, radius, lat_field, lon_field))
+                .values_list('id', lon_field, lat_field))
+    distances = distances_from(lat, lon, [(row_lat, row_lon) for _, row_lon, row_lat in rows])
+    result = [(row_id, [row_lon, row_lat], distance)
+              for (row_id, row_lon, row_lat), distance in zip(rows, distances) if distance <= radius]
+    return sorted(result, key=lambda item: item[2])
+
+
+def get_retained_footprints_db():
+    """
+    位置索引保留期内审核通过的足迹
+    """
+    retention_start = datetime.datetime.fromtimestamp(user_location_container.get_retention_start())
+    return Footprint.objects.filter(created_time__gte=retention_start, audit_status=AuditStatus.PASSED)
+
+
+def get_user_latest_footprints_db():
+    """
+    保留期内每个用户最新的一条可见足迹
+    """
+    footprints = get_retained_footprints_db().filter(hide=False, latitude__isnull=False)
+    return Footprint.objects.filter(id__in=footprints.values('user').annotate(latest_id=Max('id')).values('latest_id'))
+
+
+def get_nearby_footprints_db(lon, lat, radius, per_user=False):
+    """
+    :param per_user: 每个用户只取最新的一条可见足迹
+    :return: [(footprint_id, lon, lat)]
+    """
+    queryset = get_user_latest_footprints_db() if per_user else get_retained_footprints_db()
+    return [(footprint_id, position[0], position[1]) for footprint_id, position, _ in filter_nearby_db(
+        queryset, lon, lat, radius)]
+
+
+def get_nearby_activities_db(lon, lat, radius):
+    """
+    :return: [(activity_id, lon, lat)]
+    """
+    return [(activity_id, position[0], position[1]) for activity_id, position, _ in filter_nearby_db(
+        CommercialActivity.objects.all(), lon, lat, radius, lat_field='lat', lon_field='lon')]
+
+
+def _get_footprint_container(per_user):
+    return user_latest_location_container if per_user else user_location_container
+
+
+def load_nearby_positions(lon, lat, radius, per_user=False, limit=None):
+    """
+    查找附近的足迹和活动, 两个集合的查询在一次redis往返中完成; redis中没有位置数据时从数据库查找
+    :param radius: 单位km
+    :param per_user: 每个用户只返回最新的一条可见足迹
+    :param limit: 足迹和活动各最多返回最近的limit个(GEORADIUS COUNT), 不限制时不排序
+    :return: {'footprints': [(footprint_id, lon, lat)], 'activities': [(activity_id, lon, lat)]}
+    """
+    footprint_container = _get_footprint_container(per_user)
+    footprint_members, activity_members = RedisGeo.search_many(
+        [footprint_container, activity_location_container], lon, lat, radius, count=limit,
+        sort=GeoSortEnum.ASC if limit else None)
+    footprints = [(get_footprint_id(item.member), item.lon, item.lat) for item in footprint_members]
+    activities = [(int(item.member), item.lon, item.lat) for item in activity_members]
+    if _is_footprint_index_missing(footprint_container, footprints):
+        footprints = get_nearby_footprints_db(lon, lat, radius, per_user)[:limit]
+    if not activities and not activity_location_container.cache_exists():
+        activities = get_nearby_activities_db(lon, lat, radius)[:limit]
+    return {'footprints': footprints, 'activities': activities}
 
 
+def load_nearest_positions(lon, lat, radius, limit, per_user=False):
+    """
+    查找radius内最近的limit个足迹和活动, @see RedisGeo.nearest
+    :return: {'footprints': [(footprint_id, lon, lat)], 'activities': [(activity_id, lon, lat)]}, 按距离由近到远排序
+    """
+    result = {}
+    for name, container, load_db, parse_member, is_missing in (
+            ('footprints', _get_footprint_container(per_user),
+             lambda *args: get_nearby_footprints_db(*args, per_user=per_user), get_footprint_id,
+             _is_footprint_index_missing),
+            ('activities', activity_location_container, get_nearby_activities_db, int,
+             lambda container, items: not items and not container.cache_exists())):
+        items = [(parse_member(item.member), item.lon, item.lat) for item in container.nearest(lon, lat, limit, radius)]
+        if is_missing(container, items):
+            items = load_db(lon, lat, radius)[:limit]
+        result[name] = items
+    return result
+
+
+def filter_in_box_db(queryset, min_lon, min_lat, max_lon, max_lat, limit, lat_field='latitude', lon_field='longitude'):
+    """
+    在数据库中查找矩形内的记录, geohash前缀(有索引)粗筛后再按经纬度范围过滤
+    :return: [(id, lon, lat)], 按到矩形中心的距离由近到远排序, 最多limit个
+    """
+    center_lon, center_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    half_diagonal = max(distances_from(center_lat, center_lon, [(min_lat, min_lon), (max_lat, max_lon)]))
+    rows = list(queryset.filter(geohash_filter(center_lat, center_lon, half_diagonal)).filter(**{
+        lat_field + '__range': (min_lat, max_lat), lon_field + '__range': (min_lon, max_lon)})
+                .values_list('id', lon_field, lat_field))
+    distances = distances_from(center_lat, center_lon, [(row_lat, row_lon) for _, row_lon, row_lat in rows])
+    return [row for _, row in sorted(zip(distances, rows), key=lambda item: item[0])][:limit]
+
+
+def load_box_positions(min_lon, min_lat, max_lon, max_lat, limit):
+    """
+    查找矩形(地图可视区域)内离中心最近的limit个足迹和活动, 一次redis往返; redis中没有位置数据时从数据库查找
+    :return: {'footprints': [(footprint_id, lon, lat)], 'activities': [(activity_id, lon, lat)]}, 按到中心的距离排序
+    """
+    center_lon, center_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    width, height = get_viewport_size(min_lon, min_lat, max_lon, max_lat)
+    footprints, activities = [
+        [(int(item.member), item.lon, item.lat) for item in items]
+        for items in RedisGeo.search_box_many([user_location_container, activity_location_container],
+                                              center_lon, center_lat, width / 1000, height / 1000, count=limit)]
+    if _is_footprint_index_missing(user_location_container, footprints):
+        footprints = filter_in_box_db(get_retained_footprints_db(), min_lon, min_lat, max_lon, max_lat, limit)
+    if not activities and not activity_location_container.cache_exists():
+        activities = filter_in_box_db(CommercialActivity.objects.all(), min_lon, min_lat, max_lon, max_lat, limit,
+                                      lat_field='lat', lon_field='lon')
+    return {'footprints': footprints, 'activities': activities}
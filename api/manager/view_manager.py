@@ -1,102 +1,171 @@
-from geopy.distance import geodesic
+import math
+from functools import partial
 
-from api.manager.positon_manager import user_location_container, activity_location_container
-from commercial.manager.db_manager import get_commercial_activities_by_ids_db
-from footprint.manager.footprint_manager import get_footprints_by_ids_db, is_user_favored
+from api.manager.nearby_tile_manager import get_nearby_candidates
+from api.manager.positon_manager import load_nearby_positions, load_nearest_positions, load_box_positions
+from footprint.manager.flow_card_manager import get_flow_cards
+from footprint.manager.favor_manager import get_favored_flows
 from footprint.models import FlowType
 from utilities.date_time import time_format, datetime_to_str
+from utilities.geo import cluster_points, distances_from, get_cluster_precision, get_viewport_size
 
+# 聚合模式下每类单位最多参与聚合的数量, 附近接口取最近的, 可视区域取离中心最近的
+CLUSTER_MAX_MEMBERS = 50000
+# 聚合区域内最多的格子数, 放大地图查询大范围时降低聚合精度, 返回的格子数约为几百个
+CLUSTER_MAX_CELLS = 400
 
-def build_footprint_info(footprint, position):
+
+def build_footprint_info(card, position):
     return {
-        'footprint_id': footprint.id,
-        'time': time_format(footprint.created_time),
-        'user_id': footprint.user_id,
-        'name': footprint.name,
-        'avatar': footprint.avatar,
+        'footprint_id': card['flow_id'],
+        'time': time_format(card['created_time']),
+        'user_id': card['user_id'],
+        'name': card['name'],
+        'avatar': card['avatar'],
         'lat': position[1],
         'lon': position[0]
     }
 
 
-def build_activity_info(activity, position):
+def build_activity_info(card, position):
     return {
-        'activity_id': activity.id,
-        'name': activity.name,
-        'avatar': activity.club.avatar.url,
-        'quota': '【{}/{}】'.format(activity.participant_num, activity.total_quota),
-        'description': activity.description,
+        'activity_id': card['flow_id'],
+        'name': card['activity_name'],
+        'avatar': card['avatar'],
+        'quota': '【{}/{}】'.format(card['participant_num'], card['total_quota']),
+        'description': card['description'],
         'lat': position[1],
         'lon': position[0]
     }
 
 
-def get_nearby_activity(lon, lat, radius=7):
+def _get_id_2_position(items):
+    """
+    :param items: [(id, lon, lat)]
+    :return: {id: [lon, lat]}, 保持原有顺序
+    """
+    return {item_id: [item_lon, item_lat] for item_id, item_lon, item_lat in items}
+
+
+def get_nearby_activity(lon, lat, radius=7, limit=None, per_user=False):
     """
     获取附近的活动
     :param radius: 搜索半径，要求15km，那就订成7km
     :param lon:
     :param lat:
+    :param limit: 足迹和活动各最多返回最近的limit个, 不限制时返回半径内所有的
+    :param per_user: 每个用户只返回最新的一条可见足迹
     :return:
     """
-    # 构建用户足迹相关
-    user_locations = user_location_container.get_members_within_radius(lon, lat, radius)
-    positions = user_location_container.get_position(*user_locations)
-    footprint_id_2_position = {int(footprint_id): location for footprint_id, location in zip(user_locations, positions)}
-    footprints = get_footprints_by_ids_db([int(item) for item in user_locations])
-
-    result = {
-        'footprints': [build_footprint_info(footprint, footprint_id_2_position.get(footprint.id))
-                       for footprint in footprints]
+    if limit:
+        # 只要最近的几个时由近及远扩大半径查找, 不需要取出整个半径内的单位
+        candidates = load_nearest_positions(lon, lat, radius, limit, per_user)
+        footprint_id_2_position = _get_id_2_position(candidates['footprints'])
+        activity_id_2_position = _get_id_2_position(candidates['activities'])
+    else:
+        # 候选集来自geo格子缓存, 距离过滤和排序对每个请求单独计算
+        # per_user模式的查询集合小, 不走格子缓存
+        loader = partial(load_nearby_positions, per_user=True) if per_user else load_nearby_positions
+        candidates = get_nearby_candidates(lon, lat, radius, loader, use_cache=not per_user)
+        footprint_id_2_position = {footprint_id: position for footprint_id, position, _ in candidates['footprints']}
+        activity_id_2_position = {activity_id: position for activity_id, position, _ in candidates['activities']}
+
+    return _build_nearby_result(footprint_id_2_position, activity_id_2_position)
+
+
+def _build_nearby_result(footprint_id_2_position, activity_id_2_position):
+    cards = get_flow_cards([(footprint_id, FlowType.FOOTPRINT) for footprint_id in footprint_id_2_position] +
+                           [(activity_id, FlowType.ACTIVITY) for activity_id in activity_id_2_position])
+    return {
+        'footprints': [build_footprint_info(cards[(footprint_id, FlowType.FOOTPRINT)], position)
+                       for footprint_id, position in footprint_id_2_position.items()
+                       if (footprint_id, FlowType.FOOTPRINT) in cards],
+        'activities': [build_activity_info(cards[(activity_id, FlowType.ACTIVITY)], position)
+                       for activity_id, position in activity_id_2_position.items()
+                       if (activity_id, FlowType.ACTIVITY) in cards],
+    }
+
+
+def get_viewport_activity(min_lon, min_lat, max_lon, max_lat, limit):
+    """
+    获取地图可视区域内的足迹和活动
+    :return: 同get_nearby_activity, 足迹和活动各最多limit个, 按到区域中心的距离排序
+    """
+    candidates = load_box_positions(min_lon, min_lat, max_lon, max_lat, limit)
+    return _build_nearby_result(_get_id_2_position(candidates['footprints']),
+                                _get_id_2_position(candidates['activities']))
+
+
+def _build_cluster_result(candidates, zoom, area, lat):
+    """
+    :param candidates: {'footprints': [(id, lon, lat)], 'activities': [(id, lon, lat)]}
+    :param area: 聚合区域的面积, 单位平方米
+    :param lat: 聚合区域中心的纬度
+    :return: {footprint_clusters: [{geohash, count, lon, lat, sample_ids}], activity_clusters: [...]}
+    """
+    precision = get_cluster_precision(zoom, area=area, lat=lat, max_cells=CLUSTER_MAX_CELLS)
+    return {
+        'footprint_clusters': cluster_points(candidates['footprints'], precision),
+        'activity_clusters': cluster_points(candidates['activities'], precision),
     }
-    # 构建企业活动相关
-    activity_locations = activity_location_container.get_members_within_radius(lon, lat, radius)
-    positions = user_location_container.get_position(*activity_locations)
-    activity_id_2_position = {int(footprint_id): location for footprint_id, location in zip(activity_locations, positions)}
-    activities = get_commercial_activities_by_ids_db([int(item) for item in activity_locations])
 
-    result.update({
-        'activities': [build_activity_info(activity, activity_id_2_position.get(activity.id))
-                       for activity in activities]
-    })
-    return result
+
+def get_nearby_clusters(lon, lat, radius, zoom):
+    """
+    附近的足迹和活动按格子聚合, 缩小地图时使用, 参与聚合的单位为最近的CLUSTER_MAX_MEMBERS个
+    """
+    # 在GEORADIUS中限制数量, 不经过格子缓存(缓存的是整个候选范围)
+    candidates = load_nearby_positions(lon, lat, radius, limit=CLUSTER_MAX_MEMBERS)
+    return _build_cluster_result(candidates, zoom, math.pi * (radius * 1000) ** 2, lat)
+
+
+def get_viewport_clusters(min_lon, min_lat, max_lon, max_lat, zoom):
+    """
+    地图可视区域内的足迹和活动按格子聚合, 参与聚合的单位最多CLUSTER_MAX_MEMBERS个
+    """
+    width, height = get_viewport_size(min_lon, min_lat, max_lon, max_lat)
+    return _build_cluster_result(load_box_positions(min_lon, min_lat, max_lon, max_lat, CLUSTER_MAX_MEMBERS), zoom,
+                                 width * height, (min_lat + max_lat) / 2)
 
 
-def build_footprint_for_flow(footprint, user_id, lon, lat):
+def build_footprint_for_flow(card, favored, distance):
     return {
-        'flow_id': footprint.id, 'flow_type': FlowType.FOOTPRINT, 'avatar': footprint.avatar,
-        'name': footprint.name, 'distance': geodesic((lat, lon), (footprint.lat, footprint.lon)).meters,
-        'location': footprint.location,
-        'post_time': datetime_to_str(footprint.created_time), 'content': footprint.content,
-        'image_list': footprint.image_list,
-        'user_id': footprint.user_id,
-        'favored': is_user_favored(user_id, footprint.id, FlowType.FOOTPRINT),
-        'favor_num': footprint.favor_num,
+        'flow_id': card['flow_id'], 'flow_type': FlowType.FOOTPRINT, 'avatar': card['avatar'],
+        'name': card['name'], 'distance': distance,
+        'location': card['location'],
+        'post_time': datetime_to_str(card['created_time']), 'content': card['content'],
+        'image_list': card['image_list'],
+        'user_id': card['user_id'],
+        'favored': favored,
+        'favor_num': card['favor_num'],
     }
 
 
-def build_activity_for_flow(activity, user_id, lon, lat):
-    club = activity.club
+def build_activity_for_flow(card, favored, distance):
     return {
-        'flow_id': activity.id, 'flow_type': FlowType.ACTIVITY, 'avatar': club.avatar.url,
-        'name': club.name, 'distance': geodesic((lat, lon), (activity.lat, activity.lon)).meters,
-        'location': activity.address,
-        'post_time': datetime_to_str(activity.created_time), 'content': activity.introduction,
-        'image_list': activity.image_list,
-        'favored': is_user_favored(user_id, activity.id, FlowType.ACTIVITY),
-        'favor_num': activity.favor_num,
+        'flow_id': card['flow_id'], 'flow_type': FlowType.ACTIVITY, 'avatar': card['avatar'],
+        'name': card['name'], 'distance': distance,
+        'location': card['location'],
+        'post_time': datetime_to_str(card['created_time']), 'content': card['content'],
+        'image_list': card['image_list'],
+        'favored': favored,
+        'favor_num': card['favor_num'],
     }
 
 
 def build_flows_detail(flows, user_id, lon, lat):
     """
-    构建事件流详情，需要针对足迹和活动分别build
+    构建事件流详情，卡片从缓存批量获取，再合并点赞状态和距离
     """
-    footprint_flows = filter(lambda item: item.flow_type == FlowType.FOOTPRINT, flows)
-    activity_flows = filter(lambda item: item.flow_type == FlowType.ACTIVITY, flows)
-    footprints = get_footprints_by_ids_db([item.flow_id for item in footprint_flows])
-    activities = get_commercial_activities_by_ids_db([item.flow_id for item in activity_flows])
-    footprint_details = [build_footprint_for_flow(footprint, user_id, lon, lat) for footprint in footprints]
-    activity_details = [build_activity_for_flow(activity, user_id, lon, lat) for activity in activities]
-    total_flow = footprint_details + activity_details
+    flow_pairs = [(item.flow_id, item.flow_type) for item in flows]
+    cards = get_flow_cards(flow_pairs)
+    cards = [cards[flow_pair] for flow_pair in flow_pairs if flow_pair in cards]
+    favored_flows = get_favored_flows(user_id, flow_pairs)
+    # 整页的距离一次算完
+    distances = distances_from(lat, lon, [(card['lat'], card['lon']) for card in cards])
+    total_flow = [
+        (build_footprint_for_flow if card['flow_type'] == FlowType.FOOTPRINT else build_activity_for_flow)(
+            card, (card['flow_id'], card['flow_type']) in favored_flows, distance)
+        for card, distance in zip(cards, distances)
+    ]
     return sorted(total_flow, key=lambda flow: flow['post_time'], reverse=True)
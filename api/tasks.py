@@ -0,0 +1,14 @@
+from api.manager.positon_manager import rebuild_user_locations, USER_LOCATION_REBUILD_LOCK_KEY
+from celery_apps import app
+from redis_utils.container.api_redis_client import redis
+
+
+@app.task
+def rebuild_user_locations_task():
+    """
+    足迹位置索引缺失时由附近接口投递, 从数据库重建
+    """
+    try:
+        return rebuild_user_locations()
+    finally:
+        redis.delete(USER_LOCATION_REBUILD_LOCK_KEY)
@@ -0,0 +1,44 @@
+"""
+测试用fake redis的geo命令的基准测试, 不在单元测试中运行, 需要时手动执行:
+python manage.py test --settings=settings-test api.testing.benchmark_fake_geo
+"""
+import random
+import time
+
+import numpy as np
+from django.test import TestCase
+
+from redis_utils.connection.fake_redis import _haversine
+from redis_utils.container.api_redis_client import redis
+
+
+class FakeGeoBenchmark(TestCase):
+    """
+    大数据量下GEORADIUS只扫描附近的格子
+    python manage.py test --settings=settings-test api.testing.benchmark_fake_geo.FakeGeoBenchmark
+    """
+    SIZE = 50000
+    TIMES = 200
+
+    def setUp(self):
+        redis.flushdb()
+
+    def test_georadius_benchmark(self):
+        """
+        python manage.py test --settings=settings-test api.testing.benchmark_fake_geo.FakeGeoBenchmark.test_georadius_benchmark
+        """
+        random.seed(self.SIZE)
+        places = [(random.uniform(115, 118), random.uniform(39, 41), str(index)) for index in range(self.SIZE)]
+        for index in range(0, self.SIZE, 500):
+            redis.geoadd('test_geo_large', *[value for place in places[index: index + 500] for value in place])
+        lons, lats = np.array(redis.geopos('test_geo_large', *[place[2] for place in places])).T
+
+        queries = [(random.uniform(115, 118), random.uniform(39, 41), random.choice([0.5, 3, 20]))
+                   for _ in range(self.TIMES)]
+        start = time.time()
+        results = [redis.georadius('test_geo_large', lon, lat, radius, 'km') for lon, lat, radius in queries]
+        cost = time.time() - start
+        for (lon, lat, radius), result in zip(queries, results):
+            expected = np.nonzero(_haversine(lon, lat, lons, lats) <= radius * 1000)[0]
+            self.assertEqual(sorted(int(member) for member in result), expected.tolist())
+        print('fake georadius: {} points, {:.1f}ms per query'.format(self.SIZE, cost * 1000 / self.TIMES))
@@ -1,13 +1,44 @@
+import datetime
+import math
+import random
+import time
+from unittest.mock import patch
+
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from api.manager.nearby_tile_manager import get_radius_bucket, get_tile, nearby_tile_hit_counter, NEARBY_TILE_KEY, \
+    invalidate_nearby_tiles
+from api.manager.positon_manager import add_user_location, activity_location_container, user_location_container, \
+    load_nearby_positions, set_user_latest_location, user_latest_location_container, get_footprint_id, \
+    is_user_location_ready, LEGACY_USER_LOCATION_KEY
+from api.manager.view_manager import CLUSTER_MAX_CELLS
 from api.testing import mock
+from api.view import NEARBY_MAX_LIMIT
+from commercial.models import CommercialActivity
 from commercial.testing.mock import create_activity
-from footprint.models import FlowType
+from footprint.manager.flow_timeline_manager import rebuild_flow_timeline
+from footprint.models import FlowType, Favor, Footprint
+from redis_utils.connection.fake_redis import _haversine
+from redis_utils.container.api_geo import RedisGeo, ShardedRedisGeo
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import DAY_SECONDS
+from redis_utils.container.consts import GeoSortEnum, GeoUnitEnum
+from utilities.geo import distances_from, encode_geohash, get_cluster_precision
 from utilities.mock_utility.helper import create_user_login_client
 
 
 class TestNearby(TestCase):
 
+    def setUp(self):
+        # 测试用的redis在用例之间共享, 需要清空后重建时间线
+        redis.flushdb()
+        rebuild_flow_timeline()
+
     def test_get_nearby_activities(self):
         """
         python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_get_nearby_activities
@@ -31,4 +62,478 @@ class TestNearby(TestCase):
         self.assertEqual(len(items), 2)
         self.assertEqual(items[0]['location'], '填上')
 
+    def test_discovery_query_count(self):
+        """
+        discovery的查询次数不随条目数量增长
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_discovery_query_count
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint = mock.create_footprint(user_info)
+        Favor.objects.create(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT, user_id=user.id)
+        with CaptureQueriesContext(connection) as small_page:
+            items = client.json_get('/api/discovery/')['items']
+        self.assertEqual(len(items), 1)
+        self.assertTrue(items[0]['favored'])
+
+        for _ in range(10):
+            mock.create_footprint(user_info)
+        with CaptureQueriesContext(connection) as large_page:
+            items = client.json_get('/api/discovery/')['items']
+        self.assertEqual(len(items), 11)
+        self.assertEqual([item['favored'] for item in items].count(True), 1)
+        self.assertEqual(len(small_page), len(large_page))
+
+    def test_discovery_cursor(self):
+        """
+        discovery游标翻页
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_discovery_cursor
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint_ids = [mock.create_footprint(user_info).id for _ in range(25)]
+
+        result = client.json_get('/api/discovery/', {'cursor': ''})
+        self.assertEqual(len(result['items']), 20)
+        self.assertTrue(result['has_more'])
+        first_page_ids = [item['flow_id'] for item in result['items']]
+
+        result = client.json_get('/api/discovery/', {'cursor': result['next_cursor']})
+        self.assertEqual(len(result['items']), 5)
+        self.assertFalse(result['has_more'])
+        self.assertEqual(result['next_cursor'], '')
+        second_page_ids = [item['flow_id'] for item in result['items']]
+        self.assertEqual(sorted(first_page_ids + second_page_ids), sorted(footprint_ids))
+
+        result = client.json_get('/api/discovery/', {'cursor': 'invalid'})
+        self.assertEqual(result['error_code'], 1)
+
+    def test_discovery_timeline(self):
+        """
+        discovery优先读取redis时间线, 缓存缺失时回源数据库并重建
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_discovery_timeline
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint_ids = [mock.create_footprint(user_info).id for _ in range(3)]
+
+        def discovery_flow_ids(params=None):
+            with CaptureQueriesContext(connection) as queries:
+                result = client.json_get('/api/discovery/', params or {})
+            total_flow_queried = any('footprint_totalflow' in query['sql'] for query in queries.captured_queries)
+            return sorted(item['flow_id'] for item in result['items']), total_flow_queried
+
+        flow_ids, total_flow_queried = discovery_flow_ids()
+        self.assertEqual(flow_ids, footprint_ids)
+        self.assertFalse(total_flow_queried)
+        flow_ids, total_flow_queried = discovery_flow_ids({'cursor': ''})
+        self.assertEqual(flow_ids, footprint_ids)
+        self.assertFalse(total_flow_queried)
+
+        # redis数据丢失: 回源数据库, 同时重建时间线
+        redis.flushdb()
+        flow_ids, total_flow_queried = discovery_flow_ids()
+        self.assertEqual(flow_ids, footprint_ids)
+        self.assertTrue(total_flow_queried)
+        flow_ids, total_flow_queried = discovery_flow_ids()
+        self.assertEqual(flow_ids, footprint_ids)
+        self.assertFalse(total_flow_queried)
+
+        redis.flushdb()
+        call_command('rebuild_flow_timeline', stdout=open('/dev/null', 'w'))
+        flow_ids, total_flow_queried = discovery_flow_ids({'cursor': ''})
+        self.assertEqual(flow_ids, footprint_ids)
+        self.assertFalse(total_flow_queried)
+
+    def test_nearby_db_fallback(self):
+        """
+        redis中没有位置数据时, 附近的足迹和活动从数据库中查找
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_nearby_db_fallback
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint_ids = sorted(mock.create_footprint(user_info).id for _ in range(5))
+        activity_id = create_activity().id
+        far_footprint = mock.create_footprint(user_info)
+        far_footprint.lat, far_footprint.lon = '31.23', '121.47'
+        far_footprint.save(update_fields=['lat', 'lon'])
+        add_user_location(far_footprint.id, far_footprint.lon, far_footprint.lat)
+        far_footprint.refresh_from_db()
+        self.assertEqual((far_footprint.latitude, far_footprint.longitude), (31.23, 121.47))
+        self.assertEqual(far_footprint.geohash, encode_geohash(31.23, 121.47))
+
+        def nearby_ids():
+            result = client.json_get('/api/get_nearby_activities/', {'lon': 116.4, 'lat': 40.4, 'radius': 100})
+            return (sorted(item['footprint_id'] for item in result['footprints']),
+                    [item['activity_id'] for item in result['activities']])
+
+        self.assertEqual(nearby_ids(), (footprint_ids, [activity_id]))
+        redis.flushdb()
+        self.assertEqual(nearby_ids(), (footprint_ids, [activity_id]))
+
+        # 已有数据没有geohash时查不到, 回填之后恢复
+        Footprint.objects.update(latitude=None, longitude=None, geohash='')
+        CommercialActivity.objects.update(geohash='')
+        redis.flushdb()
+        self.assertEqual(nearby_ids(), ([], []))
+        call_command('backfill_geo_fields', stdout=open('/dev/null', 'w'))
+        # 回填不经过位置写入, 格子缓存需要等过期
+        redis.flushdb()
+        self.assertEqual(nearby_ids(), (footprint_ids, [activity_id]))
+
+    def test_nearby_tile_cache(self):
+        """
+        同一个格子内的查询共用候选集, 写入位置后失效
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_nearby_tile_cache
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprints = [mock.create_footprint(user_info) for _ in range(5)]
+        tile = get_tile(116.4, 40.4, get_radius_bucket(30))[0]
+        self.assertEqual(get_tile(116.41, 40.41, get_radius_bucket(30))[0], tile)
+
+        def nearby_footprints(lon, lat, radius):
+            result = client.json_get('/api/get_nearby_activities/', {'lon': lon, 'lat': lat, 'radius': radius})
+            return [item['footprint_id'] for item in result['footprints']]
+
+        def expected_footprints(lon, lat, radius):
+            distances = distances_from(lat, lon, [(footprint.lat, footprint.lon) for footprint in footprints])
+            return [footprint.id for distance, footprint in sorted(zip(distances, footprints), key=lambda x: x[0])
+                    if distance <= radius * 1000]
+
+        nearby_tile_hit_counter.clear()
+        self.assertEqual(nearby_footprints(116.4, 40.4, 30), expected_footprints(116.4, 40.4, 30))
+        # 同一格子同一档位, 结果按各自的位置和半径计算
+        self.assertEqual(nearby_footprints(116.41, 40.41, 20), expected_footprints(116.41, 40.41, 20))
+        self.assertEqual(nearby_tile_hit_counter.get_stats()['hit'], 1)
+
+        footprints.append(mock.create_footprint(user_info))
+        self.assertEqual(nearby_footprints(116.4, 40.4, 30), expected_footprints(116.4, 40.4, 30))
+        self.assertEqual(nearby_tile_hit_counter.get_stats(), {'hit': 1, 'miss': 2, 'hit_ratio': 0.3333})
+
+        # 只删除候选范围覆盖写入位置的格子
+        tile, center_lon, center_lat, query_radius = get_tile(116.4, 40.4, 30)
+        key = NEARBY_TILE_KEY.format(30, tile)
+        far_lon = 117.3
+        self.assertGreater(distances_from(center_lat, center_lon, [(center_lat, far_lon)])[0], query_radius * 1000)
+        invalidate_nearby_tiles(far_lon, center_lat)
+        self.assertTrue(redis.exists(key))
+        invalidate_nearby_tiles(116.7, 40.6)
+        self.assertFalse(redis.exists(key))
+
+    def test_geo_search(self):
+        """
+        一次查询返回单位、距离和坐标
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_geo_search
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprints = [mock.create_footprint(user_info) for _ in range(3)]
+        activities = [create_activity() for _ in range(3)]
+
+        members = activity_location_container.search(116, 40, 200)
+        self.assertEqual(len(members), 3)
+        self.assertEqual([member.distance for member in members], sorted(member.distance for member in members))
+        activity_id_2_position = {activity.id: (activity.lon, activity.lat) for activity in activities}
+        for member in members:
+            self.assertAlmostEqual(member.lon, activity_id_2_position[int(member.member)][0], places=5)
+            self.assertAlmostEqual(member.lat, activity_id_2_position[int(member.member)][1], places=5)
+        self.assertEqual(activity_location_container.search(116, 40, 200, count=1), members[:1])
+
+        footprint_members, activity_members = RedisGeo.search_many(
+            [user_location_container, activity_location_container], 116, 40, 200)
+        self.assertEqual(sorted(int(member.member) for member in footprint_members),
+                         sorted(footprint.id for footprint in footprints))
+        self.assertEqual(activity_members, members)
+
+        result = client.json_get('/api/get_nearest_activity/', {'lon': 116, 'lat': 40})
+        self.assertEqual((result['lon'], result['lat']), (members[0].lon, members[0].lat))
+        # 活动的坐标来自活动自己的集合
+        result = client.json_get('/api/get_nearby_activities/', {'lon': 116, 'lat': 40, 'radius': 200})
+        self.assertEqual({item['activity_id']: (item['lon'], item['lat']) for item in result['activities']},
+                         {int(member.member): (member.lon, member.lat) for member in members})
+
+    def test_nearest(self):
+        """
+        由近及远扩大半径查找最近的k个
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_nearest
+        """
+        client, user = create_user_login_client()
+        # 与(116, 40)分别相距约0.4km, 3km, 20km, 80km
+        activity_ids = []
+        for lat_offset in (0.004, 0.027, 0.18, 0.72):
+            activity = create_activity()
+            activity_location_container.add(116, 40 + lat_offset, activity.id)
+            activity_ids.append(activity.id)
+
+        with patch.object(activity_location_container, 'search', wraps=activity_location_container.search) \
+                as search:
+            members = activity_location_container.nearest(116, 40, 2, 100)
+        self.assertEqual([int(member.member) for member in members], activity_ids[:2])
+        self.assertEqual([call[0][2] for call in search.call_args_list], [1, 5])
+        self.assertEqual([int(member.member) for member in activity_location_container.nearest(116, 40, 10, 50)],
+                         activity_ids[:3])
+
+        result = client.json_get('/api/get_nearest_activity/', {'lon': 116, 'lat': 40, 'limit': 3})
+        self.assertEqual([item['activity_id'] for item in result['items']], activity_ids[:3])
+        self.assertEqual((result['lon'], result['lat']), (result['items'][0]['lon'], result['items'][0]['lat']))
+
+        result = client.json_get('/api/get_nearby_activities/', {'lon': 116, 'lat': 40, 'radius': 100, 'limit': 2})
+        self.assertEqual([item['activity_id'] for item in result['activities']], activity_ids[:2])
+        redis.flushdb()
+        result = client.json_get('/api/get_nearby_activities/', {'lon': 116, 'lat': 40, 'radius': 100, 'limit': 2})
+        self.assertEqual(len(result['activities']), 2)
+
+        for limit in ('abc', '-1'):
+            result = client.json_get('/api/get_nearby_activities/', {'lon': 116, 'lat': 40, 'limit': limit})
+            self.assertEqual(result['error_code'], 1)
+        for params in ({'limit': 'abc'}, {'limit': 0}, {'lat': 'abc'}, {'lat': 100}):
+            result = client.json_get('/api/get_nearest_activity/', dict({'lon': 116, 'lat': 40}, **params))
+            self.assertEqual(result['error_code'], 1)
+        with patch('api.view.get_nearby_activity', return_value={}) as get_nearby_activity:
+            client.json_get('/api/get_nearby_activities/', {'lon': 116, 'lat': 40, 'limit': 100000})
+        self.assertEqual(get_nearby_activity.call_args[0][3], NEARBY_MAX_LIMIT)
+
+    def test_viewport(self):
+        """
+        只返回地图可视区域内的足迹和活动
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_viewport
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprints = [mock.create_footprint(user_info) for _ in range(10)]
+        activities = [create_activity() for _ in range(5)]
+        viewport = {'min_lon': 116.25, 'min_lat': 40.25, 'max_lon': 116.65, 'max_lat': 40.65}
+
+        def in_viewport(item):
+            return viewport['min_lon'] <= float(item.lon) <= viewport['max_lon'] and \
+                viewport['min_lat'] <= float(item.lat) <= viewport['max_lat']
+
+        def viewport_ids(**params):
+            result = client.json_get('/api/get_viewport_activities/', dict(viewport, **params))
+            return ([item['footprint_id'] for item in result['footprints']],
+                    [item['activity_id'] for item in result['activities']])
+
+        footprint_ids, activity_ids = viewport_ids()
+        self.assertEqual(sorted(footprint_ids), [footprint.id for footprint in footprints if in_viewport(footprint)])
+        self.assertEqual(sorted(activity_ids), [activity.id for activity in activities if in_viewport(activity)])
+        # 数量限制时保留离中心最近的
+        limited_footprint_ids, _ = viewport_ids(limit=2)
+        self.assertEqual(limited_footprint_ids, footprint_ids[:2])
+
+        redis.flushdb()
+        self.assertEqual([sorted(ids) for ids in viewport_ids()], [sorted(footprint_ids), sorted(activity_ids)])
+        self.assertEqual(len(viewport_ids(limit=2)[0]), min(len(footprint_ids), 2))
+        self.assertEqual(client.json_get('/api/get_viewport_activities/', {'min_lon': 116})['error_code'], 1)
+
+    def test_clusters(self):
+        """
+        缩小地图时按geohash格子聚合
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_clusters
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprints = [mock.create_footprint(user_info) for _ in range(20)]
+        create_activity()
+        zoom = 11
+
+        def check_clusters(clusters, expected_footprints, precision):
+            self.assertEqual(sum(cluster['count'] for cluster in clusters), len(expected_footprints))
+            self.assertEqual([cluster['count'] for cluster in clusters],
+                             sorted((cluster['count'] for cluster in clusters), reverse=True))
+            geohash_2_ids = {}
+            for footprint in expected_footprints:
+                geohash_2_ids.setdefault(encode_geohash(float(footprint.lat), float(footprint.lon), precision),
+                                         []).append(footprint.id)
+            for cluster in clusters:
+                self.assertEqual(cluster['count'], len(geohash_2_ids[cluster['geohash']]))
+                self.assertTrue(set(cluster['sample_ids']) <= set(geohash_2_ids[cluster['geohash']]))
+                self.assertEqual(len(cluster['sample_ids']), min(cluster['count'], 3))
+
+        result = client.json_get('/api/get_nearby_activities/', {'lon': 116.4, 'lat': 40.4, 'radius': 100,
+                                                                 'zoom': zoom})
+        # 100km内的格子数超过CLUSTER_MAX_CELLS, 精度低于缩放级别对应的精度
+        precision = get_cluster_precision(zoom, area=math.pi * 100000 ** 2, lat=40.4, max_cells=CLUSTER_MAX_CELLS)
+        self.assertLess(precision, get_cluster_precision(zoom))
+        check_clusters(result['footprint_clusters'], footprints, precision)
+        self.assertEqual(sum(cluster['count'] for cluster in result['activity_clusters']), 1)
+
+        viewport = {'min_lon': 116.25, 'min_lat': 40.25, 'max_lon': 116.65, 'max_lat': 40.65}
+        result = client.json_get('/api/get_viewport_activities/', dict(viewport, zoom=zoom))
+        check_clusters(result['footprint_clusters'], [
+            footprint for footprint in footprints
+            if viewport['min_lon'] <= float(footprint.lon) <= viewport['max_lon'] and
+            viewport['min_lat'] <= float(footprint.lat) <= viewport['max_lat']], get_cluster_precision(zoom))
+
+        # 放大到街道级别查询大半径时格子数仍然有上限
+        with patch('api.manager.view_manager.CLUSTER_MAX_CELLS', 4):
+            result = client.json_get('/api/get_nearby_activities/', {'lon': 116.4, 'lat': 40.4, 'radius': 100,
+                                                                     'zoom': 18})
+        self.assertLessEqual(len(result['footprint_clusters']), 4)
+        self.assertEqual(sum(cluster['count'] for cluster in result['footprint_clusters']), len(footprints))
+
+        # 参与聚合的只有最近的CLUSTER_MAX_MEMBERS个
+        # 足迹在0.1度的网格上, 距离相同的谁排在前面不确定, 上限取在距离有间隔的位置
+        nearest_footprints = sorted(footprints, key=lambda footprint: _haversine(
+            116.4, 40.4, float(footprint.lon), float(footprint.lat)))
+        distances = [_haversine(116.4, 40.4, float(footprint.lon), float(footprint.lat))
+                     for footprint in nearest_footprints]
+        max_members = next(k for k in range(5, len(distances)) if distances[k] - distances[k - 1] > 1)
+        with patch('api.manager.view_manager.CLUSTER_MAX_MEMBERS', max_members):
+            result = client.json_get('/api/get_nearby_activities/', {'lon': 116.4, 'lat': 40.4, 'radius': 100,
+                                                                     'zoom': zoom})
+        check_clusters(result['footprint_clusters'], nearest_footprints[:max_members], precision)
+
+        for params in ({'zoom': 'abc'}, {'zoom': -1}, {'zoom': 30}, {'radius': 'abc'}, {'radius': 0},
+                       {'lat': 'abc'}, {'lat': 100}, {'radius': 1000, 'zoom': zoom}):
+            result = client.json_get('/api/get_nearby_activities/', dict({'lon': 116.4, 'lat': 40.4}, **params))
+            self.assertEqual(result['error_code'], 1)
+        for zoom in ('abc', 30):
+            result = client.json_get('/api/get_viewport_activities/', dict(viewport, zoom=zoom))
+            self.assertEqual(result['error_code'], 1)
+
+    def test_sharded_user_location(self):
+        """
+        足迹位置按天分桶, 过期的桶不再参与查询
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_sharded_user_location
+        """
+        container = ShardedRedisGeo('test_sharded', DAY_SECONDS, 3)
+        now = time.time()
+        container.add(116, 40, 'today')
+        container.add(116.01, 40, 'yesterday', 116.02, 40, 'yesterday2', timestamp=now - DAY_SECONDS)
+        self.assertEqual(container.add(116, 40.01, 'expired', timestamp=now - 5 * DAY_SECONDS), 0)
+        self.assertTrue(0 < redis.ttl(container.get_bucket_key(now - DAY_SECONDS)) <= 2 * DAY_SECONDS)
+
+        self.assertEqual([member.member for member in container.search(116, 40, 10)],
+                         ['today', 'yesterday', 'yesterday2'])
+        self.assertEqual([member.member for member in container.nearest(116, 40, 2, 10)], ['today', 'yesterday'])
+        # 与redis一样返回geohash格子的中心
+        for actual, expected in zip(container.get_position('yesterday', 'expired')[0], [116.01, 40]):
+            self.assertAlmostEqual(actual, expected, places=5)
+        self.assertIsNone(container.get_position('expired')[0])
+        # 不同桶中的两个地点, 与redis的GEODIST一致
+        distance = container.geo_distance('today', 'yesterday', GeoUnitEnum.M)
+        redis.geoadd('test_geodist', 116, 40, 'today', 116.01, 40, 'yesterday')
+        self.assertAlmostEqual(distance, redis.geodist('test_geodist', 'today', 'yesterday', GeoUnitEnum.M), delta=1)
+        self.assertAlmostEqual(container.geo_distance('today', 'yesterday'), distance / 1000)
+        self.assertIsNone(container.geo_distance('today', 'expired'))
+        container.remove('yesterday')
+        self.assertEqual(container.get_members_within_radius(116, 40, 10, sort=GeoSortEnum.ASC),
+                         ['today', 'yesterday2'])
+
+        # 数据库回源和重建索引只包括保留期内的足迹
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint_ids = sorted(mock.create_footprint(user_info).id for _ in range(3))
+        old_footprint = mock.create_footprint(user_info)
+        Footprint.objects.filter(id=old_footprint.id).update(
+            created_time=datetime.datetime.now() - datetime.timedelta(days=settings.FOOTPRINT_LOCATION_RETENTION_DAYS))
+        redis.flushdb()
+        # 分桶上线前的旧集合, 第一次查询附近时回源数据库并自动重建
+        redis.geoadd(LEGACY_USER_LOCATION_KEY, 116.4, 40.4, old_footprint.id)
+        self.assertEqual(sorted(footprint_id for footprint_id, _, _ in load_nearby_positions(116.4, 40.4, 100)[
+            'footprints']), footprint_ids)
+        self.assertTrue(is_user_location_ready())
+        self.assertFalse(redis.exists(LEGACY_USER_LOCATION_KEY))
+        self.assertEqual(sorted(int(member.member) for member in user_location_container.search(116.4, 40.4, 100)),
+                         footprint_ids)
+        redis.flushdb()
+        call_command('rebuild_user_locations', stdout=open('/dev/null', 'w'))
+        self.assertTrue(is_user_location_ready())
+        self.assertTrue(user_location_container.cache_exists())
+        self.assertEqual(sorted(int(member.member) for member in user_location_container.search(116.4, 40.4, 100)),
+                         footprint_ids)
+
+    def test_per_user_latest_location(self):
+        """
+        per_user模式每个用户只返回最新的一条可见足迹
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_per_user_latest_location
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        other_user_info = mock.create_user_info(create_user_login_client()[1])
+        footprints = [mock.create_footprint(user_info) for _ in range(3)]
+        hidden_footprint = mock.create_footprint(user_info)
+        Footprint.objects.filter(id=hidden_footprint.id).update(hide=True)
+        other_footprint = mock.create_footprint(other_user_info)
+
+        # redis中没有数据时从数据库查找
+        self.assertEqual(sorted(footprint_id for footprint_id, _, _ in load_nearby_positions(
+            116.4, 40.4, 100, per_user=True)['footprints']), [footprints[-1].id, other_footprint.id])
+
+        for footprint in footprints + [other_footprint]:
+            set_user_latest_location(footprint.user_id, footprint.id, footprint.lon, footprint.lat)
+        self.assertEqual(sorted(get_footprint_id(member.member) for member in user_latest_location_container.search(
+            116.4, 40.4, 100)), [footprints[-1].id, other_footprint.id])
+        params = {'lon': 116.4, 'lat': 40.4, 'radius': 100, 'per_user': 1}
+        result = client.json_get('/api/get_nearby_activities/', params)
+        self.assertEqual(sorted(item['footprint_id'] for item in result['footprints']),
+                         [footprints[-1].id, other_footprint.id])
+        result = client.json_get('/api/get_nearby_activities/', dict(params, limit=1))
+        self.assertEqual(len(result['footprints']), 1)
+
+        # 删除最新的足迹后换成上一条可见的足迹, 删除其他足迹不影响
+        footprints[0].delete()
+        footprints[-1].delete()
+        self.assertEqual(sorted(get_footprint_id(member.member) for member in user_latest_location_container.search(
+            116.4, 40.4, 100)), [footprints[1].id, other_footprint.id])
+        self.assertNotIn(footprints[-1].id, [int(member.member) for member in user_location_container.search(
+            116.4, 40.4, 100)])
+
+        redis.flushdb()
+        call_command('rebuild_user_locations', stdout=open('/dev/null', 'w'))
+        self.assertEqual(sorted(get_footprint_id(member.member) for member in user_latest_location_container.search(
+            116.4, 40.4, 100)), [footprints[1].id, other_footprint.id])
+
+    def test_latest_location_race(self):
+        """
+        同一个用户同时更新最新位置, 另一次写入发生在读旧位置之后时重试, 只留下一个标记
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_latest_location_race
+        """
+        user_info = mock.create_user_info(create_user_login_client()[1])
+        footprints = [mock.create_footprint(user_info) for _ in range(3)]
+        set_user_latest_location(user_info.user_id, footprints[0].id, footprints[0].lon, footprints[0].lat)
+
+        remove = user_latest_location_container.remove
+        concurrent_writes = []
+
+        def remove_after_concurrent_write(*members, **kwargs):
+            # 第一次在MULTI中排队删除旧位置时, 另一个请求已经把旧位置换成了footprints[1]
+            if not concurrent_writes:
+                concurrent_writes.append(members)
+                set_user_latest_location(user_info.user_id, footprints[1].id, footprints[1].lon, footprints[1].lat)
+            return remove(*members, **kwargs)
+
+        with patch.object(user_latest_location_container, 'remove', side_effect=remove_after_concurrent_write):
+            set_user_latest_location(user_info.user_id, footprints[2].id, footprints[2].lon, footprints[2].lat)
+        self.assertEqual(len(concurrent_writes), 1)
+        self.assertEqual([get_footprint_id(member.member) for member in user_latest_location_container.search(
+            116.4, 40.4, 100)], [footprints[2].id])
+
+    def test_fake_geo_engine(self):
+        """
+        测试用的fake redis的geo命令: 结果与逐个计算距离一致, 大数据量下的耗时见api.testing.benchmark_fake_geo
+        python manage.py test --settings=settings-test api.testing.test_nearby_activities.TestNearby.test_fake_geo_engine
+        """
+        redis.geoadd('test_geo', 13.361389, 38.115556, 'Palermo', 15.087269, 37.502669, 'Catania')
+        # redis文档中的例子
+        self.assertEqual(redis.zscore('test_geo', 'Palermo'), 3479099956230698)
+        self.assertEqual(redis.geodist('test_geo', 'Palermo', 'Catania'), 166274.1516)
+        self.assertEqual(redis.geohash('test_geo', 'Palermo', 'Catania', 'none'), ['sqc8b49rny0', 'sqdtr74hyu0', None])
+        self.assertEqual(redis.georadius('test_geo', 15, 37, 200, 'km', withdist=True, withhash=True, sort='DESC'),
+                         [[b'Palermo', 190.4424, 3479099956230698], [b'Catania', 56.4413, 3479447370796909]])
+        self.assertEqual(redis.georadius('test_geo', 15, 37, 200, 'km', count=1), [b'Catania'])
+        self.assertEqual(redis.zrem('test_geo', 'Palermo'), 1)
+        self.assertEqual(redis.geopos('test_geo', 'Palermo'), [None])
 
+        size = 500
+        random.seed(size)
+        places = [(random.uniform(115, 118), random.uniform(39, 41), str(index)) for index in range(size)]
+        redis.geoadd('test_geo_large', *[value for place in places for value in place])
+        lons, lats = np.array(redis.geopos('test_geo_large', *[place[2] for place in places])).T
+        for _ in range(50):
+            lon, lat, radius = random.uniform(115, 118), random.uniform(39, 41), random.choice([3, 20, 50])
+            result = redis.georadius('test_geo_large', lon, lat, radius, 'km', withdist=True, sort='ASC')
+            expected = np.nonzero(_haversine(lon, lat, lons, lats) <= radius * 1000)[0]
+            self.assertEqual(sorted(int(member) for member, _ in result), expected.tolist())
+            self.assertEqual([distance for _, distance in result], sorted(distance for _, distance in result))
@@ -1,11 +1,16 @@
 from django.urls import path
 
-from api.view import get_nearby_activities_view, discovery_view, get_nearest_activity_view, get_upload_token_view
+from api.view import get_nearby_activities_view, discovery_view, get_nearest_activity_view, get_upload_token_view, \
+    cache_stats_view, get_viewport_activities_view
 
 urlpatterns = [
     # 附近活动
     path('get_nearby_activities/', get_nearby_activities_view),
+    # 地图可视区域内的活动
+    path('get_viewport_activities/', get_viewport_activities_view),
     path('discovery/', discovery_view),
     path('get_nearest_activity/', get_nearest_activity_view),
     path('get_upload_token/', get_upload_token_view),
+    # 缓存命中率
+    path('cache_stats/', cache_stats_view),
 ]
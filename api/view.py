@@ -1,15 +1,27 @@
 import qiniu
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_GET, require_POST
 
 from api.manager.positon_manager import activity_location_container
-from api.manager.view_manager import get_nearby_activity, build_flows_detail
-from footprint.manager.footprint_manager import get_flows_db
-from redis_utils.container.consts import GeoUnitEnum, GeoSortEnum
-from utilities.request_utils import get_page_range
+from api.manager.view_manager import get_nearby_activity, build_flows_detail, get_viewport_activity, \
+    get_nearby_clusters, get_viewport_clusters
+from footprint.manager.footprint_manager import get_discovery_flows, get_discovery_flows_by_cursor
+from redis_utils.container.api_redis_container import CacheHitCounter
+from redis_utils.container.consts import GeoUnitEnum
+from utilities.request_utils import get_page_range, decode_cursor, PAGE_SIZE
 from utilities.response import json_http_response, json_http_success, json_http_error
 from utilities.upload_utils import get_upload_token
 
+VIEWPORT_DEFAULT_LIMIT = 100
+VIEWPORT_MAX_LIMIT = 300
+NEARBY_MAX_LIMIT = 300
+NEARBY_DEFAULT_RADIUS = 7
+# 聚合模式的最大半径, 单位km
+NEARBY_MAX_RADIUS = 100
+# web墨卡托的最大缩放级别, 0表示不聚合
+MAP_MAX_ZOOM = 22
+
 
 def hello_view(request):
     """
@@ -18,10 +30,18 @@ def hello_view(request):
     return json_http_response('welcome to zongzong! ')
 
 
+def _is_valid_position(lon, lat):
+    return -180 <= lon <= 180 and -90 <= lat <= 90
+
+
 @require_GET
 def get_nearby_activities_view(request):
     """
     URL[GET]: /api/get_nearby_activities/
+    :param request: lon, lat, radius(km, 聚合模式下最大NEARBY_MAX_RADIUS, 超过时返回参数错误),
+                    limit(可选, 足迹和活动各只返回最近的limit个, 最多NEARBY_MAX_LIMIT),
+                    zoom(可选, 地图缩放级别1~MAP_MAX_ZOOM, 传了则返回按格子聚合的结果),
+                    per_user(可选, 为1时每个用户只返回最新的一条可见足迹)
     :return: {
         user_locations: [
             {user_id, name, avatar, time, lat, lon}
@@ -30,13 +50,51 @@ def get_nearby_activities_view(request):
             {activity_id, name, avatar, description, quota}
         ]
     }
+    聚合模式: {footprint_clusters: [{geohash, count, lon, lat, sample_ids}], activity_clusters: [...]}
     """
-    lon = request.GET.get('lon')
-    lat = request.GET.get('lat')
-    radius = request.GET.get('radius', 7)
-    if not lon or not lat:
+    if not request.GET.get('lon') or not request.GET.get('lat'):
         return json_http_error('必须传经纬度')
-    result = get_nearby_activity(float(lon), float(lat), float(radius))
+    try:
+        lon, lat = float(request.GET['lon']), float(request.GET['lat'])
+        radius = float(request.GET.get('radius', NEARBY_DEFAULT_RADIUS))
+        limit = int(request.GET.get('limit', 0))
+        zoom = int(request.GET.get('zoom') or 0)
+    except ValueError:
+        return json_http_error('参数错误')
+    if not _is_valid_position(lon, lat) or not radius > 0 or limit < 0 or not 0 <= zoom <= MAP_MAX_ZOOM:
+        return json_http_error('参数错误')
+    per_user = request.GET.get('per_user') == '1'
+    if zoom:
+        if radius > NEARBY_MAX_RADIUS:
+            return json_http_error('参数错误')
+        return json_http_success(get_nearby_clusters(lon, lat, radius, zoom))
+    result = get_nearby_activity(lon, lat, radius, min(limit, NEARBY_MAX_LIMIT), per_user)
+    return json_http_success(result)
+
+
+@require_GET
+def get_viewport_activities_view(request):
+    """
+    URL[GET]: /api/get_viewport_activities/
+    地图可视区域内的足迹和活动
+    :param request: min_lon, min_lat, max_lon, max_lat: 可视区域的西南角和东北角,
+                    limit(可选, 默认100): 足迹和活动各最多返回离区域中心最近的limit个,
+                    zoom(可选, 地图缩放级别1~MAP_MAX_ZOOM, 传了则返回按格子聚合的结果)
+    :return: 同get_nearby_activities
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = [float(request.GET[name])
+                                              for name in ('min_lon', 'min_lat', 'max_lon', 'max_lat')]
+        limit = int(request.GET.get('limit', VIEWPORT_DEFAULT_LIMIT))
+        zoom = int(request.GET.get('zoom') or 0)
+    except (KeyError, ValueError):
+        return json_http_error('参数错误')
+    if min_lon >= max_lon or min_lat >= max_lat or limit < 1 or not 0 <= zoom <= MAP_MAX_ZOOM or \
+            not _is_valid_position(min_lon, min_lat) or not _is_valid_position(max_lon, max_lat):
+        return json_http_error('参数错误')
+    if zoom:
+        return json_http_success(get_viewport_clusters(min_lon, min_lat, max_lon, max_lat, zoom))
+    result = get_viewport_activity(min_lon, min_lat, max_lon, max_lat, min(limit, VIEWPORT_MAX_LIMIT))
     return json_http_success(result)
 
 
@@ -45,16 +103,25 @@ def discovery_view(request):
     """
     URL[GET]: /api/discovery/
     获取本市的所有活动，包括商家活动和足迹
-    :param request: page
+    :param request: page 或 cursor(游标翻页，第一页传空串，之后传上一页返回的next_cursor)
     :return: {
         items: [{flow_id, flow_type, avatar, name, distance, location, post_time, content, image_list}, ...]
+        next_cursor, has_more: 游标翻页时返回
     }
     """
-    page = int(request.GET.get('page', 1))
     lat = float(request.GET.get('lat', 0))
     lon = float(request.GET.get('lon', 0))
+    if 'cursor' in request.GET:
+        try:
+            cursor = decode_cursor(request.GET['cursor'])
+        except ValueError:
+            return json_http_error('参数错误')
+        flows, next_cursor, has_more = get_discovery_flows_by_cursor(cursor, PAGE_SIZE)
+        result = build_flows_detail(flows, request.user.id, lon, lat)
+        return json_http_success({'items': result, 'next_cursor': next_cursor, 'has_more': has_more})
+    page = int(request.GET.get('page', 1))
     start_num, end_num = get_page_range(page)
-    flows = get_flows_db(start_num, end_num)
+    flows = get_discovery_flows(start_num, end_num)
     result = build_flows_detail(flows, request.user.id, lon, lat)
     return json_http_success({'items': result})
 
@@ -63,18 +130,25 @@ def discovery_view(request):
 def get_nearest_activity_view(request):
     """
     获取最近的活动的地址，100km以内吧
-    :param request:
-    :return: {'lat', 'lon'}
+    :param request: lat, lon, limit(可选, 默认1)
+    :return: {'lat', 'lon', 'items': [{activity_id, lat, lon, distance}]}, lat、lon为最近的一个
     """
-    lat = float(request.GET.get('lat', 0))
-    lon = float(request.GET.get('lon', 0))
-    if not (lat and lon):
+    try:
+        lat = float(request.GET.get('lat', 0))
+        lon = float(request.GET.get('lon', 0))
+        limit = min(int(request.GET.get('limit', 1)), PAGE_SIZE)
+    except ValueError:
         return json_http_error('参数错误')
-    members = activity_location_container.get_members_within_radius(lon, lat, 100, GeoUnitEnum.KM, sort=GeoSortEnum.ASC)
+    if not (lat and lon) or not _is_valid_position(lon, lat) or limit < 1:
+        return json_http_error('参数错误')
+    members = activity_location_container.nearest(lon, lat, limit, 100, GeoUnitEnum.KM)
     if not members:
         return json_http_success()
-    location = activity_location_container.get_position(members[0])[0]
-    return json_http_success({'lat': location[1], 'lon': location[0]})
+    return json_http_success({
+        'lat': members[0].lat, 'lon': members[0].lon,
+        'items': [{'activity_id': int(member.member), 'lat': member.lat, 'lon': member.lon,
+                   'distance': member.distance} for member in members],
+    })
 
 
 @login_required
@@ -85,3 +159,14 @@ def get_upload_token_view(request):
     :return:
     """
     return json_http_success({'token': get_upload_token()})
+
+
+@staff_member_required
+@require_GET
+def cache_stats_view(request):
+    """
+    URL[GET]: /api/cache_stats/
+    各缓存的命中率, 仅staff可见
+    :return: {cache_name: {hit, miss, hit_ratio}}
+    """
+    return json_http_success(CacheHitCounter.all_stats())
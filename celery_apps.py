@@ -1,2 +1,34 @@
+"""
+celery应用
+worker: celery -A celery_apps worker -l info
+定时任务: celery -A celery_apps beat -l info (只能启动一个beat)
+"""
+import os
 
 from celery import Celery
+from django.conf import settings
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+app = Celery('zongzong')
+app.config_from_object('django.conf:settings')
+app.autodiscover_tasks()
+
+app.conf.beat_schedule = {
+    'flush-flow-counters': {
+        'task': 'footprint.tasks.flush_flow_counters_task',
+        'schedule': settings.COUNTER_FLUSH_INTERVAL,
+    },
+    'refresh-wx-access-token': {
+        'task': 'weixin.tasks.refresh_access_token_task',
+        'schedule': settings.WX_ACCESS_TOKEN_CHECK_INTERVAL,
+    },
+    'requeue-pending-moderation': {
+        'task': 'footprint.tasks.requeue_pending_moderation_task',
+        'schedule': settings.MODERATION_REQUEUE_INTERVAL,
+    },
+    'requeue-pending-chat-records': {
+        'task': 'chat.tasks.requeue_pending_chat_records_task',
+        'schedule': settings.MODERATION_REQUEUE_INTERVAL,
+    },
+}
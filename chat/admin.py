@@ -9,4 +9,4 @@ from chat.models import ChatRecord
 @admin.register(ChatRecord)
 class UserBaseInfoAdmin(VersionAdmin):
 
-    list_display = ['content', 'is_delete']
+    list_display = ['content', 'is_delete', 'audit_status']
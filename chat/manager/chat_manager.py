@@ -1,11 +1,25 @@
+"""
+私信
+
+增量获取(get_new)按消息的发布序号seq分页, 不按自增id: 异步审核时消息通过的顺序与创建顺序不同,
+对方的消息还在审核中时客户端的msg_id已经越过了它, 之后才通过的消息id比游标小, 按id增量获取永远拿不到.
+seq在消息对会话的读者可见性变化时(创建、审核通过/不通过)分配, 分配时锁住会话直到事务提交,
+所以同一会话内seq的顺序就是提交顺序, 读到seq为n的消息时seq更小的消息都已经提交.
+客户端保存收到的最大seq(返回值中的seq), get_new时带上; 审核结果变化的消息会以新的seq再返回一次, 按msg_id去重
+"""
 import hashlib
 import json
 
+from django.db import transaction
 from django.db.models import Q
 
+from chat.manager.message_manager import ConversationMessageManager
 from chat.models import ChatRecord, ChatConversationInfo
-from user_info.manager.user_info_mananger import get_user_info_by_user_id_db
+from footprint.consts import AuditStatus
+from user_info.manager.profile_manager import load_profiles
+from utilities.content_check import get_content_verdict
 from utilities.date_time import datetime_to_str, FORMAT_DATETIME
+from utilities.image_check import get_images_verdict
 
 
 def get_conversation_id_by_user_ids(user_id_list):
@@ -15,7 +29,17 @@ def get_conversation_id_by_user_ids(user_id_list):
     return hashlib.md5(peer_str.encode('utf-8')).hexdigest()
 
 
-def create_chat_record_db(conversation_id, content_json, send_id):
+def _next_seq_db(conversation_id):
+    """
+    分配会话内的下一个发布序号, 需要在事务中调用, 会话行锁到事务提交
+    """
+    conversation_info = ChatConversationInfo.objects.select_for_update().get(conversation_id=conversation_id)
+    conversation_info.last_seq += 1
+    conversation_info.save(update_fields=['last_seq'])
+    return conversation_info.last_seq
+
+
+def create_chat_record_db(conversation_id, content_json, send_id, audit_status=AuditStatus.PASSED):
     """
     创建聊天记录
     :param conversation_id:
@@ -25,12 +49,75 @@ def create_chat_record_db(conversation_id, content_json, send_id):
     {"type": "audio", "url":"[音频]audio/2011/09/06/da56b46bf19b.png", "duration": 1200《单位为毫秒》},
     :param content:
     :param send_id: 发送者的user_id
+    :param audit_status: 待审核的消息只有发送者能看到
     :return:
     """
-    record = ChatRecord.objects.create(conversation_id=conversation_id, addresser_id=send_id, content=content_json)
+    with transaction.atomic():
+        record = ChatRecord.objects.create(conversation_id=conversation_id, addresser_id=send_id,
+                                           content=content_json, audit_status=audit_status,
+                                           seq=_next_seq_db(conversation_id))
     return record
 
 
+def get_chat_content_verdict(content):
+    """
+    文本和图片消息需要审核
+    :return: True/False, 检测接口出错时返回None
+    """
+    if content['type'] == 'image':
+        return get_images_verdict([content['url']])
+    if content['type'] == 'text':
+        return get_content_verdict(content['text'])
+    return True
+
+
+def is_chat_content_valid(content):
+    """
+    检测接口出错时按不合规处理
+    """
+    return bool(get_chat_content_verdict(content))
+
+
+def moderate_chat_record(record_id, receiver_id):
+    """
+    异步审核私信, 通过后更新双方的会话列表, @see footprint.manager.moderation_manager
+    :return: 审核结果, 检测接口出错时为AuditStatus.PENDING(需要重试), 不需要审核时返回None
+    """
+    record = ChatRecord.objects.filter(id=record_id, audit_status=AuditStatus.PENDING).first()
+    if record is None:
+        return None
+    content = json.loads(record.content)
+    verdict = get_chat_content_verdict(content)
+    if verdict is None:
+        return AuditStatus.PENDING
+    audit_status = AuditStatus.PASSED if verdict else AuditStatus.REJECTED
+    with transaction.atomic():
+        # 审核结果变化后重新分配seq, 对方和发送者都能通过get_new拿到
+        if not ChatRecord.objects.filter(id=record_id, audit_status=AuditStatus.PENDING).update(
+                audit_status=audit_status, seq=_next_seq_db(record.conversation_id)):
+            return None
+    if audit_status == AuditStatus.PASSED:
+        ConversationMessageManager.add_message(receiver_id, record.addresser_id, record.conversation_id, content)
+    return audit_status
+
+
+def get_stale_pending_records_db(record_ids):
+    """
+    需要重新审核的私信
+    :return: [(record_id, receiver_id)]
+    """
+    records = list(ChatRecord.objects.filter(id__in=record_ids).only('id', 'addresser_id', 'conversation_id'))
+    conversation_2_users = {info.conversation_id: (info.user_1_id, info.user_2_id) for info in
+                            ChatConversationInfo.objects.filter(
+                                conversation_id__in={record.conversation_id for record in records})}
+    result = []
+    for record in records:
+        user_ids = conversation_2_users.get(record.conversation_id)
+        if user_ids:
+            result.append((record.id, user_ids[1] if user_ids[0] == record.addresser_id else user_ids[0]))
+    return result
+
+
 def get_conversation_info_by_conversation_id(conversation_id):
     try:
         return ChatConversationInfo.objects.get(conversation_id=conversation_id)
@@ -52,22 +139,24 @@ def get_or_create_conversation_info(conversation_id, send_id, receiver_id):
                                                       defaults={'user_1_id': user_ids[0], 'user_2_id': user_ids[1]})
 
 
-def build_conversation_list(user_id, conversation_id, conversation_info, msg_id, get_new):
+def build_conversation_list(user_id, conversation_id, conversation_info, msg_id, get_new, seq=None):
     """
 
     :param user_id:
     :param conversation_id:
-    :param start:
-    :param end:
-    :return:
+    :param msg_id: 向前翻页的游标
+    :param get_new: 为真时获取seq之后发布的消息
+    :param seq: 客户端收到的最大seq, 没有时按msg_id增量获取(旧版客户端, 异步审核时可能漏掉消息)
+    :return: {content_list, seq, ...}, seq为客户端目前应保存的最大发布序号
     """
-    my_info = get_user_info_by_user_id_db(user_id)
     receiver_id = conversation_info.user_1_id if conversation_info.user_1_id != user_id else conversation_info.user_2_id
-    receiver_info = get_user_info_by_user_id_db(receiver_id)
-    query = Q(conversation_id=conversation_id)
+    profiles = load_profiles([user_id, receiver_id])
+    my_info, receiver_info = profiles[int(user_id)], profiles[int(receiver_id)]
+    # 自己待审核和未通过的消息只有自己能看到
+    query = Q(conversation_id=conversation_id) & (Q(audit_status=AuditStatus.PASSED) | Q(addresser_id=user_id))
     result = {}
     if get_new:
-        query &= Q(id__gt=msg_id)
+        query &= Q(seq__gt=seq) if seq is not None else Q(id__gt=msg_id)
         chat_record = ChatRecord.objects.filter(query).order_by('-created_time')
     else:
         if msg_id:
@@ -78,7 +167,9 @@ def build_conversation_list(user_id, conversation_id, conversation_info, msg_id,
     result.update({
         'content_list': [{'content': json.loads(chat.content), 'is_me': user_id == chat.addresser_id,
                           'created_time': datetime_to_str(chat.created_time, FORMAT_DATETIME),
-                          'msg_id': chat.id} for chat in chat_record]
+                          'msg_id': chat.id, 'audit_status': chat.audit_status, 'seq': chat.seq}
+                         for chat in chat_record],
+        'seq': max([chat.seq for chat in chat_record] + [seq or 0]),
     })
     result.update({'my_info': {'user_id': user_id, 'avatar': my_info.avatar},
                    'receiver_info': {'user_id': receiver_id, 'avatar': receiver_info.avatar}})
@@ -1,7 +1,7 @@
 import datetime
 
 from redis_utils.container.api_redis_client import redis
-from user_info.manager.user_info_mananger import get_user_info_by_user_id_db
+from user_info.manager.profile_manager import get_profile
 from utilities.date_time import datetime_to_str, FORMAT_DATETIME
 
 
@@ -27,7 +27,7 @@ class ConversationMessageManager(object):
         :param content:
         :return:
         """
-        user_info = get_user_info_by_user_id_db(to_user_id)
+        user_info = get_profile(to_user_id)
         message = {
             'conversation_id': conversation_id, 'avatar': user_info.avatar, 'last_message': content, 'has_new': 1,
             'time': datetime_to_str(datetime.datetime.now(), FORMAT_DATETIME), 'username': user_info.nickname
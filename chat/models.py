@@ -4,6 +4,8 @@ import time
 
 from django.db import models
 
+from footprint.consts import AuditStatus
+
 
 class ChatRecord(models.Model):
     """
@@ -26,6 +28,8 @@ class ChatRecord(models.Model):
 
     content = models.TextField(default='{}', help_text='对话内容, json串')
     is_delete = models.BooleanField(default=False, help_text='辅助用户删除功能')
+    audit_status = models.SmallIntegerField(choices=AuditStatus, default=AuditStatus.PASSED, help_text='审核状态')
+    seq = models.PositiveIntegerField(default=0, help_text='会话内的发布序号, 审核结果变化时重新分配, get_new按它增量获取')
 
     created_time = models.DateTimeField(auto_now_add=True, db_index=True)
     last_modified = models.DateTimeField(auto_now=True)
@@ -64,6 +68,7 @@ class ChatRecord(models.Model):
     class Meta:
         verbose_name = u'聊天记录'
         verbose_name_plural = u'聊天记录'
+        index_together = ('conversation_id', 'seq')
 
 
 class ChatConversationInfo(models.Model):
@@ -73,6 +78,7 @@ class ChatConversationInfo(models.Model):
     conversation_id = models.CharField(max_length=100, unique=True)
     user_1_id = models.IntegerField(default=0, help_text="用户1id")
     user_2_id = models.IntegerField(default=0, help_text="用户2id")
+    last_seq = models.PositiveIntegerField(default=0, help_text="最近分配的消息发布序号")
 
     created_time = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
@@ -0,0 +1,24 @@
+from celery_apps import app
+from chat.manager.chat_manager import moderate_chat_record, get_stale_pending_records_db
+from chat.models import ChatRecord
+from footprint.manager.moderation_manager import run_moderation_task, get_stale_pending_ids_db
+
+
+@app.task(bind=True)
+def moderate_chat_record_task(self, record_id, receiver_id):
+    """
+    异步审核私信, 检测接口出错时重试
+    """
+    return run_moderation_task(self, moderate_chat_record, record_id, receiver_id)
+
+
+@app.task
+def requeue_pending_chat_records_task():
+    """
+    定时重新投递长时间仍在审核中的私信, 周期见settings.MODERATION_REQUEUE_INTERVAL
+    :return: 重新投递的数量
+    """
+    records = get_stale_pending_records_db(get_stale_pending_ids_db(ChatRecord))
+    for record_id, receiver_id in records:
+        moderate_chat_record_task.delay(record_id, receiver_id)
+    return len(records)
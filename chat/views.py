@@ -5,10 +5,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 
 from chat.manager.chat_manager import get_conversation_id_by_user_ids, create_chat_record_db, build_conversation_list, \
-    get_or_create_conversation_info, get_conversation_info_by_conversation_id
+    get_or_create_conversation_info, get_conversation_info_by_conversation_id, is_chat_content_valid
 from chat.manager.message_manager import ConversationMessageManager
-from utilities.content_check import is_content_valid
-from utilities.image_check import is_image_valid
+from chat.tasks import moderate_chat_record_task
+from footprint.consts import AuditStatus
+from utilities.content_check import is_async_moderation_enabled
 from utilities.request_utils import get_data_from_request
 from utilities.response import json_http_success, json_http_error
 
@@ -43,6 +44,7 @@ def post_content_view(request):
     发送信息
     URL[POST]: /chat/post_content/
     :param request: conversation_id， content_type， content
+    :return: {msg_id, audit_status}, 异步审核时audit_status为审核中
     """
     data = get_data_from_request(request)
     receiver_id = int(data.get('receiver_id'))
@@ -51,17 +53,19 @@ def post_content_view(request):
         return json_http_error('参数错误')
     conversation_id = conversation_id or get_conversation_id_by_user_ids([receiver_id, request.user.id])
     content = data['content_json']
-    if content['type'] == 'image':
-        if not is_image_valid(content['url']):
-            return json_http_error('请文明发言！')
-    elif content['type'] == 'text':
-        if not is_content_valid(content['text']):
-            return json_http_error('请文明发言！')
     content_str = json.dumps(content)
+    # 分配消息的发布序号; 审核任务需要重新投递时由会话找到接收者
+    get_or_create_conversation_info(conversation_id, request.user.id, receiver_id)
+    if is_async_moderation_enabled():
+        chat_record = create_chat_record_db(conversation_id, content_str, request.user.id, AuditStatus.PENDING)
+        moderate_chat_record_task.delay(chat_record.id, receiver_id)
+        return json_http_success({'msg_id': chat_record.id, 'audit_status': chat_record.audit_status})
+    if not is_chat_content_valid(content):
+        return json_http_error('请文明发言！')
     chat_record = create_chat_record_db(conversation_id, content_str, request.user.id)
     # 发推送、更新badge、
     ConversationMessageManager.add_message(receiver_id, request.user.id, conversation_id, content)
-    return json_http_success()
+    return json_http_success({'msg_id': chat_record.id, 'audit_status': chat_record.audit_status})
 
 
 @require_GET
@@ -69,13 +73,15 @@ def post_content_view(request):
 def get_conversation_detail_view(request):
     """
     获取聊天详情
-    :param request:
-    :return:
+    :param request: msg_id向前翻页, get_new=1时获取seq之后发布的消息
+    :return: {content_list, seq, ...}, 客户端保存最大的seq, 下次get_new时带上
     """
     conversation_id = request.GET.get('conversation_id')
     receiver_id = request.GET.get('receiver_id')
     msg_id = int(request.GET.get('msg_id', 0))
     get_new = int(request.GET.get('get_new', 0))
+    seq = request.GET.get('seq')
+    seq = int(seq) if seq is not None else None
     if conversation_id:
         conversation_info = get_conversation_info_by_conversation_id(conversation_id)
     elif receiver_id:
@@ -83,5 +89,5 @@ def get_conversation_detail_view(request):
         conversation_info, _ = get_or_create_conversation_info(conversation_id, request.user.id, int(receiver_id))
     else:
         return json_http_error('参数错误')
-    result = build_conversation_list(request.user.id, conversation_id, conversation_info, msg_id, get_new)
+    result = build_conversation_list(request.user.id, conversation_id, conversation_info, msg_id, get_new, seq)
     return json_http_success(result)
@@ -1,9 +1,14 @@
-from geopy.distance import geodesic
+from django.db import transaction
 
-from commercial.manager.db_manager import get_commercial_activity_by_id_db, create_activity_participate_record_db
+from commercial.manager.db_manager import create_activity_participate_record_db, \
+    incr_participant_num_within_quota_db, get_activity_participant_user_ids_db
 from commercial.models import CommercialActivity, ActivityParticipant
-from footprint.manager.footprint_manager import is_user_favored
+from footprint.manager.flow_card_manager import invalidate_flow_cards
+from footprint.manager.flow_counter_manager import apply_pending_deltas, get_pending_deltas, is_write_behind_enabled
+from footprint.manager.favor_manager import is_user_favored, get_favored_flows
 from footprint.models import FlowType
+from user_info.manager.profile_manager import load_profiles
+from utilities.geo import distances_from
 from utilities.time_utils import get_time_show
 
 
@@ -40,9 +45,19 @@ def get_activity_participants(activity_id):
     return ActivityParticipant.objects.filter(activity_id=activity_id)
 
 
+def build_activity_participants(activity_id):
+    """
+    报名者列表, 一次查询取出报名者的user_id, 资料批量从缓存获取
+    :return: [{user_id, avatar}]
+    """
+    user_ids = get_activity_participant_user_ids_db(activity_id)
+    profiles = load_profiles(user_ids)
+    return [{'user_id': user_id, 'avatar': profiles[user_id].avatar} for user_id in user_ids]
+
+
 def build_activity_detail(activity, user_id):
     """
-    构建活动详情页信息
+    构建活动详情页信息, activity需要select_related('club'), @see get_commercial_activity_by_id_db
             top_image,
         title,
         club_name,
@@ -74,26 +89,24 @@ def build_activity_detail(activity, user_id):
         'favored': is_user_favored(user_id, activity.id, FlowType.ACTIVITY),
         'favor_num': activity.favor_num,
     }
-    participants = get_activity_participants(activity.id)
-    result.update({'participants': [{'user_id': item.user_info.user_id, 'avatar': item.user_info.avatar}
-                                    for item in participants]})
+    result.update({'participants': build_activity_participants(activity.id)})
     return result
 
 
 def participate_activity(activity_id, user_info_id, name, cellphone, num, hint):
-    activity = get_commercial_activity_by_id_db(activity_id)
-    if activity.participant_num >= activity.total_quota:
-        return '人数已满'
-    record, created = create_activity_participate_record_db(activity_id, user_info_id, name, cellphone, num, hint)
-    if not created:
-        return u'请勿重复报名'
-    activity.participant_num += 1
-    activity.save()
+    with transaction.atomic():
+        if not incr_participant_num_within_quota_db(activity_id):
+            return '人数已满'
+        record, created = create_activity_participate_record_db(activity_id, user_info_id, name, cellphone, num, hint)
+        if not created:
+            # 重复报名, 回滚刚才占用的名额
+            transaction.set_rollback(True)
+            return u'请勿重复报名'
+    invalidate_flow_cards((activity_id, FlowType.ACTIVITY))
     return ''
 
 
-def build_activity_brief_info(activity, user_id, lon, lat):
-    distance = geodesic((activity.lat, activity.lon), (lat, lon)).meters if lat and lon else 0
+def build_activity_brief_info(activity, favored, distance):
     return {
         'time_detail': activity.time_detail,
         'post_time': get_time_show(activity.created_time),
@@ -101,6 +114,24 @@ def build_activity_brief_info(activity, user_id, lon, lat):
         'image_list': activity.image_list,
         'distance': distance,
         'activity_id': activity.id,
-        'favored': is_user_favored(user_id, activity.id, FlowType.ACTIVITY),
+        'favored': favored,
         'favor_num': activity.favor_num
-    }
\ No newline at end of file
+    }
+
+
+def build_activity_brief_list(activities, user_id, lon, lat):
+    """
+    构建活动列表，点赞状态一次查询，距离一次向量化计算
+    """
+    activities = list(activities)
+    flow_pairs = [(activity.id, FlowType.ACTIVITY) for activity in activities]
+    favored_flows = get_favored_flows(user_id, flow_pairs)
+    distances = distances_from(lat, lon, [(activity.lat, activity.lon) for activity in activities]) \
+        if lat and lon else [0] * len(activities)
+    result = [build_activity_brief_info(activity, (activity.id, FlowType.ACTIVITY) in favored_flows, distance)
+              for activity, distance in zip(activities, distances)]
+    if is_write_behind_enabled():
+        pair_2_deltas = get_pending_deltas(flow_pairs)
+        for flow_pair, info in zip(flow_pairs, result):
+            apply_pending_deltas(info, pair_2_deltas.get(flow_pair, {}))
+    return result
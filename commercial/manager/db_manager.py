@@ -1,19 +1,65 @@
+from django.db.models import F
+
 from commercial.models import CommercialActivity, Club, ActivityParticipant
+from utilities.projection import ProjectedRow
+from utilities.request_utils import get_page_by_cursor
+
+
+# 活动列表(build_activity_brief_list)用到的列, 不取detail等大字段
+ACTIVITY_BRIEF_COLUMNS = ('id', 'name', 'time_detail', 'created_time', 'image_list', 'favor_num', 'lat', 'lon')
 
 
 def get_commercial_activity_by_id_db(activity_id):
+    """
+    俱乐部在同一条查询中取出, 详情页使用activity.club不再查询
+    """
     try:
-        return CommercialActivity.objects.get(id=activity_id)
+        return CommercialActivity.objects.select_related('club').get(id=activity_id)
     except CommercialActivity.DoesNotExist:
         return None
 
 
+def get_activity_participant_user_ids_db(activity_id):
+    """
+    报名者的user_id, join UserBaseInfo一次查出, 资料用profile_manager.load_profiles批量获取
+    """
+    return list(ActivityParticipant.objects.filter(activity_id=activity_id).values_list('user_info__user_id',
+                                                                                         flat=True))
+
+
+class ActivityRow(ProjectedRow):
+    """
+    活动卡片用到的列, 不包含detail、top_image; 俱乐部的名称和头像在同一条查询中join取出
+    """
+    COLUMNS = ('id', 'name', 'description', 'participant_num', 'total_quota', 'address', 'time_detail',
+               'created_time', 'introduction', 'image_list', 'favor_num', 'lat', 'lon', 'club_id', 'club__name',
+               'club__avatar')
+    __slots__ = ProjectedRow.get_attrs(COLUMNS)
+
+    @property
+    def club_avatar_url(self):
+        return Club._meta.get_field('avatar').storage.url(self.club_avatar) if self.club_avatar else ''
+
+
 def get_commercial_activities_by_ids_db(ids):
-    return CommercialActivity.objects.filter(id__in=ids)
+    """
+    :return: [ActivityRow]
+    """
+    return ActivityRow.project(CommercialActivity.objects.filter(id__in=ids))
 
 
 def get_commercial_activities_by_club_id_db(club_id, start, end):
-    return CommercialActivity.objects.filter(club_id=club_id).order_by('-created_time')[start: end]
+    return CommercialActivity.objects.filter(club_id=club_id).only(*ACTIVITY_BRIEF_COLUMNS).order_by(
+        '-created_time')[start: end]
+
+
+def get_commercial_activities_by_club_id_cursor_db(club_id, cursor, count):
+    """
+    游标方式获取俱乐部的活动
+    :return: activities, next_cursor, has_more
+    """
+    return get_page_by_cursor(CommercialActivity.objects.filter(club_id=club_id).only(*ACTIVITY_BRIEF_COLUMNS),
+                              cursor, count)
 
 
 def get_club_by_id_db(club_id):
@@ -27,3 +73,12 @@ def create_activity_participate_record_db(activity_id, user_info_id, name, cellp
     return ActivityParticipant.objects.get_or_create(activity_id=activity_id, user_info_id=user_info_id, defaults={
         'name': name, 'cellphone': cellphone, 'num': num, 'hint': hint
     })
+
+
+def incr_participant_num_within_quota_db(activity_id):
+    """
+    名额未满时报名人数+1, 判断和更新在同一条UPDATE中完成, 并发报名不会超额
+    :return: 是否更新成功
+    """
+    return bool(CommercialActivity.objects.filter(id=activity_id, participant_num__lt=F('total_quota'))
+                .update(participant_num=F('participant_num') + 1))
@@ -2,6 +2,7 @@ from django.db import models
 from django.db.models import ForeignKey
 
 from user_info.models import UserBaseInfo
+from utilities.geo import encode_geohash
 
 
 class Club(models.Model):
@@ -22,9 +23,25 @@ class Club(models.Model):
     telephone = models.CharField(max_length=15, verbose_name='电话')
     lat = models.FloatField(verbose_name='维度')
     lon = models.FloatField(verbose_name='经度')
+    # 由lat/lon在save时生成, 用于数据库中的范围过滤
+    geohash = models.CharField(max_length=12, verbose_name='geohash', default='', blank=True, db_index=True)
     created_time = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        created = not self.id
+        self.geohash = encode_geohash(self.lat, self.lon)
+        if update_fields is not None and {'lat', 'lon'} & set(update_fields):
+            update_fields = set(update_fields) | {'geohash'}
+        super(Club, self).save(force_insert, force_update, using, update_fields)
+        if not created:
+            # 活动卡片中包含俱乐部的名称和头像
+            from footprint.models import FlowType
+            from footprint.manager.flow_card_manager import invalidate_flow_cards
+            activity_ids = self.commercialactivity_set.values_list('id', flat=True)
+            invalidate_flow_cards(*[(activity_id, FlowType.ACTIVITY) for activity_id in activity_ids])
+
 
 class CommercialActivity(models.Model):
     # 商业活动
@@ -35,6 +52,8 @@ class CommercialActivity(models.Model):
     address = models.CharField(max_length=100, verbose_name='活动地址')
     lat = models.FloatField(verbose_name='维度')
     lon = models.FloatField(verbose_name='经度')
+    # 由lat/lon在save时生成, 用于数据库中的范围过滤
+    geohash = models.CharField(max_length=12, verbose_name='geohash', default='', blank=True, db_index=True)
     time_detail = models.CharField(max_length=100, verbose_name='活动时间')
     introduction = models.CharField(max_length=200, verbose_name='内容简介')
     description = models.CharField(max_length=100, verbose_name='活动说明')
@@ -51,15 +70,33 @@ class CommercialActivity(models.Model):
     class Meta:
         verbose_name = u'商家活动啊'
         verbose_name_plural = u'商家活动'
+        # 俱乐部活动游标翻页使用
+        indexes = [models.Index(fields=['club', '-created_time', '-id'])]
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         created = not self.id
+        self.geohash = encode_geohash(self.lat, self.lon)
+        if update_fields is not None and {'lat', 'lon'} & set(update_fields):
+            update_fields = set(update_fields) | {'geohash'}
         super(CommercialActivity, self).save(force_insert, force_update, using, update_fields)
+        from footprint.models import FlowType
         if created:
-            from footprint.models import FlowType
             from footprint.manager.footprint_manager import add_to_flow
             add_to_flow(self.id, FlowType.ACTIVITY)
+        else:
+            from footprint.manager.flow_card_manager import invalidate_flow_cards
+            invalidate_flow_cards((self.id, FlowType.ACTIVITY))
+
+    def delete(self, using=None, keep_parents=False):
+        activity_id = self.id
+        result = super(CommercialActivity, self).delete(using, keep_parents)
+        from api.manager.positon_manager import remove_activity_location
+        from footprint.models import FlowType
+        from footprint.manager.footprint_manager import remove_from_flow
+        remove_activity_location(activity_id)
+        remove_from_flow(activity_id, FlowType.ACTIVITY)
+        return result
 
 
 class ActivityParticipant(models.Model):
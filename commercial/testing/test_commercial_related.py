@@ -1,7 +1,13 @@
 from django.test import TestCase
 
+from api.testing.mock import create_user_info
+from commercial.models import ActivityParticipant
 from commercial.testing import mock
+from footprint.manager.flow_timeline_manager import rebuild_flow_timeline
+from redis_utils.container.api_redis_client import redis
+from user_info.manager.profile_manager import _local_profiles
 from utilities.mock_utility.helper import create_user_login_client
+from utilities.mock_utility.mock import create_user
 
 
 class Test(TestCase):
@@ -21,4 +27,48 @@ class Test(TestCase):
                                                              'cellphone': '18210065466', 'num': 2,
                                                              'hint': '没有'})
         result = client.json_get('/commercial/get_activity_detail/?activity_id={}'.format(activity.id))
-        self.assertEqual(len(result['participants']), 1)
\ No newline at end of file
+        self.assertEqual(len(result['participants']), 1)
+
+
+class QueryBudgetTest(TestCase):
+    """
+    各接口的查询次数上限, 与列表长度无关
+    python manage.py test --settings=settings-test commercial.testing.test_commercial_related.QueryBudgetTest
+    """
+    # 每个请求都有: session + 当前用户
+    AUTH_QUERIES = 2
+
+    def setUp(self):
+        redis.flushdb()
+        _local_profiles.clear()
+
+    def test_commercial_query_budget(self):
+        """
+        python manage.py test --settings=settings-test commercial.testing.test_commercial_related.QueryBudgetTest.test_commercial_query_budget
+        """
+        client, user = create_user_login_client()
+        club = mock.create_club()
+        for num in (1, 5):
+            activities = [mock.create_activity(club) for _ in range(num)]
+            activity = activities[0]
+            activity.top_image = 'top.jpg'
+            activity.save()
+            for _ in range(num):
+                ActivityParticipant.objects.create(activity=activity, user_info=create_user_info(create_user()),
+                                                   name='name', cellphone='110', num=1, hint='')
+            _local_profiles.clear()
+            redis.flushdb()
+            rebuild_flow_timeline()
+
+            # 活动和俱乐部 + 报名者user_id + 报名者资料 + 是否点赞
+            with self.assertNumQueries(self.AUTH_QUERIES + 4):
+                result = client.json_get('/commercial/get_activity_detail/', {'activity_id': activity.id})
+            self.assertEqual((result['club_name'], len(result['participants'])), (club.name, num))
+            # 俱乐部 + 活动列表 + 是否点赞
+            with self.assertNumQueries(self.AUTH_QUERIES + 3):
+                result = client.json_get('/commercial/get_club_activity_info/', {'club_id': club.id, 'cursor': ''})
+            self.assertTrue(result['activity_list'])
+            # 时间线 + 卡片中的活动(join俱乐部) + 是否点赞
+            with self.assertNumQueries(self.AUTH_QUERIES + 2):
+                result = client.json_get('/api/discovery/')
+            self.assertTrue(result['items'])
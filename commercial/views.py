@@ -5,13 +5,13 @@ from django.views.decorators.http import require_GET, require_POST
 from commercial.manager.banner_manager import get_top_banner_db, build_top_banner
 from commercial.manager.activity_manager import build_club_info, \
     build_activity_detail, participate_activity, \
-    build_activity_brief_info
+    build_activity_brief_list
 from commercial.manager.db_manager import get_commercial_activity_by_id_db, get_commercial_activities_by_club_id_db, \
-    get_club_by_id_db
+    get_club_by_id_db, get_commercial_activities_by_club_id_cursor_db
 from footprint.manager.footprint_manager import add_favor_db
 from footprint.models import FlowType
 from user_info.manager.user_info_mananger import get_user_info_by_user_id_db
-from utilities.request_utils import get_page_range, get_data_from_request
+from utilities.request_utils import get_page_range, get_data_from_request, decode_cursor
 from utilities.response import json_http_success, json_http_error
 
 
@@ -116,21 +116,28 @@ def participate_activity_view(request):
 def get_club_activities_info(request):
     """
     URL[GET]: /commercial/get_club_activity_info/
-    :param request:
-    :return:
+    :param request: club_id, page 或 cursor(游标翻页，第一页传空串，之后传上一页返回的next_cursor)
+    :return: {activity_list, avatar, next_cursor, has_more(游标翻页时返回)}
     """
     club_id = int(request.GET['club_id'])
-    page = int(request.GET.get('page', 1))
     lat = float(request.GET.get('lat', 0))
     lon = float(request.GET.get('lon', 0))
-    start, end = get_page_range(page, 5)
     club = get_club_by_id_db(club_id)
     if not club:
         return json_http_error('错误')
+    if 'cursor' in request.GET:
+        try:
+            cursor = decode_cursor(request.GET['cursor'])
+        except ValueError:
+            return json_http_error('参数错误')
+        activities, next_cursor, has_more = get_commercial_activities_by_club_id_cursor_db(club_id, cursor, 5)
+        return json_http_success({'activity_list': build_activity_brief_list(activities, request.user.id, lon, lat),
+                                  'avatar': club.avatar.url, 'next_cursor': next_cursor, 'has_more': has_more})
+    page = int(request.GET.get('page', 1))
+    start, end = get_page_range(page, 5)
     activities = get_commercial_activities_by_club_id_db(club_id, start, end)
 
-    return json_http_success({'activity_list': [build_activity_brief_info(activity, request.user.id, lon, lat) for
-                                                activity in activities],
+    return json_http_success({'activity_list': build_activity_brief_list(activities, request.user.id, lon, lat),
                               'avatar': club.avatar.url})
 
 
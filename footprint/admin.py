@@ -7,9 +7,9 @@ from footprint.models import Footprint, Comment
 @admin.register(Footprint)
 class FootprintAdmin(VersionAdmin):
 
-    list_display = ['name', 'sex', 'content', 'hide']
+    list_display = ['name', 'sex', 'content', 'hide', 'audit_status']
 
 
 @admin.register(Comment)
 class CommentAdmin(VersionAdmin):
-    list_display = ['name', 'comment', 'is_deleted']
+    list_display = ['name', 'comment', 'is_deleted', 'audit_status']
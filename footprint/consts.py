@@ -0,0 +1,11 @@
+from utilities.enum import EnumBase, EnumItem
+
+
+class AuditStatus(EnumBase):
+    """
+    内容审核状态
+    异步审核(settings.ASYNC_MODERATION)时足迹、评论、私信先以PENDING保存, 审核完成前只有作者自己能看到
+    """
+    PASSED = EnumItem(0, '已通过')
+    PENDING = EnumItem(1, '审核中')
+    REJECTED = EnumItem(2, '未通过')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from commercial.models import Club, CommercialActivity
+from footprint.models import Footprint
+from utilities.geo import encode_geohash
+
+BACKFILL_BATCH = 500
+
+
+class Command(BaseCommand):
+    help = '为已有的足迹、活动、俱乐部生成数值坐标和geohash'
+
+    def _bulk_update(self, model, objects, fields):
+        for index in range(0, len(objects), BACKFILL_BATCH):
+            model.objects.bulk_update(objects[index: index + BACKFILL_BATCH], fields)
+        return len(objects)
+
+    def handle(self, *args, **options):
+        footprints = []
+        for footprint in Footprint.objects.filter(geohash='').only('id', 'lat', 'lon').iterator():
+            footprint.sync_geo_fields()
+            if footprint.geohash:
+                footprints.append(footprint)
+        count = self._bulk_update(Footprint, footprints, ['latitude', 'longitude', 'geohash'])
+        self.stdout.write('backfill {} footprints'.format(count))
+
+        for model in (CommercialActivity, Club):
+            objects = list(model.objects.filter(geohash='').only('id', 'lat', 'lon'))
+            for obj in objects:
+                obj.geohash = encode_geohash(obj.lat, obj.lon)
+            count = self._bulk_update(model, objects, ['geohash'])
+            self.stdout.write('backfill {} {}'.format(count, model._meta.model_name))
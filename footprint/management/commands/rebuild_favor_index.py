@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from footprint.manager.favor_manager import rebuild_favor_index
+
+
+class Command(BaseCommand):
+    help = '从Favor表重建redis中的点赞索引'
+
+    def handle(self, *args, **options):
+        count = rebuild_favor_index()
+        self.stdout.write('rebuild favor index with {} favor records'.format(count))
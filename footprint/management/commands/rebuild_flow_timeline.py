@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from footprint.manager.flow_timeline_manager import rebuild_flow_timeline
+
+
+class Command(BaseCommand):
+    help = '从TotalFlow重建发现页的redis时间线'
+
+    def handle(self, *args, **options):
+        count = rebuild_flow_timeline()
+        self.stdout.write('rebuild discovery flow timeline with {} flows'.format(count))
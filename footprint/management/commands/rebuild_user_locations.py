@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.manager.positon_manager import rebuild_user_locations
+
+
+class Command(BaseCommand):
+    help = '从数据库重建redis中保留期内足迹的位置索引'
+
+    def handle(self, *args, **options):
+        count = rebuild_user_locations()
+        self.stdout.write('rebuild user locations with {} footprints'.format(count))
@@ -0,0 +1,146 @@
+"""
+点赞关系
+
+redis中每个事件一个set, 保存点赞过的user_id: "flow_favor_users:{flow_type}:{flow_id}"
+索引建好之后(FAVOR_INDEX_READY_KEY存在)redis是读写的唯一依据, 点赞/取消、是否点赞都只需要O(1)次redis调用,
+Favor表由celery任务异步写入, 只用于持久化和重建索引
+索引没有建好时(首次上线、redis数据丢失)读写都走数据库, 同时写入redis;
+重建: python manage.py rebuild_favor_index
+
+这些key是持久数据而不是缓存: 不设置过期时间, redis的maxmemory-policy需要是noeviction或volatile-*(只淘汰有过期时间的key),
+不能用allkeys-*. 即使某个集合意外丢失, Favor表也不受影响: 异步任务写入的是点赞时toggle_favor的结果,
+不会从redis回读, 重建索引即可恢复
+"""
+import datetime
+
+from footprint.models import Favor
+from redis_utils.container.api_redis_client import redis
+
+FAVOR_USERS_KEY = 'flow_favor_users:{}:{}'
+FAVOR_INDEX_READY_KEY = 'flow_favor_users:_READY'
+FAVOR_REBUILD_BATCH = 1000
+
+
+def _get_favor_users_key(flow_id, flow_type):
+    return FAVOR_USERS_KEY.format(flow_type, flow_id)
+
+
+def is_favor_index_ready():
+    return bool(redis.exists(FAVOR_INDEX_READY_KEY))
+
+
+def is_user_favored_db(user_id, flow_id, flow_type):
+    return Favor.objects.filter(user_id=user_id, flow_id=flow_id, flow_type=flow_type, favored=True).exists()
+
+
+def get_favored_flows_db(user_id, flow_pairs):
+    """
+    批量获取用户点赞过的flow，列表页只需要一次查询
+    :param user_id:
+    :param flow_pairs: [(flow_id, flow_type), ...]
+    :return: set([(flow_id, flow_type), ...])
+    """
+    flow_pairs = {(int(flow_id), flow_type) for flow_id, flow_type in flow_pairs}
+    if not user_id or not flow_pairs:
+        return set()
+    flow_ids = {flow_id for flow_id, _ in flow_pairs}
+    favored_pairs = Favor.objects.filter(user_id=user_id, flow_id__in=flow_ids, favored=True).values_list(
+        'flow_id', 'flow_type')
+    return flow_pairs & set(favored_pairs)
+
+
+def is_user_favored(user_id, flow_id, flow_type):
+    if not is_favor_index_ready():
+        return is_user_favored_db(user_id, flow_id, flow_type)
+    return bool(redis.sismember(_get_favor_users_key(flow_id, flow_type), user_id))
+
+
+def get_favored_flows(user_id, flow_pairs):
+    """
+    批量获取用户点赞过的flow, 所有SISMEMBER在一次网络往返中完成
+    :return: set([(flow_id, flow_type), ...])
+    """
+    if not is_favor_index_ready():
+        return get_favored_flows_db(user_id, flow_pairs)
+    flow_pairs = list({(int(flow_id), flow_type) for flow_id, flow_type in flow_pairs})
+    if not user_id or not flow_pairs:
+        return set()
+    pipeline = redis.pipeline(transaction=False)
+    for flow_id, flow_type in flow_pairs:
+        pipeline.sismember(_get_favor_users_key(flow_id, flow_type), user_id)
+    return {flow_pair for flow_pair, favored in zip(flow_pairs, pipeline.execute()) if favored}
+
+
+def toggle_favor(flow_id, flow_type, user_id):
+    """
+    点赞, 已经点过赞的取消点赞
+    WATCH + MULTI, 同一个用户并发点击时每次都基于上一次的结果切换
+    :return: 操作之后是否为点赞状态
+    """
+    key = _get_favor_users_key(flow_id, flow_type)
+
+    def toggle(pipeline):
+        favored = not pipeline.sismember(key, user_id)
+        pipeline.multi()
+        if favored:
+            pipeline.sadd(key, user_id)
+        else:
+            pipeline.srem(key, user_id)
+        return favored
+
+    return redis.transaction(toggle, key, value_from_callable=True)
+
+
+def toggle_favor_db(flow_id, flow_type, user_id):
+    """
+    索引没有建好时的点赞, 以数据库为准, 同时写入redis
+    :return: 操作之后是否为点赞状态
+    """
+    favor, created = Favor.objects.get_or_create(flow_id=flow_id, flow_type=flow_type, user_id=user_id)
+    if not created:
+        favor.favored = not favor.favored
+        favor.save()
+    key = _get_favor_users_key(flow_id, flow_type)
+    if favor.favored:
+        redis.sadd(key, user_id)
+    else:
+        redis.srem(key, user_id)
+    return favor.favored
+
+
+def sync_favor_db(flow_id, flow_type, user_id, favored, toggled_at):
+    """
+    将点赞时toggle_favor的结果写入Favor表
+    last_modified记为点赞的时间, 多个任务乱序执行时只有更新的点赞能覆盖, 最终与redis一致
+    :param favored: 点赞之后是否为点赞状态
+    :param toggled_at: 点赞时的时间戳
+    """
+    toggled_time = datetime.datetime.fromtimestamp(toggled_at)
+    favors = Favor.objects.filter(flow_id=flow_id, flow_type=flow_type, user_id=user_id)
+    if favors.filter(last_modified__lt=toggled_time).update(favored=favored, last_modified=toggled_time):
+        return
+    if not favors.exists():
+        favor = Favor.objects.create(flow_id=flow_id, flow_type=flow_type, user_id=user_id, favored=favored)
+        # auto_now会覆盖last_modified
+        Favor.objects.filter(id=favor.id).update(last_modified=toggled_time)
+
+
+def rebuild_favor_index():
+    """
+    从Favor表重建redis索引
+    :return: 处理的点赞记录数
+    """
+    count = 0
+    pipeline = redis.pipeline(transaction=False)
+    for favor in Favor.objects.only('flow_id', 'flow_type', 'user_id', 'favored').iterator():
+        key = _get_favor_users_key(favor.flow_id, favor.flow_type)
+        if favor.favored:
+            pipeline.sadd(key, favor.user_id)
+        else:
+            pipeline.srem(key, favor.user_id)
+        count += 1
+        if count % FAVOR_REBUILD_BATCH == 0:
+            pipeline.execute()
+    pipeline.set(FAVOR_INDEX_READY_KEY, 1)
+    pipeline.execute()
+    return count
@@ -0,0 +1,146 @@
+"""
+事件卡片缓存
+
+发现页、附近、用户足迹轨迹都要把足迹/活动渲染成卡片, 其中image_list的json解析、club头像url等每次都重复计算
+这里按(flow_id, flow_type)缓存卡片中与浏览者无关的部分, 批量mget获取, 未命中的一次查库后写回
+点赞状态、距离等与浏览者相关的字段由调用方在取到卡片后再合并
+计数字段开启write-behind时会加上redis中尚未写回的变化, @see flow_counter_manager
+
+失效: Footprint/CommercialActivity/Club保存, 以及点赞数、评论数、报名人数变化时删除对应卡片
+回写与失效的竞争: 未命中的请求查库后才写回, 这期间卡片被失效时写回的是旧卡片, 会保留FLOW_CARD_EXPIRE(一天).
+所以失效时先把卡片的版本号 "flow_card_version:{flow_type}:{flow_id}" 加一(保留FLOW_CARD_VERSION_EXPIRE秒)再删除卡片,
+未命中的请求在查库前读版本号, 写回时WATCH版本号, 版本号变了的卡片不写回;
+只有查库到写回超过FLOW_CARD_VERSION_EXPIRE秒(版本号已过期)时旧卡片才可能写回, 最多保留FLOW_CARD_EXPIRE
+命中率: flow_card_hit_counter.get_stats(), 或staff访问 /api/cache_stats/
+未命中时只查询卡片用到的列(FootprintRow/ActivityRow), 不实例化Model; 一页20个足迹+20个活动(活动详情约2万字)
+本地sqlite: 完整Model约10ms、峰值内存约980KB, 列投影约4ms、约50KB
+(footprint.testing.benchmark_flow_card.ProjectionBenchmark)
+"""
+import pickle
+
+from commercial.manager.db_manager import get_commercial_activities_by_ids_db
+from footprint.manager.flow_counter_manager import apply_pending_deltas, get_pending_deltas, is_write_behind_enabled
+from footprint.models import FlowType
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import CacheHitCounter, DAY_SECONDS
+
+FLOW_CARD_KEY = 'flow_card:{}:{}'
+FLOW_CARD_EXPIRE = DAY_SECONDS
+FLOW_CARD_VERSION_KEY = 'flow_card_version:{}:{}'
+# 需要远大于未命中时查库到写回的耗时
+FLOW_CARD_VERSION_EXPIRE = 60
+
+flow_card_hit_counter = CacheHitCounter('flow_card')
+
+
+def _get_card_key(flow_id, flow_type):
+    return FLOW_CARD_KEY.format(flow_type, flow_id)
+
+
+def _get_card_version_key(flow_id, flow_type):
+    return FLOW_CARD_VERSION_KEY.format(flow_type, flow_id)
+
+
+def build_footprint_card(footprint):
+    return {
+        'flow_id': footprint.id, 'flow_type': FlowType.FOOTPRINT,
+        'user_id': footprint.user_id, 'avatar': footprint.avatar, 'name': footprint.name,
+        'location': footprint.location, 'created_time': footprint.created_time,
+        'content': footprint.content, 'image_list': footprint.image_list,
+        'favor_num': footprint.favor_num, 'comment_num': footprint.comment_num,
+        'forward_num': footprint.forward_num, 'lat': footprint.lat, 'lon': footprint.lon,
+    }
+
+
+def build_activity_card(activity):
+    """
+    :param activity: ActivityRow
+    """
+    return {
+        'flow_id': activity.id, 'flow_type': FlowType.ACTIVITY,
+        'avatar': activity.club_avatar_url, 'name': activity.club_name,
+        'activity_name': activity.name, 'description': activity.description,
+        'participant_num': activity.participant_num, 'total_quota': activity.total_quota,
+        'location': activity.address, 'created_time': activity.created_time,
+        'content': activity.introduction, 'image_list': activity.image_list,
+        'favor_num': activity.favor_num,
+        'lat': activity.lat, 'lon': activity.lon,
+    }
+
+
+def _load_cards_db(flow_pairs):
+    """
+    未命中的卡片从数据库构建, 足迹和活动各一次查询, 只取卡片用到的列
+    """
+    from footprint.manager.footprint_manager import get_footprints_by_ids_db
+    footprint_ids = [flow_id for flow_id, flow_type in flow_pairs if flow_type == FlowType.FOOTPRINT]
+    activity_ids = [flow_id for flow_id, flow_type in flow_pairs if flow_type == FlowType.ACTIVITY]
+    cards = []
+    if footprint_ids:
+        cards.extend(build_footprint_card(footprint) for footprint in get_footprints_by_ids_db(footprint_ids))
+    if activity_ids:
+        cards.extend(build_activity_card(activity) for activity in get_commercial_activities_by_ids_db(activity_ids))
+    return {(card['flow_id'], card['flow_type']): card for card in cards}
+
+
+def get_flow_cards(flow_pairs):
+    """
+    批量获取事件卡片
+    :param flow_pairs: [(flow_id, flow_type)]
+    :return: {(flow_id, flow_type): card}, 已不存在的事件不在结果中
+    """
+    flow_pairs = list(dict.fromkeys((int(flow_id), int(flow_type)) for flow_id, flow_type in flow_pairs))
+    if not flow_pairs:
+        return {}
+    values = redis.mget([_get_card_key(*flow_pair) for flow_pair in flow_pairs])
+    result = {flow_pair: pickle.loads(value) for flow_pair, value in zip(flow_pairs, values) if value is not None}
+    missed_pairs = [flow_pair for flow_pair in flow_pairs if flow_pair not in result]
+    flow_card_hit_counter.record(hit=len(result), miss=len(missed_pairs))
+    if missed_pairs:
+        # 版本号需要在查库之前读取
+        versions = dict(zip(missed_pairs, redis.mget([_get_card_version_key(*flow_pair)
+                                                      for flow_pair in missed_pairs])))
+        loaded_cards = _load_cards_db(missed_pairs)
+        _write_back_cards(loaded_cards, versions)
+        result.update(loaded_cards)
+    if is_write_behind_enabled():
+        # 卡片中是数据库中的计数, 加上还没有写回的变化
+        for flow_pair, deltas in get_pending_deltas(list(result)).items():
+            apply_pending_deltas(result[flow_pair], deltas)
+    return result
+
+
+def _write_back_cards(cards, versions):
+    """
+    WATCH + MULTI, 只写回查库之后没有被失效的卡片
+    :param versions: {(flow_id, flow_type): 查库前读到的版本号}
+    """
+    if not cards:
+        return
+    version_keys = [_get_card_version_key(*flow_pair) for flow_pair in cards]
+
+    def write_back(pipeline):
+        current_versions = pipeline.mget(version_keys)
+        pipeline.multi()
+        for (flow_pair, card), current_version in zip(cards.items(), current_versions):
+            if current_version == versions[flow_pair]:
+                pipeline.setex(_get_card_key(*flow_pair), FLOW_CARD_EXPIRE,
+                               pickle.dumps(card, pickle.HIGHEST_PROTOCOL))
+
+    redis.transaction(write_back, *version_keys)
+
+
+def invalidate_flow_cards(*flow_pairs):
+    """
+    删除卡片缓存, 下次读取时重新构建; 先增加版本号再删除, 正在查库的请求不会再写回旧卡片
+    :param flow_pairs: (flow_id, flow_type), ...
+    """
+    if not flow_pairs:
+        return
+    pipeline = redis.pipeline(transaction=True)
+    for flow_pair in flow_pairs:
+        version_key = _get_card_version_key(*flow_pair)
+        pipeline.incr(version_key)
+        pipeline.expire(version_key, FLOW_CARD_VERSION_EXPIRE)
+    pipeline.delete(*[_get_card_key(*flow_pair) for flow_pair in flow_pairs])
+    pipeline.execute()
@@ -0,0 +1,119 @@
+"""
+发现页事件流的redis时间线
+
+TotalFlow写入时同步写入redis有序集合, 发现页直接从时间线翻页, 不再查询TotalFlow表
+member: "{total_flow_id}:{flow_type}:{flow_id}"
+score: created_time的时间戳(精确到微秒)
+
+时间线只保留最新的FLOW_TIMELINE_MAX_LENGTH条, 更早的数据由调用方回源到数据库
+是否完整由FLOW_TIMELINE_READY_KEY标记: 标记不存在(首次上线、redis数据丢失)时认为缓存缺失,
+需要调用rebuild_flow_timeline重建(python manage.py rebuild_flow_timeline)
+"""
+import time
+from collections import namedtuple
+
+from footprint.models import TotalFlow
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import GeneralListCacheByTime, MONTH_SECONDS
+from utilities.date_time import timestamp_to_datetime
+from utilities.request_utils import encode_cursor
+
+FLOW_TIMELINE_GROUP = 'all'
+FLOW_TIMELINE_MAX_LENGTH = 1000
+FLOW_TIMELINE_READY_KEY = 'discovery_flow_timeline:_READY'
+
+flow_timeline = GeneralListCacheByTime('discovery_flow_timeline', expire_time=MONTH_SECONDS,
+                                       max_length=FLOW_TIMELINE_MAX_LENGTH)
+
+# 与TotalFlow字段一致的轻量对象, build_flows_detail及游标翻页只需要这几个字段
+FlowItem = namedtuple('FlowItem', ['id', 'flow_type', 'flow_id', 'created_time'])
+
+
+def _datetime_to_score(created_time):
+    return time.mktime(created_time.timetuple()) + created_time.microsecond / 1000000.0
+
+
+def _build_member(flow):
+    return '{}:{}:{}'.format(flow.id, flow.flow_type, flow.flow_id)
+
+
+def _parse_member(member, score=None):
+    member = member.decode('utf-8') if isinstance(member, bytes) else member
+    total_flow_id, flow_type, flow_id = [int(item) for item in member.split(':')]
+    created_time = timestamp_to_datetime(score) if score is not None else None
+    return FlowItem(total_flow_id, flow_type, flow_id, created_time)
+
+
+def is_timeline_ready():
+    return bool(redis.exists(FLOW_TIMELINE_READY_KEY))
+
+
+def add_flow_to_timeline(flow):
+    """
+    新的TotalFlow写入时间线
+    即使时间线还没有重建也写入, 防止重建过程中新写入的数据丢失
+    """
+    flow_timeline.add_member(FLOW_TIMELINE_GROUP, _build_member(flow), _datetime_to_score(flow.created_time))
+    # 标记与时间线同时续期, 保证两者同时过期
+    redis.expire(FLOW_TIMELINE_READY_KEY, MONTH_SECONDS)
+
+
+def remove_flows_from_timeline(flows):
+    """
+    删除的TotalFlow移出时间线
+    """
+    for flow in flows:
+        flow_timeline.remove_member(FLOW_TIMELINE_GROUP, _build_member(flow))
+
+
+def rebuild_flow_timeline():
+    """
+    从数据库重建时间线
+    :return: 写入的条数
+    """
+    flows = TotalFlow.objects.order_by('-created_time', '-id')[:FLOW_TIMELINE_MAX_LENGTH]
+    member_2_score = {_build_member(flow): _datetime_to_score(flow.created_time) for flow in flows}
+    flow_timeline.add_members(FLOW_TIMELINE_GROUP, **member_2_score)
+    redis.setex(FLOW_TIMELINE_READY_KEY, MONTH_SECONDS, 1)
+    return len(member_2_score)
+
+
+def _may_exceed_timeline(fetched_num, expected_num):
+    """
+    时间线已满且取到的数据不够, 说明更早的数据只在数据库中
+    """
+    return fetched_num < expected_num and \
+        flow_timeline.get_member_count(FLOW_TIMELINE_GROUP) >= FLOW_TIMELINE_MAX_LENGTH
+
+
+def get_timeline_flows(start_num, end_num):
+    """
+    按页码从时间线获取事件流
+    :return: [FlowItem], 需要回源数据库时返回None
+    """
+    if not is_timeline_ready():
+        return None
+    members = flow_timeline.get_member_by_rank(FLOW_TIMELINE_GROUP, start_num, end_num - 1, desc=True)
+    if _may_exceed_timeline(len(members), end_num - start_num):
+        return None
+    return [_parse_member(member) for member in members]
+
+
+def get_timeline_flows_by_cursor(cursor, count):
+    """
+    按游标从时间线获取事件流, 游标与数据库翻页通用
+    时间线按score排序, 同一微秒内创建的多条数据可能被跳过, 实际不会出现
+    :return: (flows, next_cursor, has_more), 需要回源数据库时返回None
+    """
+    if not is_timeline_ready():
+        return None
+    end_time = _datetime_to_score(cursor[0]) - 0.000001 if cursor else float('inf')
+    members = flow_timeline.get_member_by_time(FLOW_TIMELINE_GROUP, 0, end_time, with_score=True,
+                                               start=0, num=count + 1, reverse=True)
+    if _may_exceed_timeline(len(members), count + 1):
+        return None
+    flows = [_parse_member(member, score) for member, score in members]
+    has_more = len(flows) > count
+    flows = flows[:count]
+    next_cursor = encode_cursor(flows[-1].created_time, flows[-1].id) if has_more else ''
+    return flows, next_cursor, has_more
@@ -1,11 +1,24 @@
 import json
-
-from geopy.distance import geodesic
-
-from commercial.manager.db_manager import get_commercial_activity_by_id_db
-from footprint.models import Footprint, Favor, TotalFlow, FlowType, Comment
-from user_info.manager.user_info_mananger import get_user_info_by_user_id_db
+import time
+
+from django.db.models import Q
+
+from footprint.consts import AuditStatus
+from footprint.manager.favor_manager import is_favor_index_ready, toggle_favor, toggle_favor_db, is_user_favored, \
+    get_favored_flows
+from footprint.manager.flow_card_manager import get_flow_cards, invalidate_flow_cards
+from footprint.manager.flow_counter_manager import FLOW_COUNTER_MODELS, apply_pending_deltas, buffer_flow_count, \
+    get_pending_deltas, is_write_behind_enabled
+from footprint.manager.flow_timeline_manager import add_flow_to_timeline, get_timeline_flows, \
+    get_timeline_flows_by_cursor, is_timeline_ready, rebuild_flow_timeline, remove_flows_from_timeline
+from footprint.models import Footprint, TotalFlow, FlowType, Comment
+from footprint.tasks import sync_favor_task
+from user_info.manager.profile_manager import get_profile, load_profiles
 from utilities.date_time import datetime_to_str
+from utilities.db_counter import incr_counter_db
+from utilities.geo import distances_from
+from utilities.projection import ProjectedRow
+from utilities.request_utils import get_page_by_cursor
 from utilities.time_utils import get_time_show
 
 
@@ -16,11 +29,32 @@ def get_footprint_by_id_db(footprint_id):
         return None
 
 
+class FootprintRow(ProjectedRow):
+    """
+    足迹卡片用到的列, image_list在第一次访问时才解析
+    """
+    COLUMNS = ('id', 'user_id', 'name', 'avatar', 'location', 'created_time', 'content', 'image_list_str',
+               'favor_num', 'comment_num', 'forward_num', 'lat', 'lon')
+    __slots__ = ProjectedRow.get_attrs(COLUMNS) + ('_image_list', )
+
+    @property
+    def image_list(self):
+        try:
+            return self._image_list
+        except AttributeError:
+            self._image_list = json.loads(self.image_list_str) if self.image_list_str else []
+            return self._image_list
+
+
 def get_footprints_by_ids_db(footprint_ids):
-    return Footprint.objects.filter(id__in=footprint_ids)
+    """
+    :return: [FootprintRow]
+    """
+    return FootprintRow.project(Footprint.objects.filter(id__in=footprint_ids))
 
 
-def create_footprint_db(user_id, thinking, latitude, longitude, location, image_list, hide):
+def create_footprint_db(user_id, thinking, latitude, longitude, location, image_list, hide,
+                        audit_status=AuditStatus.PASSED):
     """
     创建痕迹
     :param user_id:
@@ -29,15 +63,29 @@ def create_footprint_db(user_id, thinking, latitude, longitude, location, image_
     :param longitude: 经度
     :param location: 地点名
     :param image_list: list
+    :param audit_status: 待审核的足迹审核通过后才进入发现页
     :return: footprint
     """
-    user_info = get_user_info_by_user_id_db(user_id)
-    footprint = Footprint.objects.create(user=user_info.user, name=user_info.nickname, sex=user_info.sex,
+    user_info = get_profile(user_id)
+    footprint = Footprint.objects.create(user_id=user_id, name=user_info.nickname, sex=user_info.sex,
                                          content=thinking, lat=latitude, lon=longitude, location=location,
-                                         image_list_str=json.dumps(image_list), hide=hide, avatar=user_info.avatar)
+                                         image_list_str=json.dumps(image_list), hide=hide, avatar=user_info.avatar,
+                                         audit_status=audit_status)
     return footprint
 
 
+def get_visible_query(author_field, user_id):
+    """
+    审核通过的内容所有人可见, 待审核和未通过的只有作者自己可见
+    :param author_field: 作者user_id对应的字段名
+    """
+    return Q(audit_status=AuditStatus.PASSED) | Q(**{author_field: user_id})
+
+
+def is_footprint_visible(footprint, user_id):
+    return footprint.audit_status == AuditStatus.PASSED or footprint.user_id == user_id
+
+
 def get_user_newest_footprint_db(user_id):
     """
     获取用户最新的一个动态
@@ -48,64 +96,146 @@ def get_user_newest_footprint_db(user_id):
     return query[0] if query else None
 
 
-def get_footprints_by_user_id_db(user_id, start, end):
+def _get_user_footprints_query(user_id, viewer_id):
+    query = Footprint.objects.filter(user_id=user_id).only('id', 'created_time', 'audit_status')
+    if int(user_id) != viewer_id:
+        query = query.filter(audit_status=AuditStatus.PASSED)
+    return query
+
+
+def get_footprints_by_user_id_db(user_id, start, end, viewer_id=None):
+    """
+    获取用户足迹, 只取id、created_time和审核状态, 内容由build_footprint_list_info从卡片缓存获取
+    :param viewer_id: 查看者, 不是本人时只返回审核通过的
+    """
+    return _get_user_footprints_query(user_id, viewer_id).order_by('-created_time')[start: end]
+
+
+def get_footprints_by_user_id_cursor_db(user_id, cursor, count, viewer_id=None):
     """
-    获取用户足迹
+    游标方式获取用户足迹
+    :return: footprints, next_cursor, has_more
     """
-    return Footprint.objects.filter(user_id=user_id).order_by('-created_time')[start: end]
+    return get_page_by_cursor(_get_user_footprints_query(user_id, viewer_id), cursor, count)
+
+
+def update_flow_count(flow_id, flow_type, field_name, delta):
+    """
+    更新事件的计数并返回最新值
+    开启write-behind时只写入redis缓冲, 最新值为卡片中的数据库值加上缓冲中的变化
+    :return: 最新的计数, 事件不存在时返回None
+    """
+    if is_write_behind_enabled():
+        buffer_flow_count(flow_id, flow_type, field_name, delta)
+        return get_flow_count(flow_id, flow_type, field_name)
+    count = incr_counter_db(FLOW_COUNTER_MODELS[flow_type], flow_id, field_name, delta)
+    invalidate_flow_cards((flow_id, flow_type))
+    return count
+
+
+def get_flow_count(flow_id, flow_type, field_name):
+    """
+    当前的计数, 包括还没写回数据库的变化
+    :return: 事件不存在时返回None
+    """
+    card = get_flow_cards([(flow_id, flow_type)]).get((int(flow_id), flow_type))
+    return card[field_name] if card else None
 
 
 def update_footprint_favor_num_db(footprint_id, num):
-    footprint = get_footprint_by_id_db(footprint_id)
-    footprint.favor_num += num
-    footprint.save()
-    return footprint.favor_num
+    return update_flow_count(footprint_id, FlowType.FOOTPRINT, 'favor_num', num)
 
 
 def update_activity_favor_num(activity_id, num):
-    activity = get_commercial_activity_by_id_db(activity_id)
-    activity.favor_num += num
-    activity.save()
-    return activity.favor_num
+    return update_flow_count(activity_id, FlowType.ACTIVITY, 'favor_num', num)
 
 
 def add_favor_db(flow_id, flow_type, user_id):
     """
-    点赞
+    点赞, 再点一次取消
+    点赞关系以redis为准, Favor表异步写入, @see favor_manager
     """
-    favor, created = Favor.objects.get_or_create(flow_id=flow_id, flow_type=flow_type, user_id=user_id)
-    if not created:
-        favor.favored = not favor.favored
-        favor.save()
+    if is_favor_index_ready():
+        favored = toggle_favor(flow_id, flow_type, user_id)
+        sync_favor_task.delay(flow_id, flow_type, user_id, favored, time.time())
+    else:
+        favored = toggle_favor_db(flow_id, flow_type, user_id)
     if flow_type == FlowType.FOOTPRINT:
-        favor_num = update_footprint_favor_num_db(flow_id, 1 if favor.favored else -1)
+        favor_num = update_footprint_favor_num_db(flow_id, 1 if favored else -1)
     else:
-        favor_num = update_activity_favor_num(flow_id, 1 if favor.favored else -1)
+        favor_num = update_activity_favor_num(flow_id, 1 if favored else -1)
     return favor_num
 
 
 def update_comment_num_db(footprint_id, num=1):
-    footprint = get_footprint_by_id_db(footprint_id)
-    footprint.comment_num += num
-    footprint.save()
-    return footprint.comment_num
+    return update_flow_count(footprint_id, FlowType.FOOTPRINT, 'comment_num', num)
 
 
-def get_footprint_comment_list(footprint_id, start, end):
-    return Comment.objects.filter(flow_id=footprint_id, flow_type=FlowType.FOOTPRINT,
-                                  is_deleted=False).order_by('-created_time')[start: end]
+def get_footprint_comment_list(footprint_id, start, end, user_id=None):
+    """
+    :param user_id: 查看者, 可以看到自己待审核的评论
+    """
+    return Comment.objects.filter(get_visible_query('user_id', user_id), flow_id=footprint_id,
+                                  flow_type=FlowType.FOOTPRINT, is_deleted=False).order_by('-created_time')[start: end]
 
 
 def add_to_flow(flow_id, flow_type):
-    return TotalFlow.objects.create(flow_id=flow_id, flow_type=flow_type)
+    flow = TotalFlow.objects.create(flow_id=flow_id, flow_type=flow_type)
+    add_flow_to_timeline(flow)
+    return flow
+
+
+def remove_from_flow(flow_id, flow_type):
+    """
+    足迹、活动删除后从事件流、发现页时间线中删除, 并删除卡片缓存
+    """
+    flows = list(TotalFlow.objects.filter(flow_id=flow_id, flow_type=flow_type))
+    TotalFlow.objects.filter(id__in=[flow.id for flow in flows]).delete()
+    remove_flows_from_timeline(flows)
+    invalidate_flow_cards((flow_id, flow_type))
 
 
 def get_flows_db(start_num, end_num):
     return TotalFlow.objects.order_by('-created_time')[start_num: end_num]
 
 
-def is_user_favored(user_id, flow_id, flow_type):
-    return Favor.objects.filter(user_id=user_id, flow_id=flow_id, flow_type=flow_type, favored=True).exists()
+def get_flows_by_cursor_db(cursor, count):
+    """
+    游标方式获取事件流
+    :return: flows, next_cursor, has_more
+    """
+    return get_page_by_cursor(TotalFlow.objects.all(), cursor, count)
+
+
+def _rebuild_timeline_if_missing():
+    """
+    时间线缺失(首次上线、redis数据丢失)时顺带重建, 之后的请求不再回源
+    """
+    if not is_timeline_ready():
+        rebuild_flow_timeline()
+
+
+def get_discovery_flows(start_num, end_num):
+    """
+    发现页事件流, 优先读redis时间线, 缓存缺失或超出时间线长度时回源数据库
+    """
+    flows = get_timeline_flows(start_num, end_num)
+    if flows is None:
+        flows = get_flows_db(start_num, end_num)
+        _rebuild_timeline_if_missing()
+    return flows
+
+
+def get_discovery_flows_by_cursor(cursor, count):
+    """
+    游标方式获取发现页事件流, 回源策略同get_discovery_flows
+    :return: flows, next_cursor, has_more
+    """
+    result = get_timeline_flows_by_cursor(cursor, count)
+    if result is None:
+        result = get_flows_by_cursor_db(cursor, count)
+        _rebuild_timeline_if_missing()
+    return result
 
 
 def build_user_footprint(footprint):
@@ -139,13 +269,17 @@ def build_user_footprint(footprint):
     }
 
 
-def build_comment(comment):
+def build_comment(comment, profile=None):
+    """
+    :param profile: 评论者当前的资料, 头像昵称为空(没有资料)时用评论时记录的
+    """
     return {
-        'avatar': comment.avatar,
-        'name': comment.name,
+        'avatar': (profile and profile.avatar) or comment.avatar,
+        'name': (profile and profile.nickname) or comment.name,
         'created_time': datetime_to_str(comment.created_time),
         'content': comment.comment,
-        'user_id': comment.user_id
+        'user_id': comment.user_id,
+        'audit_status': comment.audit_status,
     }
 
 
@@ -170,24 +304,32 @@ def build_footprint_detail(footprint, user_id):
         ]
     }
     """
-    user_info = get_user_info_by_user_id_db(footprint.user_id)
+    comment_list = list(get_footprint_comment_list(footprint.id, 0, 20, user_id))
+    # 作者和所有评论者的资料一次取出
+    profiles = load_profiles([footprint.user_id] + [comment.user_id for comment in comment_list])
+    user_info = profiles[footprint.user_id]
     user_info_data = {
         'avatar': user_info.avatar,
         'nickname': user_info.nickname,
         'user_id': footprint.user_id
     }
+    counts = {'favor_num': footprint.favor_num, 'comment_num': footprint.comment_num,
+              'forward_num': footprint.forward_num}
+    if is_write_behind_enabled():
+        deltas = get_pending_deltas([(footprint.id, FlowType.FOOTPRINT)])
+        apply_pending_deltas(counts, deltas.get((footprint.id, FlowType.FOOTPRINT), {}))
     foot_print_data = {
         'location': footprint.location,
         'content': footprint.content,
         'image_list': footprint.image_list,
-        'favor_num': footprint.favor_num,
-        'reply_num': footprint.comment_num,
-        'forward_num': footprint.forward_num,
+        'favor_num': counts['favor_num'],
+        'reply_num': counts['comment_num'],
+        'forward_num': counts['forward_num'],
         'show_time': get_time_show(footprint.created_time),
         'favored': is_user_favored(user_id, footprint.id, FlowType.FOOTPRINT),
+        'audit_status': footprint.audit_status,
     }
-    comment_list = get_footprint_comment_list(footprint.id, 0, 20)
-    comment_data = {'comments': [build_comment(comment) for comment in comment_list]}
+    comment_data = {'comments': [build_comment(comment, profiles[comment.user_id]) for comment in comment_list]}
     result = user_info_data
     result.update(foot_print_data)
     result.update(comment_data)
@@ -196,25 +338,31 @@ def build_footprint_detail(footprint, user_id):
 
 def build_footprint_list_info(footprints, user_id, lat=None, lon=None):
     """
-    构建足迹列表详情
-    :param footprints:
+    构建足迹列表详情, 卡片内容从缓存获取
+    :param footprints: 只用到id
     :return:
     """
     need_distance = bool(lat and lon)
+    flow_pairs = [(footprint.id, FlowType.FOOTPRINT) for footprint in footprints]
+    cards = get_flow_cards(flow_pairs)
+    cards = [cards[flow_pair] for flow_pair in flow_pairs if flow_pair in cards]
+    favored_flows = get_favored_flows(user_id, flow_pairs)
+    distances = distances_from(lat, lon, [(card['lat'], card['lon']) for card in cards]) if need_distance else []
+    audit_statuses = {footprint.id: footprint.audit_status for footprint in footprints}
     result = []
-    for footprint in footprints:
+    for index, card in enumerate(cards):
         info = {
-            'location': footprint.location,
-            'created_time': get_time_show(footprint.created_time),
-            'content': footprint.content,
-            'image_list': footprint.image_list,
-            'comment_num': footprint.comment_num,
-            'favor_num': footprint.favor_num,
-            'footprint_id': footprint.id,
-            'favored': is_user_favored(user_id, footprint.id, FlowType.FOOTPRINT)
+            'location': card['location'],
+            'created_time': get_time_show(card['created_time']),
+            'content': card['content'],
+            'image_list': card['image_list'],
+            'comment_num': card['comment_num'],
+            'favor_num': card['favor_num'],
+            'footprint_id': card['flow_id'],
+            'favored': (card['flow_id'], FlowType.FOOTPRINT) in favored_flows,
+            'audit_status': audit_statuses[card['flow_id']],
         }
         if need_distance:
-            distance = geodesic((lat, lon), (footprint.lat, footprint.lon)).meters
-            info['distance'] = distance
+            info['distance'] = distances[index]
         result.append(info)
     return result
@@ -0,0 +1,118 @@
+"""
+足迹和评论的异步审核
+
+同步审核时发足迹要依次等待文本检测和每张图片的检测, 第三方接口慢的时候会占掉uwsgi harakiri(10s)的大部分时间.
+开启settings.ASYNC_MODERATION后, 足迹、评论、私信先以AuditStatus.PENDING保存, 请求立即返回, 审核由celery任务执行:
+- 审核中和未通过的内容只有作者自己能看到, 接口返回audit_status供客户端展示
+- 足迹审核通过后才进入发现页时间线和附近, 评论审核通过后才计入评论数, 私信审核通过后才更新双方的会话列表
+- 只有PENDING状态的内容会被更新, 任务重复执行不会重复发布
+- 检测接口出错(超时、access_token失效、系统繁忙)与检测不通过区分开: 出错时内容保持PENDING, 任务按指数退避重试
+  MODERATION_MAX_RETRIES次(@see run_moderation_task); 重试用完或worker异常退出的, 由定时任务每
+  settings.MODERATION_REQUEUE_INTERVAL秒把提交超过MODERATION_STALE_SECONDS秒仍为PENDING的重新投递,
+  超过MODERATION_REQUEUE_MAX_AGE秒的不再投递, 需要人工处理
+私信的审核见chat.manager.chat_manager.moderate_chat_record
+"""
+import datetime
+
+from api.manager.positon_manager import add_footprint_location
+from footprint.consts import AuditStatus
+from footprint.manager.footprint_manager import add_to_flow, get_footprint_by_id_db, update_comment_num_db
+from footprint.models import Comment, FlowType, Footprint
+from log_utils.loggers import info_logger
+from utilities.content_check import get_content_verdict
+from utilities.image_check import get_images_verdict
+
+# 第一次重试的等待时间, 之后每次翻倍: 10s, 20s, ..., 共约5分钟
+MODERATION_RETRY_DELAY = 10
+MODERATION_MAX_RETRIES = 5
+# 需要大于所有重试的等待时间之和, 避免重试还没结束就被重新投递
+MODERATION_STALE_SECONDS = 10 * 60
+MODERATION_REQUEUE_MAX_AGE = 24 * 60 * 60
+# 每次定时任务最多重新投递的数量, 新提交的优先
+MODERATION_REQUEUE_BATCH = 200
+
+
+def get_footprint_verdict(content, image_list):
+    """
+    :return: 正文和所有图片都合规为True, 任意一项不合规为False, 没有不合规但检测接口出错为None
+    """
+    content_verdict = get_content_verdict(content) if content else True
+    if content_verdict is False:
+        return False
+    images_verdict = get_images_verdict(image_list)
+    if images_verdict is False:
+        return False
+    return None if content_verdict is None or images_verdict is None else True
+
+
+def finish_audit_db(model, item_id, passed):
+    """
+    审核中的内容更新为审核结果
+    :return: 更新后的状态, 内容不存在或已经审核过时返回None
+    """
+    audit_status = AuditStatus.PASSED if passed else AuditStatus.REJECTED
+    updated = model.objects.filter(id=item_id, audit_status=AuditStatus.PENDING).update(audit_status=audit_status)
+    return audit_status if updated else None
+
+
+def moderate_footprint(footprint_id):
+    """
+    审核足迹, 通过后进入发现页和附近
+    :return: 审核结果, 检测接口出错时为AuditStatus.PENDING(需要重试), 不需要审核时返回None
+    """
+    footprint = get_footprint_by_id_db(footprint_id)
+    if footprint is None or footprint.audit_status != AuditStatus.PENDING:
+        return None
+    verdict = get_footprint_verdict(footprint.content, footprint.image_list)
+    if verdict is None:
+        return AuditStatus.PENDING
+    audit_status = finish_audit_db(Footprint, footprint_id, verdict)
+    if audit_status == AuditStatus.PASSED:
+        add_to_flow(footprint.id, FlowType.FOOTPRINT)
+        add_footprint_location(footprint)
+    return audit_status
+
+
+def moderate_comment(comment_id):
+    """
+    审核评论, 通过后计入评论数
+    :return: 审核结果, 检测接口出错时为AuditStatus.PENDING(需要重试), 不需要审核时返回None
+    """
+    comment = Comment.objects.filter(id=comment_id, audit_status=AuditStatus.PENDING).first()
+    if comment is None:
+        return None
+    verdict = get_content_verdict(comment.comment)
+    if verdict is None:
+        return AuditStatus.PENDING
+    audit_status = finish_audit_db(Comment, comment_id, verdict)
+    if audit_status == AuditStatus.PASSED:
+        update_comment_num_db(comment.flow_id)
+    return audit_status
+
+
+def run_moderation_task(task, moderate, *args):
+    """
+    在celery任务(bind=True)中执行审核, 检测接口出错或抛出异常时按指数退避重试
+    :param moderate: moderate_footprint等审核函数
+    """
+    countdown = MODERATION_RETRY_DELAY * 2 ** task.request.retries
+    try:
+        audit_status = moderate(*args)
+    except Exception as e:
+        info_logger.info('{}{} failed: {}'.format(moderate.__name__, args, e))
+        raise task.retry(exc=e, countdown=countdown, max_retries=MODERATION_MAX_RETRIES)
+    if audit_status == AuditStatus.PENDING:
+        raise task.retry(countdown=countdown, max_retries=MODERATION_MAX_RETRIES)
+    return audit_status
+
+
+def get_stale_pending_ids_db(model):
+    """
+    提交超过MODERATION_STALE_SECONDS秒仍在审核中的内容, 不包括超过MODERATION_REQUEUE_MAX_AGE秒的
+    :return: [id], 新提交的在前, 最多MODERATION_REQUEUE_BATCH个
+    """
+    now = datetime.datetime.now()
+    created_range = (now - datetime.timedelta(seconds=MODERATION_REQUEUE_MAX_AGE),
+                     now - datetime.timedelta(seconds=MODERATION_STALE_SECONDS))
+    return list(model.objects.filter(audit_status=AuditStatus.PENDING, created_time__range=created_range)
+                .order_by('-id').values_list('id', flat=True)[:MODERATION_REQUEUE_BATCH])
@@ -3,8 +3,10 @@ import json
 from django.contrib.auth.models import User
 from django.db import models
 
+from footprint.consts import AuditStatus
 from user_info.consts import SexChoices
 from utilities.enum import EnumBase, EnumItem
+from utilities.geo import encode_geohash
 
 
 class FlowType(EnumBase):
@@ -21,6 +23,10 @@ class TotalFlow(models.Model):
     created_time = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # 游标翻页使用
+        indexes = [models.Index(fields=['-created_time', '-id'])]
+
 
 class Footprint(models.Model):
     """
@@ -32,6 +38,10 @@ class Footprint(models.Model):
     sex = models.CharField(choices=SexChoices, verbose_name=u'性别', max_length=10)
     lat = models.CharField(max_length=20, verbose_name=u'维度', null=True, blank=True)
     lon = models.CharField(max_length=20, verbose_name=u'经度', null=True, blank=True)
+    # 由lat/lon在save时生成, 用于数据库中的范围过滤
+    latitude = models.FloatField(verbose_name=u'纬度数值', null=True, blank=True)
+    longitude = models.FloatField(verbose_name=u'经度数值', null=True, blank=True)
+    geohash = models.CharField(max_length=12, verbose_name=u'geohash', default='', blank=True, db_index=True)
     location = models.CharField(max_length=50, verbose_name=u'地点', null=True, blank=True)
     content = models.CharField(max_length=200, verbose_name=u'痕迹内容')
     image_list_str = models.TextField(verbose_name=u'图片列表json')
@@ -39,6 +49,8 @@ class Footprint(models.Model):
     comment_num = models.PositiveIntegerField(default=0, verbose_name=u'评论数')
     forward_num = models.PositiveIntegerField(default=0, verbose_name=u'转发数')
     hide = models.BooleanField(default=False, verbose_name=u'是否只有自己能看到')
+    # 审核通过后才进入发现页和附近, @see footprint.manager.moderation_manager
+    audit_status = models.SmallIntegerField(choices=AuditStatus, default=AuditStatus.PASSED, verbose_name=u'审核状态')
     created_time = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
@@ -50,17 +62,45 @@ class Footprint(models.Model):
     def image_list(self, image_list):
         self.image_list_str = json.dumps(image_list)
 
+    def sync_geo_fields(self):
+        """
+        根据lat/lon字符串更新数值坐标和geohash
+        """
+        try:
+            self.latitude, self.longitude = float(self.lat), float(self.lon)
+        except (TypeError, ValueError):
+            self.latitude, self.longitude, self.geohash = None, None, ''
+        else:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         created = not self.id
+        self.sync_geo_fields()
+        if update_fields is not None and {'lat', 'lon'} & set(update_fields):
+            update_fields = set(update_fields) | {'latitude', 'longitude', 'geohash'}
         super(Footprint, self).save(force_insert, force_update, using, update_fields)
-        if created:
+        if not created:
+            from footprint.manager.flow_card_manager import invalidate_flow_cards
+            invalidate_flow_cards((self.id, FlowType.FOOTPRINT))
+        elif self.audit_status == AuditStatus.PASSED:
             from footprint.manager.footprint_manager import add_to_flow
             add_to_flow(self.id, FlowType.FOOTPRINT)
 
+    def delete(self, using=None, keep_parents=False):
+        footprint_id = self.id
+        result = super(Footprint, self).delete(using, keep_parents)
+        from api.manager.positon_manager import on_footprint_deleted
+        from footprint.manager.footprint_manager import remove_from_flow
+        on_footprint_deleted(footprint_id, self.user_id)
+        remove_from_flow(footprint_id, FlowType.FOOTPRINT)
+        return result
+
     class Meta:
         verbose_name = u'足迹'
         verbose_name_plural = u'足迹'
+        # 用户足迹游标翻页使用
+        indexes = [models.Index(fields=['user', '-created_time', '-id'])]
 
 
 class Comment(models.Model):
@@ -76,6 +116,7 @@ class Comment(models.Model):
     image_list = models.CharField(max_length=1000, default='[]', help_text=u'评论附带图片')
 
     is_deleted = models.BooleanField(default=False)
+    audit_status = models.SmallIntegerField(choices=AuditStatus, default=AuditStatus.PASSED, verbose_name=u'审核状态')
     created_time = models.DateTimeField(auto_now_add=True, db_index=True)
     last_modified = models.DateTimeField(auto_now=True)
 
@@ -96,6 +137,10 @@ class Favor(models.Model):
     created_time = models.DateTimeField(auto_now_add=True, db_index=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # 用户是否点赞、批量查询点赞状态使用
+        indexes = [models.Index(fields=['user_id', 'flow_id', 'flow_type'])]
+
 
 class FootprintFavor(models.Model):
     """
@@ -0,0 +1,55 @@
+from celery_apps import app
+from footprint.manager.favor_manager import sync_favor_db
+from footprint.manager.flow_counter_manager import flush_flow_counters
+from footprint.models import Comment, Footprint
+
+
+@app.task
+def flush_flow_counters_task():
+    """
+    定时将redis中缓冲的计数写回数据库, 周期见settings.COUNTER_FLUSH_INTERVAL
+    """
+    return flush_flow_counters()
+
+
+@app.task
+def sync_favor_task(flow_id, flow_type, user_id, favored, toggled_at):
+    """
+    点赞状态写入Favor表
+    """
+    sync_favor_db(flow_id, flow_type, user_id, favored, toggled_at)
+
+
+@app.task(bind=True)
+def moderate_footprint_task(self, footprint_id):
+    """
+    异步审核足迹, 检测接口出错时重试, @see footprint.manager.moderation_manager
+    """
+    # moderation_manager依赖footprint_manager, 后者引用了本模块
+    from footprint.manager.moderation_manager import moderate_footprint, run_moderation_task
+    return run_moderation_task(self, moderate_footprint, footprint_id)
+
+
+@app.task(bind=True)
+def moderate_comment_task(self, comment_id):
+    """
+    异步审核评论
+    """
+    from footprint.manager.moderation_manager import moderate_comment, run_moderation_task
+    return run_moderation_task(self, moderate_comment, comment_id)
+
+
+@app.task
+def requeue_pending_moderation_task():
+    """
+    定时重新投递长时间仍在审核中的足迹和评论, 周期见settings.MODERATION_REQUEUE_INTERVAL
+    :return: 重新投递的数量
+    """
+    from footprint.manager.moderation_manager import get_stale_pending_ids_db
+    footprint_ids = get_stale_pending_ids_db(Footprint)
+    for footprint_id in footprint_ids:
+        moderate_footprint_task.delay(footprint_id)
+    comment_ids = get_stale_pending_ids_db(Comment)
+    for comment_id in comment_ids:
+        moderate_comment_task.delay(comment_id)
+    return len(footprint_ids) + len(comment_ids)
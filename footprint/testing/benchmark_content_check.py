@@ -0,0 +1,79 @@
+"""
+内容审核缓存的基准测试, 不在单元测试中运行, 需要时手动执行:
+python manage.py test --settings=settings-test footprint.testing.benchmark_content_check
+"""
+import time
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from api.testing import mock
+from footprint.testing.test_content_check import CHECK_LATENCY, _mock_check_response, _mock_image_check, \
+    get_view_requests
+from redis_utils.container.api_redis_client import redis
+from utilities.content_check import _local_verdicts
+from utilities.image_check import are_images_valid, image_verdict_cache
+from utilities.mock_utility.helper import create_user_login_client
+
+
+@patch('utilities.content_check.get_access_token', return_value='token')
+class ContentCheckBenchmark(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.benchmark_content_check.ContentCheckBenchmark
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        _local_verdicts.clear()
+
+    def test_view_latency(self, _):
+        """
+        模拟检测接口延迟CHECK_LATENCY, 相同文本第一次与之后的接口耗时
+        python manage.py test --settings=settings-test footprint.testing.benchmark_content_check.ContentCheckBenchmark.test_view_latency
+        """
+        client, user = create_user_login_client()
+        receiver_client, receiver = create_user_login_client()
+        footprint = mock.create_footprint(mock.create_user_info(user))
+        with patch('utilities.content_check.requests.post', _mock_check_response()):
+            for name, request in zip(('comment_footprint_view', 'post_content_view'),
+                                     get_view_requests(client, footprint, receiver)):
+                costs = []
+                for _ in range(3):
+                    start = time.perf_counter()
+                    request()
+                    costs.append(time.perf_counter() - start)
+                print('{}: check latency {:.0f}ms, first {:.1f}ms, cached {:.1f}ms'.format(
+                    name, CHECK_LATENCY * 1000, costs[0] * 1000, max(costs[1:]) * 1000))
+
+
+class ImageCheckBenchmark(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.benchmark_content_check.ImageCheckBenchmark
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        image_verdict_cache.local.clear()
+
+    def test_batch_image_check(self):
+        """
+        模拟七牛延迟CHECK_LATENCY, 9张图串行审核、并发审核与再次审核的耗时
+        python manage.py test --settings=settings-test footprint.testing.benchmark_content_check.ImageCheckBenchmark.test_batch_image_check
+        """
+        images = ['https://image.zongzong.com/benchmark/{}.jpg'.format(index) for index in range(9)]
+        with patch('utilities.image_check._check_image', _mock_image_check()) as check:
+            start = time.perf_counter()
+            for image in images:
+                check(image)
+            serial_cost = time.perf_counter() - start
+
+            start = time.perf_counter()
+            are_images_valid(images)
+            concurrent_cost = time.perf_counter() - start
+
+            image_verdict_cache.local.clear()
+            start = time.perf_counter()
+            are_images_valid(images)
+            cached_cost = time.perf_counter() - start
+        print('9 images: serial {:.1f}ms, concurrent {:.1f}ms, cached {:.1f}ms'.format(
+            serial_cost * 1000, concurrent_cost * 1000, cached_cost * 1000))
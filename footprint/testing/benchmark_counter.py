@@ -0,0 +1,42 @@
+"""
+计数写入的基准测试, 不在单元测试中运行, 需要时手动执行:
+python manage.py test --settings=settings-test footprint.testing.benchmark_counter
+"""
+import time
+
+from django.test import TransactionTestCase, override_settings
+
+from api.testing import mock
+from footprint.manager.flow_counter_manager import flush_flow_counters
+from footprint.manager.footprint_manager import update_footprint_favor_num_db
+from redis_utils.container.api_redis_client import redis
+from utilities.mock_utility.mock import create_user
+
+
+class WriteBehindBenchmark(TransactionTestCase):
+    """
+    同步写数据库与write-behind的吞吐对比
+    python manage.py test --settings=settings-test footprint.testing.benchmark_counter.WriteBehindBenchmark
+    """
+    TIMES = 2000
+
+    def setUp(self):
+        redis.flushdb()
+
+    def test_write_behind_benchmark(self):
+        """
+        python manage.py test --settings=settings-test footprint.testing.benchmark_counter.WriteBehindBenchmark.test_write_behind_benchmark
+        """
+        footprint = mock.create_footprint(mock.create_user_info(create_user()))
+        favor_num = footprint.favor_num
+        for write_behind in (False, True):
+            with override_settings(COUNTER_WRITE_BEHIND=write_behind):
+                start = time.time()
+                for _ in range(self.TIMES):
+                    update_footprint_favor_num_db(footprint.id, 1)
+                flush_flow_counters()
+                cost = time.time() - start
+            print('write_behind: {:<5}  {} favors in {:.3f}s, {:.0f}/s'.format(
+                str(write_behind), self.TIMES, cost, self.TIMES / cost))
+        footprint.refresh_from_db()
+        self.assertEqual(footprint.favor_num, favor_num + 2 * self.TIMES)
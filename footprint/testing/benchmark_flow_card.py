@@ -0,0 +1,58 @@
+"""
+卡片查库方式的基准测试, 不在单元测试中运行, 需要时手动执行:
+python manage.py test --settings=settings-test footprint.testing.benchmark_flow_card
+"""
+import time
+import tracemalloc
+
+from django.test import TestCase
+
+from api.testing import mock
+from commercial.manager.db_manager import get_commercial_activities_by_ids_db
+from commercial.models import CommercialActivity
+from commercial.testing.mock import create_activity
+from footprint.manager.footprint_manager import get_footprints_by_ids_db
+from footprint.models import Footprint
+from redis_utils.container.api_redis_client import redis
+from utilities.mock_utility.mock import create_user
+
+
+class ProjectionBenchmark(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.benchmark_flow_card.ProjectionBenchmark
+    """
+
+    def setUp(self):
+        redis.flushdb()
+
+    def test_projection_benchmark(self):
+        """
+        一页卡片用完整Model与列投影的耗时和内存对比
+        python manage.py test --settings=settings-test footprint.testing.benchmark_flow_card.ProjectionBenchmark.test_projection_benchmark
+        """
+        user_info = mock.create_user_info(create_user())
+        footprint_ids = [mock.create_footprint(user_info).id for _ in range(20)]
+        activity_ids = [create_activity().id for _ in range(20)]
+        # 活动详情通常是很长的图文
+        CommercialActivity.objects.update(detail='详细描述' * 5000)
+        times = 50
+        loaders = (
+            ('model', lambda: (list(Footprint.objects.filter(id__in=footprint_ids)),
+                               list(CommercialActivity.objects.filter(id__in=activity_ids).select_related('club')))),
+            ('projection', lambda: (get_footprints_by_ids_db(footprint_ids),
+                                    get_commercial_activities_by_ids_db(activity_ids))),
+        )
+        peaks = {}
+        for name, loader in loaders:
+            start = time.time()
+            for _ in range(times):
+                loader()
+            cost = (time.time() - start) * 1000 / times
+            tracemalloc.start()
+            page = loader()
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del page
+            print('{:<10}  20 footprints + 20 activities per page: {:.2f}ms, peak {:.0f}KB'.format(
+                name, cost, peaks[name] / 1024))
+        self.assertLess(peaks['projection'], peaks['model'])
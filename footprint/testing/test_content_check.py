@@ -0,0 +1,212 @@
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+import requests
+from django.test import TestCase
+
+from api.testing import mock
+from redis_utils.container.api_redis_client import redis
+from utilities.content_check import is_content_valid, get_content_verdict, content_verdict_hit_counter, \
+    _local_verdicts, get_content_digest, CONTENT_VERDICT_KEY, CONTENT_VALID_EXPIRE, CONTENT_INVALID_EXPIRE, \
+    RISKY_CONTENT_ERRCODE
+from utilities.image_check import are_images_valid, image_verdict_cache, get_images_verdict, IMAGE_CHECK_TIMEOUT
+from utilities.mock_utility.helper import create_user_login_client
+
+# 模拟微信msg_sec_check、七牛图片审核的一次往返
+CHECK_LATENCY = 0.2
+
+
+def _mock_check_response(errcode=0):
+    def post(*args, **kwargs):
+        time.sleep(CHECK_LATENCY)
+        response = MagicMock()
+        response.json.return_value = {'errcode': errcode, 'errmsg': 'ok' if errcode == 0 else 'risky'}
+        return response
+    return MagicMock(side_effect=post)
+
+
+@patch('utilities.content_check.get_access_token', return_value='token')
+class ContentVerdictCacheTest(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.test_content_check.ContentVerdictCacheTest
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        _local_verdicts.clear()
+
+    def test_verdict_cache(self, _):
+        """
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ContentVerdictCacheTest.test_verdict_cache
+        """
+        self.assertEqual(get_content_digest(' 你好，世界\n'), get_content_digest('你好，世界'))
+        # 全角、空白不同的文本分别检测
+        self.assertNotEqual(get_content_digest('你好　 ，世界'), get_content_digest('你好 ,世界'))
+        content_verdict_hit_counter.clear()
+        with patch('utilities.content_check.requests.post', _mock_check_response()) as post:
+            self.assertTrue(is_content_valid('你好'))
+            self.assertTrue(is_content_valid(' 你好 '))
+            _local_verdicts.clear()
+            self.assertTrue(is_content_valid('你好'))
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(content_verdict_hit_counter.get_stats()['hit'], 1)
+        self.assertEqual(content_verdict_hit_counter.get_stats()['miss'], 1)
+        self.assertLessEqual(redis.ttl(CONTENT_VERDICT_KEY.format(get_content_digest('你好'))), CONTENT_VALID_EXPIRE)
+
+        # 违规的结论保存更久
+        with patch('utilities.content_check.requests.post', _mock_check_response(RISKY_CONTENT_ERRCODE)) as post:
+            self.assertFalse(is_content_valid('risky'))
+            self.assertFalse(is_content_valid('risky'))
+        self.assertEqual(post.call_count, 1)
+        self.assertGreater(redis.ttl(CONTENT_VERDICT_KEY.format(get_content_digest('risky'))), CONTENT_VALID_EXPIRE)
+        self.assertLessEqual(redis.ttl(CONTENT_VERDICT_KEY.format(get_content_digest('risky'))),
+                             CONTENT_INVALID_EXPIRE)
+
+        # 接口出错不缓存, 出错与违规区分开
+        with patch('utilities.content_check.requests.post', _mock_check_response(-1)) as post:
+            self.assertFalse(is_content_valid('error'))
+            self.assertIsNone(get_content_verdict('error'))
+        self.assertEqual(post.call_count, 2)
+        with patch('utilities.content_check.requests.post', side_effect=requests.Timeout()):
+            self.assertIsNone(get_content_verdict('timeout'))
+
+    def test_view_verdict_cache(self, _):
+        """
+        相同文本第二次起不再请求检测接口
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ContentVerdictCacheTest.test_view_verdict_cache
+        """
+        client, user = create_user_login_client()
+        receiver_client, receiver = create_user_login_client()
+        footprint = mock.create_footprint(mock.create_user_info(user))
+        for request in get_view_requests(client, footprint, receiver):
+            with patch('utilities.content_check.requests.post', _mock_check_response()) as post:
+                for _ in range(3):
+                    self.assertEqual(request()['error_code'], 0)
+            self.assertEqual(post.call_count, 1)
+
+
+def get_view_requests(client, footprint, receiver):
+    """
+    需要检测文本的接口, 评论和私信各一次请求
+    """
+    return [
+        lambda: client.json_post('/footprint/comment/', {'footprint_id': footprint.id, 'comment': '赞'}),
+        lambda: client.json_raw_post(
+            '/chat/post_content/', {'receiver_id': receiver.id, 'content_json': {'type': 'text', 'text': '在吗'}}),
+    ]
+
+
+def _mock_image_check(rejected=(), failed=(), latency=CHECK_LATENCY):
+    def check(image_url):
+        time.sleep(0 if image_url in rejected else latency)
+        if image_url in failed:
+            return None
+        return image_url not in rejected
+    return MagicMock(side_effect=check)
+
+
+class ImageCheckTest(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.test_content_check.ImageCheckTest
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        image_verdict_cache.local.clear()
+
+    def test_batch_image_check(self):
+        """
+        并发审核, 结论缓存
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ImageCheckTest.test_batch_image_check
+        """
+        images = ['https://image.zongzong.com/{}.jpg'.format(index) for index in range(9)]
+        # 9张图的审核同时进行时才能都通过栅栏, 串行审核会等待超时
+        barrier = threading.Barrier(len(images), timeout=IMAGE_CHECK_TIMEOUT / 2)
+
+        def check(image_url):
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                return None
+            return True
+
+        with patch('utilities.image_check._check_image', MagicMock(side_effect=check)) as check_image:
+            self.assertTrue(get_images_verdict(images + images[:3] + ['']))
+            self.assertEqual(check_image.call_count, 9)
+
+            image_verdict_cache.local.clear()
+            self.assertTrue(are_images_valid(images))
+            self.assertEqual(check_image.call_count, 9)
+
+    def test_short_circuit(self):
+        """
+        一张不通过立即返回, 不通过的结论被缓存, 接口出错的不缓存
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ImageCheckTest.test_short_circuit
+        """
+        # 取消不了的审核在后台完成后仍会写缓存, 与其他用例的图片区分开
+        images = ['https://image.zongzong.com/short_circuit/{}.jpg'.format(index) for index in range(9)]
+        release, finished = threading.Event(), []
+
+        def check(image_url):
+            if image_url == images[4]:
+                return False
+            release.wait(IMAGE_CHECK_TIMEOUT)
+            finished.append(image_url)
+            return True
+
+        with patch('utilities.image_check._check_image', MagicMock(side_effect=check)):
+            self.assertFalse(get_images_verdict(images))
+            # 返回时其他图片的审核还没有完成
+            self.assertEqual(finished, [])
+            release.set()
+        with patch('utilities.image_check._check_image', _mock_image_check()) as check:
+            self.assertFalse(are_images_valid([images[4]]))
+            self.assertEqual(check.call_count, 0)
+
+        with patch('utilities.image_check._check_image', _mock_image_check(failed=['error.jpg'], latency=0)) as check:
+            self.assertFalse(are_images_valid(['error.jpg']))
+            self.assertFalse(are_images_valid(['error.jpg']))
+            self.assertEqual(check.call_count, 2)
+        # 出错与不通过区分开
+        with patch('utilities.image_check._check_image', _mock_image_check(
+                rejected=['rejected.jpg'], failed=['error.jpg', 'error2.jpg'], latency=0)):
+            self.assertIsNone(get_images_verdict(['error.jpg', 'error2.jpg', 'pass.jpg']))
+            self.assertFalse(get_images_verdict(['error.jpg', 'rejected.jpg']))
+
+    def test_check_timeout_and_error(self):
+        """
+        请求七牛有单独的超时, 只有一张图时也有等待上限, 接口异常按出错处理
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ImageCheckTest.test_check_timeout_and_error
+        """
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'result': {'suggestion': 'pass'}}
+        with patch('utilities.image_check.requests.post', return_value=response) as post:
+            self.assertTrue(get_images_verdict(['pass.jpg']))
+        self.assertEqual(post.call_args[1]['timeout'], IMAGE_CHECK_TIMEOUT)
+
+        response.json.return_value = {'error': 'bad response'}
+        with patch('utilities.image_check.requests.post', return_value=response):
+            self.assertIsNone(get_images_verdict(['bad_response.jpg']))
+        with patch('utilities.image_check.requests.post', side_effect=requests.Timeout()):
+            self.assertIsNone(get_images_verdict(['timeout.jpg', 'timeout2.jpg']))
+
+        with patch('utilities.image_check.IMAGE_CHECK_TIMEOUT', 0.05), \
+                patch('utilities.image_check._check_image', _mock_image_check(latency=0.5)):
+            self.assertIsNone(get_images_verdict(['slow.jpg']))
+
+    def test_avatar_and_chat_image(self):
+        """
+        修改资料和发送图片消息使用同一个审核缓存
+        python manage.py test --settings=settings-test footprint.testing.test_content_check.ImageCheckTest.test_avatar_and_chat_image
+        """
+        client, user = create_user_login_client()
+        receiver_client, receiver = create_user_login_client()
+        mock.create_user_info(user)
+        with patch('utilities.image_check._check_image', _mock_image_check(latency=0)) as check:
+            result = client.json_post('/user_info/my_profile/edit/', {'avatar': 'avatar.jpg'})
+            self.assertEqual(result['error_code'], 0)
+            result = client.json_raw_post('/chat/post_content/', {
+                'receiver_id': receiver.id, 'content_json': {'type': 'image', 'url': 'avatar.jpg'}})
+            self.assertEqual(result['error_code'], 0)
+            self.assertEqual(check.call_count, 1)
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+
+from api.testing import mock
+from commercial.manager.activity_manager import participate_activity
+from commercial.models import ActivityParticipant
+from commercial.testing.mock import create_activity
+from footprint.manager.flow_card_manager import get_flow_cards
+from footprint.manager.flow_counter_manager import flush_flow_counters, FLOW_COUNTER_PROCESSING_KEY, \
+    FLOW_COUNTER_PENDING_KEY, FLOW_COUNTER_FLUSH_LOCK_KEY, flow_counter_flush_lock
+from footprint.manager.footprint_manager import update_footprint_favor_num_db, update_comment_num_db, \
+    update_activity_favor_num
+from footprint.models import Footprint, FlowType
+from redis_utils.container.api_redis_client import redis
+from utilities.mock_utility.mock import create_user
+
+
+class TestCounterConcurrency(TransactionTestCase):
+    """
+    计数字段并发更新不丢失
+    python manage.py test --settings=settings-test footprint.testing.test_counter.TestCounterConcurrency
+    """
+    THREAD_NUM = 8
+    TIMES_PER_THREAD = 25
+
+    def setUp(self):
+        redis.flushdb()
+
+    def _run_concurrently(self, func, times):
+        def worker(index):
+            try:
+                return func(index)
+            finally:
+                # 每个线程有自己的数据库连接, 用完需要关闭
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.THREAD_NUM) as executor:
+            return list(executor.map(worker, range(times)))
+
+    @override_settings(COUNTER_WRITE_BEHIND=False)
+    def test_favor_and_comment_num(self):
+        """
+        直接写数据库
+        python manage.py test --settings=settings-test footprint.testing.test_counter.TestCounterConcurrency.test_favor_and_comment_num
+        """
+        footprint = mock.create_footprint(mock.create_user_info(create_user()))
+        Footprint.objects.filter(id=footprint.id).update(favor_num=0, comment_num=0)
+        times = self.THREAD_NUM * self.TIMES_PER_THREAD
+
+        favor_nums = self._run_concurrently(lambda _: update_footprint_favor_num_db(footprint.id, 1), times)
+        comment_nums = self._run_concurrently(lambda _: update_comment_num_db(footprint.id), times)
+        footprint.refresh_from_db()
+        self.assertEqual(footprint.favor_num, times)
+        self.assertEqual(footprint.comment_num, times)
+        # 每次返回的都是各自更新后的值
+        self.assertEqual(sorted(favor_nums), list(range(1, times + 1)))
+        self.assertEqual(sorted(comment_nums), list(range(1, times + 1)))
+
+        self.assertEqual(update_footprint_favor_num_db(footprint.id, -times - 1), 0)
+        self.assertIsNone(update_footprint_favor_num_db(footprint.id + 1, 1))
+
+    def test_participate_within_quota(self):
+        """
+        python manage.py test --settings=settings-test footprint.testing.test_counter.TestCounterConcurrency.test_participate_within_quota
+        """
+        activity = create_activity()
+        activity.participant_num, activity.total_quota = 0, 10
+        activity.save()
+        user_info_ids = [mock.create_user_info(create_user()).id for _ in range(self.THREAD_NUM * 3)]
+
+        results = self._run_concurrently(
+            lambda index: participate_activity(activity.id, user_info_ids[index], 'name', '110', 1, ''),
+            len(user_info_ids))
+        activity.refresh_from_db()
+        self.assertEqual(activity.participant_num, 10)
+        self.assertEqual(results.count(''), 10)
+        self.assertEqual(ActivityParticipant.objects.filter(activity_id=activity.id).count(), 10)
+        self.assertEqual(participate_activity(activity.id, user_info_ids[0], 'name', '110', 1, ''), '人数已满')
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind(self):
+        """
+        计数先写redis, flush后批量写回数据库
+        python manage.py test --settings=settings-test footprint.testing.test_counter.TestCounterConcurrency.test_write_behind
+        """
+        footprint = mock.create_footprint(mock.create_user_info(create_user()))
+        Footprint.objects.filter(id=footprint.id).update(favor_num=0, comment_num=3)
+        activity = create_activity()
+        times = self.THREAD_NUM * self.TIMES_PER_THREAD
+
+        self._run_concurrently(lambda _: update_footprint_favor_num_db(footprint.id, 1), times)
+        self.assertEqual(update_comment_num_db(footprint.id, -1), 2)
+        self.assertEqual(update_activity_favor_num(activity.id, 2), activity.favor_num + 2)
+        # 写回之前: 数据库不变, 读到的是数据库的值加上缓冲
+        footprint.refresh_from_db()
+        self.assertEqual((footprint.favor_num, footprint.comment_num), (0, 3))
+        card = get_flow_cards([(footprint.id, FlowType.FOOTPRINT)])[(footprint.id, FlowType.FOOTPRINT)]
+        self.assertEqual((card['favor_num'], card['comment_num']), (times, 2))
+
+        # BEGIN + 每个Model一条UPDATE
+        with self.assertNumQueries(3):
+            self.assertEqual(flush_flow_counters(), 2)
+        footprint.refresh_from_db()
+        activity_favor_num = activity.favor_num
+        activity.refresh_from_db()
+        self.assertEqual((footprint.favor_num, footprint.comment_num), (times, 2))
+        self.assertEqual(activity.favor_num, activity_favor_num + 2)
+        card = get_flow_cards([(footprint.id, FlowType.FOOTPRINT)])[(footprint.id, FlowType.FOOTPRINT)]
+        self.assertEqual((card['favor_num'], card['comment_num']), (times, 2))
+        self.assertEqual(flush_flow_counters(), 0)
+
+        # 上次flush在写数据库之前失败, 遗留的processing会在下次flush时写回
+        update_footprint_favor_num_db(footprint.id, 1)
+        redis.rename(FLOW_COUNTER_PENDING_KEY, FLOW_COUNTER_PROCESSING_KEY)
+        update_footprint_favor_num_db(footprint.id, 1)
+        self.assertEqual(get_flow_cards([(footprint.id, FlowType.FOOTPRINT)])[(footprint.id, FlowType.FOOTPRINT)]
+                         ['favor_num'], times + 2)
+        self.assertEqual(flush_flow_counters(), 1)
+        self.assertEqual(flush_flow_counters(), 1)
+        footprint.refresh_from_db()
+        self.assertEqual(footprint.favor_num, times + 2)
+
+    def test_flush_lock(self):
+        """
+        flush的锁只由持有者释放, 超时后不会删掉下一个flush的锁
+        python manage.py test --settings=settings-test footprint.testing.test_counter.TestCounterConcurrency.test_flush_lock
+        """
+        token = flow_counter_flush_lock.acquire()
+        self.assertIsNone(flow_counter_flush_lock.acquire())
+        self.assertEqual(flush_flow_counters(), 0)
+        self.assertEqual(redis.get(FLOW_COUNTER_FLUSH_LOCK_KEY), token.encode('utf-8'))
+
+        # 锁过期后被下一个flush持有, 之前的持有者释放时不会删掉它
+        redis.delete(FLOW_COUNTER_FLUSH_LOCK_KEY)
+        next_token = flow_counter_flush_lock.acquire()
+        self.assertFalse(flow_counter_flush_lock.release(token))
+        self.assertEqual(redis.get(FLOW_COUNTER_FLUSH_LOCK_KEY), next_token.encode('utf-8'))
+        self.assertTrue(flow_counter_flush_lock.release(next_token))
+        self.assertFalse(redis.exists(FLOW_COUNTER_FLUSH_LOCK_KEY))
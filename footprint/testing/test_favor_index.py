@@ -0,0 +1,85 @@
+import time
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from api.testing import mock
+from commercial.testing.mock import create_activity
+from footprint.manager.favor_manager import is_user_favored, get_favored_flows, is_favor_index_ready, \
+    sync_favor_db, toggle_favor, FAVOR_USERS_KEY
+from footprint.models import Favor, FlowType
+from redis_utils.container.api_redis_client import redis
+from utilities.mock_utility.helper import create_user_login_client
+
+
+class TestFavorIndex(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.test_favor_index.TestFavorIndex
+    """
+    def setUp(self):
+        redis.flushdb()
+
+    def test_favor_index(self):
+        """
+        python manage.py test --settings=settings-test footprint.testing.test_favor_index.TestFavorIndex.test_favor_index
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint = mock.create_footprint(user_info)
+        activity = create_activity()
+        footprint_pair, activity_pair = (footprint.id, FlowType.FOOTPRINT), (activity.id, FlowType.ACTIVITY)
+
+        # 索引未建立: 读写都走数据库
+        self.assertFalse(is_favor_index_ready())
+        client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        self.assertTrue(Favor.objects.get(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT).favored)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_favored_flows(user.id, [footprint_pair, activity_pair]), {footprint_pair})
+
+        call_command('rebuild_favor_index', stdout=open('/dev/null', 'w'))
+        self.assertTrue(is_favor_index_ready())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_favored_flows(user.id, [footprint_pair, activity_pair]), {footprint_pair})
+            self.assertTrue(is_user_favored(user.id, footprint.id, FlowType.FOOTPRINT))
+            self.assertFalse(is_user_favored(user.id, activity.id, FlowType.ACTIVITY))
+
+        # 索引建立后: 以redis为准, Favor表由异步任务写入
+        client.json_post('/commercial/favor_activity/', {'activity_id': activity.id})
+        client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_favored_flows(user.id, [footprint_pair, activity_pair]), {activity_pair})
+        self.assertFalse(Favor.objects.get(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT).favored)
+        self.assertTrue(Favor.objects.get(flow_id=activity.id, flow_type=FlowType.ACTIVITY).favored)
+
+        # redis数据丢失后从数据库重建
+        redis.flushdb()
+        self.assertEqual(get_favored_flows(user.id, [footprint_pair, activity_pair]), {activity_pair})
+        call_command('rebuild_favor_index', stdout=open('/dev/null', 'w'))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_favored_flows(user.id, [footprint_pair, activity_pair]), {activity_pair})
+
+    def test_sync_favor(self):
+        """
+        Favor表写入点赞时的结果, 不回读redis, 乱序执行以点赞时间较新的为准
+        python manage.py test --settings=settings-test footprint.testing.test_favor_index.TestFavorIndex.test_sync_favor
+        """
+        client, user = create_user_login_client()
+        footprint = mock.create_footprint(mock.create_user_info(user))
+        call_command('rebuild_favor_index', stdout=open('/dev/null', 'w'))
+        client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        # 集合被淘汰后点赞记录不受影响
+        redis.delete(FAVOR_USERS_KEY.format(FlowType.FOOTPRINT, footprint.id))
+        sync_favor_db(footprint.id, FlowType.FOOTPRINT, user.id, True, time.time())
+        self.assertTrue(Favor.objects.get(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT).favored)
+
+        now = time.time()
+        sync_favor_db(footprint.id, FlowType.FOOTPRINT, user.id, False, now + 2)
+        sync_favor_db(footprint.id, FlowType.FOOTPRINT, user.id, True, now + 1)
+        self.assertFalse(Favor.objects.get(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT).favored)
+        sync_favor_db(footprint.id, FlowType.ACTIVITY, user.id, False, now + 2)
+        sync_favor_db(footprint.id, FlowType.ACTIVITY, user.id, True, now + 1)
+        self.assertFalse(Favor.objects.get(flow_id=footprint.id, flow_type=FlowType.ACTIVITY).favored)
+
+        # 连续点击每次都在上一次的基础上切换
+        self.assertEqual([toggle_favor(footprint.id, FlowType.FOOTPRINT, user.id) for _ in range(3)],
+                         [True, False, True])
@@ -0,0 +1,137 @@
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from api.testing import mock
+from commercial.testing.mock import create_activity
+from footprint.manager.flow_card_manager import flow_card_hit_counter, get_flow_cards, _get_card_key, _load_cards_db
+from footprint.manager.flow_timeline_manager import rebuild_flow_timeline
+from footprint.manager.footprint_manager import update_comment_num_db, get_footprints_by_ids_db
+from footprint.models import FlowType, TotalFlow
+from redis_utils.container.api_redis_client import redis
+from utilities.mock_utility.helper import create_user_login_client
+from utilities.mock_utility.mock import create_user
+
+
+class TestFlowCard(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard
+    """
+    def setUp(self):
+        redis.flushdb()
+        rebuild_flow_timeline()
+
+    def test_discovery_use_card_cache(self):
+        """
+        第二次请求不再查询足迹表, 命中率统计正确
+        python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard.test_discovery_use_card_cache
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        for _ in range(3):
+            mock.create_footprint(user_info)
+
+        items = client.json_get('/api/discovery/')['items']
+        self.assertEqual(len(items), 3)
+        self.assertEqual(flow_card_hit_counter.get_stats(), {'hit': 0, 'miss': 3, 'hit_ratio': 0})
+
+        with CaptureQueriesContext(connection) as queries:
+            cached_items = client.json_get('/api/discovery/')['items']
+        self.assertEqual(cached_items, items)
+        self.assertFalse(any('footprint_footprint' in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(flow_card_hit_counter.get_stats(), {'hit': 3, 'miss': 3, 'hit_ratio': 0.5})
+
+        staff = create_user()
+        staff.is_staff = True
+        staff.save()
+        staff_client, _ = create_user_login_client(staff)
+        result = staff_client.json_get('/api/cache_stats/')
+        self.assertEqual(result['flow_card']['hit_ratio'], 0.5)
+
+    def test_invalidate_on_save(self):
+        """
+        点赞、评论数变化、修改足迹后卡片失效
+        python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard.test_invalidate_on_save
+        """
+        client, user = create_user_login_client()
+        user_info = mock.create_user_info(user)
+        footprint = mock.create_footprint(user_info)
+        flow_pair = (footprint.id, FlowType.FOOTPRINT)
+        card = get_flow_cards([flow_pair])[flow_pair]
+        self.assertEqual(card['favor_num'], footprint.favor_num)
+
+        result = client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        self.assertEqual(get_flow_cards([flow_pair])[flow_pair]['favor_num'], result['favor_num'])
+
+        update_comment_num_db(footprint.id)
+        self.assertEqual(get_flow_cards([flow_pair])[flow_pair]['comment_num'], footprint.comment_num + 1)
+
+        footprint.refresh_from_db()
+        footprint.content = '修改后的内容'
+        footprint.save()
+        self.assertEqual(get_flow_cards([flow_pair])[flow_pair]['content'], '修改后的内容')
+
+    def test_invalidate_on_delete(self):
+        """
+        删除足迹、活动后卡片失效, 并从发现页时间线中删除
+        python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard.test_invalidate_on_delete
+        """
+        client, user = create_user_login_client()
+        footprint = mock.create_footprint(mock.create_user_info(user))
+        activity = create_activity()
+        flow_pairs = [(footprint.id, FlowType.FOOTPRINT), (activity.id, FlowType.ACTIVITY)]
+        self.assertEqual(len(client.json_get('/api/discovery/')['items']), 2)
+        self.assertTrue(all(redis.exists(_get_card_key(*flow_pair)) for flow_pair in flow_pairs))
+
+        footprint.delete()
+        activity.delete()
+        self.assertFalse(any(redis.exists(_get_card_key(*flow_pair)) for flow_pair in flow_pairs))
+        self.assertFalse(TotalFlow.objects.exists())
+        self.assertEqual(client.json_get('/api/discovery/')['items'], [])
+
+    def test_stale_write_back(self):
+        """
+        查库期间卡片被失效时不写回旧卡片
+        python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard.test_stale_write_back
+        """
+        footprint = mock.create_footprint(mock.create_user_info(create_user()))
+        flow_pair = (footprint.id, FlowType.FOOTPRINT)
+
+        def load_then_update(flow_pairs):
+            cards = _load_cards_db(flow_pairs)
+            update_comment_num_db(footprint.id)
+            return cards
+
+        with patch('footprint.manager.flow_card_manager._load_cards_db', side_effect=load_then_update):
+            self.assertEqual(get_flow_cards([flow_pair])[flow_pair]['comment_num'], footprint.comment_num)
+        self.assertFalse(redis.exists(_get_card_key(*flow_pair)))
+        self.assertEqual(get_flow_cards([flow_pair])[flow_pair]['comment_num'], footprint.comment_num + 1)
+        self.assertTrue(redis.exists(_get_card_key(*flow_pair)))
+
+    def test_projected_rows(self):
+        """
+        卡片只查询用到的列, 结果与完整的Model一致
+        python manage.py test --settings=settings-test footprint.testing.test_flow_card.TestFlowCard.test_projected_rows
+        """
+        footprint = mock.create_footprint(mock.create_user_info(create_user()))
+        activity = create_activity()
+        with CaptureQueriesContext(connection) as queries:
+            cards = get_flow_cards([(footprint.id, FlowType.FOOTPRINT), (activity.id, FlowType.ACTIVITY)])
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(any('"detail"' in query['sql'] for query in queries.captured_queries))
+
+        footprint.refresh_from_db()
+        footprint_card = cards[(footprint.id, FlowType.FOOTPRINT)]
+        for field in ('user_id', 'name', 'avatar', 'location', 'content', 'image_list', 'lat', 'lon', 'comment_num'):
+            self.assertEqual(footprint_card[field], getattr(footprint, field))
+        activity_card = cards[(activity.id, FlowType.ACTIVITY)]
+        self.assertEqual((activity_card['name'], activity_card['activity_name'], activity_card['location']),
+                         (activity.club.name, activity.name, activity.address))
+        self.assertEqual(activity_card['avatar'], activity.club.avatar.url if activity.club.avatar else '')
+
+        row = get_footprints_by_ids_db([footprint.id])[0]
+        with self.assertRaises(AttributeError):
+            row.extra = 1
+        self.assertIs(row.image_list, row.image_list)
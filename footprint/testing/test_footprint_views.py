@@ -1,11 +1,13 @@
 import json
 import random
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from api.testing import mock
+from footprint.manager.flow_counter_manager import flush_flow_counters
 from footprint.manager.footprint_manager import get_footprint_by_id_db
 from footprint.models import Footprint
+from redis_utils.container.api_redis_client import redis
 from utilities.mock_utility.helper import create_user_login_client
 
 
@@ -40,3 +42,25 @@ class TestFootprint(TestCase):
         client2.json_post('/footprint/favor/', {'footprint_id': footprint.id})
         footprint = get_footprint_by_id_db(footprint.id)
         self.assertEqual(footprint.favor_num, 0)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_favor_write_behind(self):
+        """
+        点赞数先累加在redis中, 写回数据库之前接口返回的已经是最新值
+        python manage.py test --settings=settings-test footprint.testing.test_footprint_views.TestFootprint.test_favor_write_behind
+        """
+        redis.flushdb()
+        client, user = create_user_login_client()
+        footprint = mock.create_footprint(mock.create_user_info(user))
+        favor_num = footprint.favor_num
+        result = client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        self.assertEqual(result['favor_num'], favor_num + 1)
+        self.assertEqual(get_footprint_by_id_db(footprint.id).favor_num, favor_num)
+        self.assertEqual(client.json_get('/footprint/detail/', {'footprint_id': footprint.id})['favor_num'],
+                         favor_num + 1)
+        flush_flow_counters()
+        self.assertEqual(get_footprint_by_id_db(footprint.id).favor_num, favor_num + 1)
+
+        client.json_post('/footprint/favor/', {'footprint_id': footprint.id})
+        flush_flow_counters()
+        self.assertEqual(get_footprint_by_id_db(footprint.id).favor_num, favor_num)
@@ -0,0 +1,256 @@
+import datetime
+import json
+import time
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from api.testing import mock
+from chat.manager.chat_manager import moderate_chat_record
+from chat.manager.message_manager import ConversationMessageManager
+from chat.models import ChatRecord
+from chat.tasks import moderate_chat_record_task, requeue_pending_chat_records_task
+from footprint.consts import AuditStatus
+from footprint.manager.flow_timeline_manager import rebuild_flow_timeline
+from footprint.manager.moderation_manager import moderate_footprint, moderate_comment, MODERATION_STALE_SECONDS, \
+    MODERATION_REQUEUE_MAX_AGE
+from footprint.models import Comment, Footprint
+from footprint.tasks import moderate_footprint_task, moderate_comment_task, requeue_pending_moderation_task
+from redis_utils.container.api_redis_client import redis
+from user_info.manager.profile_manager import _local_profiles
+from utilities.mock_utility.helper import create_user_login_client
+
+# 模拟一次第三方审核接口的耗时
+CHECK_LATENCY = 0.3
+
+
+def _slow_check(result):
+    def check(*args):
+        time.sleep(CHECK_LATENCY)
+        return result
+    return check
+
+
+def _apply(task):
+    """
+    直接执行任务, 代替被patch掉的delay
+    """
+    return lambda *args: task.apply(args=args)
+
+
+@override_settings(ASYNC_MODERATION=True)
+class AsyncModerationTest(TestCase):
+    """
+    python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        rebuild_flow_timeline()
+        _local_profiles.clear()
+        self.author_client, self.author = create_user_login_client()
+        self.viewer_client, self.viewer = create_user_login_client()
+        self.author_info = mock.create_user_info(self.author)
+        mock.create_user_info(self.viewer)
+
+    def _post_footprint(self, content):
+        start = time.perf_counter()
+        result = self.author_client.json_post('/footprint/create/', {
+            'content': content, 'image_list': json.dumps(['1.jpg', '2.jpg']), 'lat': '39.9', 'lon': '116.4',
+            'location': 'here'})
+        # 请求不等待审核
+        self.assertLess(time.perf_counter() - start, CHECK_LATENCY)
+        self.assertEqual(result['audit_status'], AuditStatus.PENDING)
+        return result['footprint_id']
+
+    def _get_track_statuses(self, client):
+        footprints = client.json_get('/footprint/get_user_track/', {'user_id': self.author.id})['footprints']
+        return {item['footprint_id']: item['audit_status'] for item in footprints}
+
+    def _get_discovery_ids(self):
+        return [item['flow_id'] for item in self.viewer_client.json_get('/api/discovery/')['items']]
+
+    @patch('footprint.views.moderate_footprint_task.delay')
+    def test_async_footprint(self, delay):
+        """
+        python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest.test_async_footprint
+        """
+        with patch('footprint.manager.moderation_manager.get_content_verdict', _slow_check(True)), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', _slow_check(True)):
+            passed_id = self._post_footprint('pass')
+            delay.assert_called_once_with(passed_id)
+
+            # 审核完成前只有作者能看到
+            self.assertEqual(self._get_track_statuses(self.author_client), {passed_id: AuditStatus.PENDING})
+            self.assertEqual(self._get_track_statuses(self.viewer_client), {})
+            result = self.author_client.json_get('/footprint/detail/', {'footprint_id': passed_id})
+            self.assertEqual(result['audit_status'], AuditStatus.PENDING)
+            self.assertNotEqual(self.viewer_client.json_get('/footprint/detail/', {'footprint_id': passed_id})[
+                'error_code'], 0)
+            self.assertEqual(self._get_discovery_ids(), [])
+
+            self.assertEqual(moderate_footprint(passed_id), AuditStatus.PASSED)
+            # 重复执行不会重复发布
+            self.assertIsNone(moderate_footprint(passed_id))
+        self.assertEqual(self._get_track_statuses(self.viewer_client), {passed_id: AuditStatus.PASSED})
+        self.assertEqual(self._get_discovery_ids(), [passed_id])
+        nearby = self.viewer_client.json_get('/api/get_nearby_activities/', {'lat': 39.9, 'lon': 116.4})
+        self.assertEqual([item['footprint_id'] for item in nearby['footprints']], [passed_id])
+
+        with patch('footprint.manager.moderation_manager.get_content_verdict', return_value=True), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=False):
+            rejected_id = self._post_footprint('reject')
+            self.assertEqual(moderate_footprint(rejected_id), AuditStatus.REJECTED)
+        self.assertEqual(self._get_track_statuses(self.author_client),
+                         {passed_id: AuditStatus.PASSED, rejected_id: AuditStatus.REJECTED})
+        self.assertEqual(self._get_track_statuses(self.viewer_client), {passed_id: AuditStatus.PASSED})
+        self.assertEqual(self._get_discovery_ids(), [passed_id])
+
+    @patch('chat.views.moderate_chat_record_task.delay')
+    @patch('footprint.views.moderate_comment_task.delay')
+    def test_async_comment_and_chat(self, comment_delay, chat_delay):
+        """
+        python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest.test_async_comment_and_chat
+        """
+        footprint = mock.create_footprint(self.author_info)
+        with patch('footprint.manager.moderation_manager.get_content_verdict', _slow_check(True)):
+            start = time.perf_counter()
+            result = self.viewer_client.json_post('/footprint/comment/', {'footprint_id': footprint.id,
+                                                                          'comment': 'hello'})
+            self.assertLess(time.perf_counter() - start, CHECK_LATENCY)
+            self.assertEqual((result['comment_num'], result['audit_status']), (footprint.comment_num, AuditStatus.PENDING))
+            comment_id = comment_delay.call_args[0][0]
+
+            detail = self.viewer_client.json_get('/footprint/detail/', {'footprint_id': footprint.id})
+            self.assertEqual([item['audit_status'] for item in detail['comments']], [AuditStatus.PENDING])
+            detail = self.author_client.json_get('/footprint/detail/', {'footprint_id': footprint.id})
+            self.assertEqual(detail['comments'], [])
+
+            self.assertEqual(moderate_comment(comment_id), AuditStatus.PASSED)
+        detail = self.author_client.json_get('/footprint/detail/', {'footprint_id': footprint.id})
+        self.assertEqual([item['content'] for item in detail['comments']], ['hello'])
+        self.assertEqual(detail['reply_num'], footprint.comment_num + 1)
+
+        with patch('chat.manager.chat_manager.get_content_verdict', _slow_check(True)):
+            start = time.perf_counter()
+            result = self.author_client.json_raw_post('/chat/post_content/', {
+                'receiver_id': self.viewer.id, 'content_json': {'type': 'text', 'text': 'hi'}})
+            self.assertLess(time.perf_counter() - start, CHECK_LATENCY)
+            msg_id = result['msg_id']
+            chat_delay.assert_called_once_with(msg_id, self.viewer.id)
+
+            params = {'receiver_id': self.author.id}
+            self.assertEqual(self.viewer_client.json_get('/chat/get_conversation_detail/', params)['content_list'], [])
+            self.assertEqual(ConversationMessageManager.get_all_message_list(self.viewer.id), [])
+            params = {'receiver_id': self.viewer.id}
+            content_list = self.author_client.json_get('/chat/get_conversation_detail/', params)['content_list']
+            self.assertEqual([(item['msg_id'], item['audit_status']) for item in content_list],
+                             [(msg_id, AuditStatus.PENDING)])
+
+            self.assertEqual(moderate_chat_record(msg_id, self.viewer.id), AuditStatus.PASSED)
+        params = {'receiver_id': self.author.id}
+        content_list = self.viewer_client.json_get('/chat/get_conversation_detail/', params)['content_list']
+        self.assertEqual([item['content']['text'] for item in content_list], ['hi'])
+        self.assertEqual(len(ConversationMessageManager.get_all_message_list(self.viewer.id)), 1)
+
+    @patch('footprint.views.moderate_footprint_task.delay')
+    def test_check_error_retry(self, delay):
+        """
+        检测接口出错与不通过区分开, 出错时保持审核中并重试
+        python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest.test_check_error_retry
+        """
+        with patch('footprint.manager.moderation_manager.get_content_verdict', return_value=None), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=True):
+            footprint_id = self._post_footprint('error')
+            self.assertEqual(moderate_footprint(footprint_id), AuditStatus.PENDING)
+        self.assertEqual(Footprint.objects.get(id=footprint_id).audit_status, AuditStatus.PENDING)
+        # 有一项不通过就可以得出结论
+        with patch('footprint.manager.moderation_manager.get_content_verdict', return_value=None), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=False):
+            self.assertEqual(moderate_footprint(footprint_id), AuditStatus.REJECTED)
+
+        # 出错、抛出异常后重试(eager模式下立即执行), 直到得到结论
+        footprint_id = self._post_footprint('retry')
+        with patch('footprint.manager.moderation_manager.get_content_verdict',
+                   side_effect=[None, ConnectionError(), True]) as check, \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=True):
+            moderate_footprint_task.apply(args=(footprint_id,))
+        self.assertEqual(check.call_count, 3)
+        self.assertEqual(Footprint.objects.get(id=footprint_id).audit_status, AuditStatus.PASSED)
+        self.assertEqual(self._get_discovery_ids(), [footprint_id])
+
+        # 重试次数用完仍为审核中
+        footprint_id = self._post_footprint('unavailable')
+        with patch('footprint.manager.moderation_manager.get_content_verdict', return_value=None), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=True):
+            moderate_footprint_task.apply(args=(footprint_id,))
+        self.assertEqual(Footprint.objects.get(id=footprint_id).audit_status, AuditStatus.PENDING)
+
+    @patch('chat.views.moderate_chat_record_task.delay')
+    @patch('footprint.views.moderate_comment_task.delay')
+    @patch('footprint.views.moderate_footprint_task.delay')
+    def test_requeue_stale_pending(self, *_):
+        """
+        定时任务重新投递长时间仍在审核中的内容
+        python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest.test_requeue_stale_pending
+        """
+        footprint = mock.create_footprint(self.author_info)
+        self.viewer_client.json_post('/footprint/comment/', {'footprint_id': footprint.id, 'comment': 'hello'})
+        self.author_client.json_raw_post('/chat/post_content/', {
+            'receiver_id': self.viewer.id, 'content_json': {'type': 'text', 'text': 'hi'}})
+        footprint_ids = [self._post_footprint('stale'), self._post_footprint('expired'), self._post_footprint('new')]
+        now = datetime.datetime.now()
+        stale_time = now - datetime.timedelta(seconds=MODERATION_STALE_SECONDS + 60)
+        Footprint.objects.filter(id=footprint_ids[0]).update(created_time=stale_time)
+        Footprint.objects.filter(id=footprint_ids[1]).update(
+            created_time=now - datetime.timedelta(seconds=MODERATION_REQUEUE_MAX_AGE + 60))
+        Comment.objects.filter(audit_status=AuditStatus.PENDING).update(created_time=stale_time)
+        ChatRecord.objects.filter(audit_status=AuditStatus.PENDING).update(created_time=stale_time)
+
+        with patch('footprint.manager.moderation_manager.get_content_verdict', return_value=True), \
+                patch('footprint.manager.moderation_manager.get_images_verdict', return_value=True), \
+                patch('chat.manager.chat_manager.get_content_verdict', return_value=True), \
+                patch.object(moderate_footprint_task, 'delay', side_effect=_apply(moderate_footprint_task)), \
+                patch.object(moderate_comment_task, 'delay', side_effect=_apply(moderate_comment_task)), \
+                patch.object(moderate_chat_record_task, 'delay', side_effect=_apply(moderate_chat_record_task)) \
+                as chat_delay:
+            self.assertEqual(requeue_pending_moderation_task(), 2)
+            self.assertEqual(requeue_pending_chat_records_task(), 1)
+            chat_delay.assert_called_once_with(ChatRecord.objects.get().id, self.viewer.id)
+        self.assertEqual([Footprint.objects.get(id=footprint_id).audit_status for footprint_id in footprint_ids],
+                         [AuditStatus.PASSED, AuditStatus.PENDING, AuditStatus.PENDING])
+        self.assertEqual(Comment.objects.get().audit_status, AuditStatus.PASSED)
+        self.assertEqual(ChatRecord.objects.get().audit_status, AuditStatus.PASSED)
+        self.assertEqual(len(ConversationMessageManager.get_all_message_list(self.viewer.id)), 1)
+
+    @patch('chat.views.moderate_chat_record_task.delay')
+    def test_chat_get_new_out_of_order(self, _):
+        """
+        对方的消息晚于自己的消息通过审核, 增量获取仍然能拿到
+        python manage.py test --settings=settings-test footprint.testing.test_moderation.AsyncModerationTest.test_chat_get_new_out_of_order
+        """
+        def post(client, receiver, text):
+            return client.json_raw_post('/chat/post_content/', {
+                'receiver_id': receiver.id, 'content_json': {'type': 'text', 'text': text}})['msg_id']
+
+        def get_new(client, receiver, seq):
+            result = client.json_get('/chat/get_conversation_detail/',
+                                     {'receiver_id': receiver.id, 'get_new': 1, 'seq': seq})
+            return [(item['content']['text'], item['audit_status']) for item in result['content_list']], result['seq']
+
+        first_id = post(self.author_client, self.viewer, 'first')
+        second_id = post(self.author_client, self.viewer, 'second')
+        # 对方的两条消息都在审核中, 自己发的消息先返回, 客户端的msg_id越过了它们
+        reply_id = post(self.viewer_client, self.author, 'reply')
+        content_list, seq = get_new(self.viewer_client, self.author, 0)
+        self.assertEqual(content_list, [('reply', AuditStatus.PENDING)])
+        self.assertGreater(reply_id, second_id)
+
+        with patch('chat.manager.chat_manager.get_content_verdict', return_value=True):
+            self.assertEqual(moderate_chat_record(reply_id, self.author.id), AuditStatus.PASSED)
+            self.assertEqual(moderate_chat_record(second_id, self.viewer.id), AuditStatus.PASSED)
+            content_list, seq = get_new(self.viewer_client, self.author, seq)
+            self.assertEqual(sorted(content_list), [('reply', AuditStatus.PASSED), ('second', AuditStatus.PASSED)])
+            self.assertEqual(moderate_chat_record(first_id, self.viewer.id), AuditStatus.PASSED)
+        self.assertEqual(get_new(self.viewer_client, self.author, seq)[0], [('first', AuditStatus.PASSED)])
+        self.assertEqual(get_new(self.viewer_client, self.author, seq + 1), ([], seq + 1))
@@ -1,19 +1,20 @@
 import json
-import logging
 
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 
-from api.manager.positon_manager import add_user_location
+from api.manager.positon_manager import add_footprint_location
+from footprint.consts import AuditStatus
 from footprint.manager.comment_manager import create_comment_db
 from footprint.manager.footprint_manager import create_footprint_db, add_favor_db, \
     build_footprint_detail, get_footprint_by_id_db, get_footprints_by_user_id_db, update_comment_num_db, \
-    build_footprint_list_info
+    build_footprint_list_info, get_footprints_by_user_id_cursor_db, get_flow_count, is_footprint_visible
 from footprint.models import FlowType
+from footprint.tasks import moderate_footprint_task, moderate_comment_task
 from log_utils.loggers import info_logger
-from utilities.content_check import is_content_valid
-from utilities.image_check import is_image_valid
-from utilities.request_utils import get_data_from_request, get_page_range
+from utilities.content_check import is_content_valid, is_async_moderation_enabled
+from utilities.image_check import are_images_valid
+from utilities.request_utils import get_data_from_request, get_page_range, decode_cursor
 from utilities.response import json_http_success, json_http_error
 
 
@@ -39,17 +40,22 @@ def comment_footprint_view(request):
     URL[POST]: /footprint/comment/
     评论footprint，目前只能评论主贴
     :param request:
-    :return:
+    :return: {comment_num, audit_status}, 异步审核时评论审核通过后才计入comment_num
     """
     post_data = get_data_from_request(request)
     footprint_id = post_data['footprint_id']
     comment = post_data['comment']
+    if is_async_moderation_enabled():
+        comment_record = create_comment_db(request.user, footprint_id, comment, AuditStatus.PENDING)
+        moderate_comment_task.delay(comment_record.id)
+        comment_num = get_flow_count(footprint_id, FlowType.FOOTPRINT, 'comment_num')
+        return json_http_success({'comment_num': comment_num, 'audit_status': comment_record.audit_status})
     if not is_content_valid(comment):
         return json_http_error('请注意用词')
     success = create_comment_db(request.user, footprint_id, comment)
     if success:
         comment_num = update_comment_num_db(footprint_id)
-        return json_http_success({'comment_num': comment_num})
+        return json_http_success({'comment_num': comment_num, 'audit_status': AuditStatus.PASSED})
     return json_http_error()
 
 
@@ -60,27 +66,29 @@ def post_footprint_view(request):
     发布踪踪动态
     URL[POST]: /footprint/create/
     :param request:
-    :return:
+    :return: {footprint_id, audit_status}, 异步审核时足迹审核通过后才进入发现页和附近
     """
     post_data = get_data_from_request(request)
     latitude = post_data.get('lat')
     longitude = post_data.get('lon')
     location = post_data.get('location')
     content = post_data['content']
-    if content and not is_content_valid(content):
-        return json_http_error('请注意用词')
     image_list = post_data['image_list']
     if isinstance(image_list, str):
         image_list = json.loads(image_list)
-    for image in image_list:
-        logging.info('{}{}'.format(image, type(image)))
-        if not is_image_valid(image):
-            return json_http_error('请文明发言')
     hide = bool(int(post_data.get('hide', 0)))
-    footprint = create_footprint_db(request.user, content, latitude, longitude, location, image_list, hide)
-    if latitude and longitude:
-        add_user_location(footprint.id, longitude, latitude)
-    return json_http_success()
+    if is_async_moderation_enabled():
+        footprint = create_footprint_db(request.user.id, content, latitude, longitude, location, image_list, hide,
+                                        AuditStatus.PENDING)
+        moderate_footprint_task.delay(footprint.id)
+        return json_http_success({'footprint_id': footprint.id, 'audit_status': footprint.audit_status})
+    if content and not is_content_valid(content):
+        return json_http_error('请注意用词')
+    if not are_images_valid(image_list):
+        return json_http_error('请文明发言')
+    footprint = create_footprint_db(request.user.id, content, latitude, longitude, location, image_list, hide)
+    add_footprint_location(footprint)
+    return json_http_success({'footprint_id': footprint.id, 'audit_status': footprint.audit_status})
 
 
 @login_required
@@ -97,6 +105,8 @@ def get_footprint_detail_view(request):
     """
     footprint_id = request.GET.get('footprint_id')
     footprint = get_footprint_by_id_db(footprint_id)
+    if footprint is None or not is_footprint_visible(footprint, request.user.id):
+        return json_http_error('足迹不存在')
     footprint_detail = build_footprint_detail(footprint, request.user.id)
     return json_http_success(footprint_detail)
 
@@ -105,15 +115,24 @@ def get_footprint_detail_view(request):
 def get_user_footprint_track_view(request):
     """
     /footprint/user_track/
-    :param request:
-    :return:
+    :param request: user_id, page 或 cursor(游标翻页，第一页传空串，之后传上一页返回的next_cursor)
+    :return: {footprints, has_more, next_cursor(游标翻页时返回)}
     """
     user_id = int(request.GET.get('user_id', 0)) or request.user.id
-    page = int(request.GET.get('page', 0))
     lat = float(request.GET.get('lat', 0))
     lon = float(request.GET.get('lon', 0))
+    if 'cursor' in request.GET:
+        try:
+            cursor = decode_cursor(request.GET['cursor'])
+        except ValueError:
+            return json_http_error('参数错误')
+        footprints, next_cursor, has_more = get_footprints_by_user_id_cursor_db(user_id, cursor, 5, request.user.id)
+        result = build_footprint_list_info(footprints, request.user.id, lat, lon)
+        return json_http_success({'footprints': result, 'has_more': has_more, 'next_cursor': next_cursor})
+    page = int(request.GET.get('page', 0))
     start, end = get_page_range(page, 5)
-    footprints = get_footprints_by_user_id_db(user_id, start, end)
+    # 多取一条用于判断has_more
+    footprints = get_footprints_by_user_id_db(user_id, start, end + 1, request.user.id)
     has_more = len(footprints) > 5
     footprints = footprints[:5]
     result = build_footprint_list_info(footprints, request.user.id, lat, lon)
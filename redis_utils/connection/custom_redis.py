@@ -8,6 +8,7 @@ import time
 import logging
 
 import redis as pyredis
+from redis.client import dict_merge, parse_georadius_generic
 from redis.exceptions import RedisError
 
 
@@ -88,6 +89,11 @@ class ConnectionPoolProxy(object):
 
 
 class CustomRedis(pyredis.StrictRedis):
+    # redis-py 3.3还没有GEOSEARCH(redis 6.2), 返回格式与GEORADIUS相同
+    RESPONSE_CALLBACKS = dict_merge(pyredis.StrictRedis.RESPONSE_CALLBACKS, {
+        'GEOSEARCH': parse_georadius_generic,
+    })
+
     def __init__(self, *args, **kwargs):
         super(CustomRedis, self).__init__(*args, **kwargs)
         self.connection_pool = ConnectionPoolProxy(self.connection_pool)
@@ -5,15 +5,16 @@
 """
 from __future__ import absolute_import
 
+import math
 import pickle
 import time
 import six
 
 import fakeredis
-import simplejson as json
+import numpy as np
 from fakeredis import FakeStrictRedis
-from geopy.distance import geodesic
-from redis import DataError
+from redis import DataError, ResponseError
+from redis.client import Pipeline
 
 from redis_utils.container.consts import GeoUnitEnum, GeoSortEnum
 
@@ -260,20 +261,49 @@ class CYFakerRedis(FakeStrictRedis):
         self.set(key, now_time)
         return True, capacity + 1, left_num, -1, period * (capacity - left_num) / count_per_period
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CYFakerPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def execute_command(self, *args, **options):
+        if args[0] == 'GEOSEARCH':
+            return self.geosearch(*args[1:], **options)
+        return FakeStrictRedis.execute_command(self, *args, **options)
+
     # GEO COMMANDS
-    def geoadd(self, key, *values):
+    # 与redis一样, geo数据存为zset, score为52位的geohash(经纬度各26位交错), 所以zrem/expire/type等命令都与redis一致;
+    # 查询时按半径选择geohash精度, 只取出中心格子及周围8个格子对应的score区间, 再用numpy精确计算距离
+    def geoadd(self, name, *values):
         """
         Add the specified geospatial items to the specified key identified
         by the ``name`` argument. The Geospatial items are given as ordered
         members of the ``values`` argument, each item or place is formed by
         the triad longitude, latitude and name.
+        :return: 新增的成员数
         """
         if len(values) % 3 != 0:
             raise DataError("GEOADD requires places with lon, lat and name"
                             " values")
-        for i in range(0, len(values), 3):
-            self.hset(key, values[i + 2], json.dumps(values[i:i + 2]))
-        return True
+        lons = np.array(values[0::3], dtype=float)
+        lats = np.array(values[1::3], dtype=float)
+        if ((lons < GEO_LON_MIN) | (lons > GEO_LON_MAX) | (lats < GEO_LAT_MIN) | (lats > GEO_LAT_MAX)).any():
+            raise ResponseError("invalid longitude,latitude pair")
+        scores = _encode_geo_scores(lons, lats)
+        return FakeStrictRedis.zadd(self, name, {member: int(score) for member, score in zip(values[2::3], scores)})
+
+    def _get_geo_positions(self, name, *members):
+        """
+        :return: [(lon, lat)], 不存在的为None
+        """
+        pipeline = FakeStrictRedis.pipeline(self, transaction=False)
+        for member in members:
+            pipeline.zscore(name, member)
+        scores = pipeline.execute()
+        exists = [score is not None for score in scores]
+        if not any(exists):
+            return [None] * len(members)
+        lons, lats = _decode_geo_scores([score for score in scores if score is not None])
+        positions = iter(zip(lons.tolist(), lats.tolist()))
+        return [next(positions) if exist else None for exist in exists]
 
     def geodist(self, name, place1, place2, unit=None):
         """
@@ -281,68 +311,146 @@ class CYFakerRedis(FakeStrictRedis):
         ``name`` key.
         The units must be one of the following : m, km mi, ft. By default
         meters are used.
+        地点不存在时与redis一样返回None
         """
-        if unit and unit not in GeoUnitEnum.values():
-            raise DataError("GEODIST invalid unit")
-        if not self.hget(name, place1) or not self.hget(name, place2):
-            raise DataError("place does not exists")
-        place1_data = json.loads(self.hget(name, place1))
-        place2_data = json.loads(self.hget(name, place2))
-        distance = geodesic((place1_data[1], place1_data[0]), (place2_data[1], place2_data[0]))
-        if unit == GeoUnitEnum.M or not unit:
-            return distance.meters
-        elif unit == GeoUnitEnum.MI:
-            return distance.miles
-        elif unit == GeoUnitEnum.KM:
-            return distance.kilometers
-        else:
-            return distance.feet
+        unit_meters = _get_unit_meters(unit)
+        position1, position2 = self._get_geo_positions(name, place1, place2)
+        if not position1 or not position2:
+            return None
+        return round(float(_haversine(position1[0], position1[1], position2[0], position2[1])) / unit_meters, 4)
 
     def geohash(self, name, *values):
         """
-        测试用例里用不到这玩意儿
+        与redis一致, 返回11位的标准geohash, 不存在的为None
         """
-        return ''
+        positions = self._get_geo_positions(name, *values)
+        exists = [position for position in positions if position]
+        if not exists:
+            return positions
+        # 标准geohash的纬度范围是[-90, 90], 需要用格子中心重新编码
+        lons, lats = zip(*exists)
+        scores = _interleave(_get_cell_index(lats, -90, 90, GEO_STEP), _get_cell_index(lons, -180, 180, GEO_STEP))
+        hashes = iter(''.join(GEOHASH_BASE32[(int(score) >> (52 - (index + 1) * 5)) & 0x1f] for index in range(10))
+                      # 只有52位, 第11位补0
+                      + '0' for score in scores)
+        return [next(hashes) if position else None for position in positions]
 
     def geopos(self, name, *values):
         """
         Return the positions of each item of ``values`` as members of
         the specified key identified by the ``name`` argument. Each position
         is represented by the pairs lon and lat.
+        与redis一样返回的是geohash格子的中心, 与写入的坐标有不到1米的误差
+        """
+        return self._get_geo_positions(name, *values)
+
+    def _geo_search(self, name, longitude, latitude, radius=None, box=None, unit=None, withdist=False,
+                    withcoord=False, withhash=False, count=None, sort=None, store=None, store_dist=None):
+        """
+        :param radius: 按半径查找
+        :param box: (width, height), 按矩形查找
+        :return: 与redis-py的返回格式一致: 没有with*时为[name], 否则为[name, dist, hash, (lon, lat)]中需要的部分
         """
+        unit_meters = _get_unit_meters(unit)
+        if sort and sort not in GeoSortEnum.values():
+            raise DataError("GEORADIUS invalid sort")
+        longitude, latitude = float(longitude), float(latitude)
+        if box:
+            width, height = box[0] * unit_meters, box[1] * unit_meters
+            cover_radius = math.hypot(width, height) / 2
+        else:
+            cover_radius = radius * unit_meters
+
+        members, scores = [], []
+        for min_score, max_score in _get_geo_search_ranges(longitude, latitude, cover_radius):
+            for member, score in FakeStrictRedis.zrangebyscore(self, name, min_score, max_score, withscores=True):
+                members.append(member)
+                scores.append(score)
+        lons, lats = _decode_geo_scores(scores)
+        distances = _haversine(longitude, latitude, lons, lats)
+        if box:
+            matched = (np.abs(np.radians(lats) - math.radians(latitude)) * EARTH_RADIUS_IN_METERS <= height / 2) \
+                & (_haversine(longitude, lats, lons, lats) <= width / 2)
+        else:
+            matched = distances <= cover_radius
+        indexes = np.nonzero(matched)[0]
+
+        if count and not sort:
+            # 与redis一致, 指定count时返回最近的count个
+            sort = GeoSortEnum.ASC
+        if sort:
+            indexes = indexes[np.argsort(distances[indexes], kind='stable')]
+            if sort == GeoSortEnum.DESC:
+                indexes = indexes[::-1]
+        if count:
+            indexes = indexes[:count]
+
+        if store or store_dist:
+            mapping = {members[index]: int(scores[index]) if store else distances[index] / unit_meters
+                       for index in indexes}
+            pipeline = FakeStrictRedis.pipeline(self, transaction=False)
+            pipeline.delete(store or store_dist)
+            if mapping:
+                pipeline.zadd(store or store_dist, mapping)
+            pipeline.execute()
+            return len(mapping)
+
         result = []
-        for place in values:
-            position = self.hget(name, place)
-            position = json.loads(position) if position else None
-            result.append(position)
+        for index in indexes:
+            item = [members[index]]
+            if withdist:
+                item.append(round(float(distances[index]) / unit_meters, 4))
+            if withhash:
+                item.append(int(scores[index]))
+            if withcoord:
+                item.append((float(lons[index]), float(lats[index])))
+            result.append(item if withdist or withhash or withcoord else item[0])
         return result
 
     def georadius(self, name, longitude, latitude, radius, unit=None,
                   withdist=False, withcoord=False, withhash=False, count=None,
                   sort=None, store=None, store_dist=None):
         """
-        测试用例只支持with_dist和count，别的就不支持了，太麻烦且没用, 如果有需求自己去查文档吧。。
         获取单位unit的半径radius内的单位，根据配置项可以返回距离，坐标，hash三个信息，并可以选择数量和按距离排列的顺序
         """
-        if unit and unit not in GeoUnitEnum.values() or (sort and sort not in GeoSortEnum.values()):
-            raise DataError("GEODIST invalid unit")
-        all_items = self.hgetall(name)
-        all_items = {key: json.loads(value) for key, value in all_items.items()}
-        result = []
-        for place_name, item in all_items.items():
-            lon, lat = item
-            dist = geodesic((latitude, longitude), (lat, lon))
-            distance = dist.m if unit == GeoUnitEnum.M else dist.km if unit == GeoUnitEnum.KM else dist.mi \
-                if unit == GeoUnitEnum.MI else dist.ft
-            if distance <= radius:
-                result.append([place_name, distance])
-        if sort:
-            result.sort(key=lambda x: x[1], reverse=sort == GeoSortEnum.DESC)
-
-        if not withdist:
-            result = [item[0] for item in result]
-
-        return result if not count else result[:count]
+        if store and store_dist:
+            raise DataError("GEORADIUS store and store_dist cant be set together")
+        return self._geo_search(name, longitude, latitude, radius=float(radius), unit=unit, withdist=withdist,
+                                withcoord=withcoord, withhash=withhash, count=count, sort=sort, store=store,
+                                store_dist=store_dist)
+
+    def geosearch(self, name, *args, **options):
+        """
+        GEOSEARCH, 支持FROMLONLAT/FROMMEMBER, BYRADIUS/BYBOX, ASC/DESC, COUNT [ANY], WITHCOORD, WITHDIST, WITHHASH
+        矩形的判断与redis一致: 纬度方向和所在纬线方向的距离分别不超过高、宽的一半
+        """
+        args = [arg.decode('utf-8') if isinstance(arg, bytes) else arg for arg in args]
+        upper_args = [arg.upper() if isinstance(arg, str) else arg for arg in args]
+        index, center, search_options = 0, None, {}
+        while index < len(args):
+            option = upper_args[index]
+            if option == 'FROMLONLAT':
+                center, index = (float(args[index + 1]), float(args[index + 2])), index + 3
+            elif option == 'FROMMEMBER':
+                center, index = self._get_geo_positions(name, args[index + 1])[0], index + 2
+                if not center:
+                    raise ResponseError("could not decode requested zset member")
+            elif option == 'BYRADIUS':
+                search_options.update(radius=float(args[index + 1]), unit=args[index + 2])
+                index += 3
+            elif option == 'BYBOX':
+                search_options.update(box=(float(args[index + 1]), float(args[index + 2])), unit=args[index + 3])
+                index += 4
+            elif option in (GeoSortEnum.ASC, GeoSortEnum.DESC):
+                search_options['sort'], index = option, index + 1
+            elif option == 'COUNT':
+                search_options['count'], index = int(args[index + 1]), index + 2
+            elif option in ('WITHDIST', 'WITHCOORD', 'WITHHASH'):
+                search_options[option.lower()], index = True, index + 1
+            else:
+                # ANY: 找到count个就返回, 这里总是返回最近的count个, 也满足语义
+                index += 1
+        return self._geo_search(name, center[0], center[1], **search_options)
 
     def georadiusbymember(self, name, member, radius, unit=None,
                           withdist=False, withcoord=False, withhash=False,
@@ -350,15 +458,157 @@ class CYFakerRedis(FakeStrictRedis):
         """
         与上面一个的区别是用地点名member代替了地点的左边
         """
-        if unit and unit not in GeoUnitEnum.values():
-            raise DataError("GEODIST invalid unit")
-        place_data = self.hget(name, member)
-        if not place_data:
-            raise DataError("member does not exist")
-        place_data = json.loads(place_data)
-        lon, lat = place_data
-        return self.georadius(name, lon, lat, radius, unit, withdist, withcoord, withhash, count, sort, store,
-                              store_dist)
+        position = self._get_geo_positions(name, member)[0]
+        if not position:
+            raise ResponseError("could not decode requested zset member")
+        return self.georadius(name, position[0], position[1], radius, unit, withdist, withcoord, withhash, count,
+                              sort, store, store_dist)
+
+
+# 与redis的geohash.h一致
+GEO_STEP = 26
+GEO_LAT_MIN, GEO_LAT_MAX = -85.05112878, 85.05112878
+GEO_LON_MIN, GEO_LON_MAX = -180, 180
+EARTH_RADIUS_IN_METERS = 6372797.560856
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEO_UNIT_METERS = {GeoUnitEnum.M: 1, GeoUnitEnum.KM: 1000, GeoUnitEnum.MI: 1609.34, GeoUnitEnum.FT: 0.3048}
+_SPREAD_MASKS = ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                 (2, 0x3333333333333333), (1, 0x5555555555555555))
+_SQUASH_MASKS = ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                 (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF))
+
+
+def _get_unit_meters(unit):
+    unit = unit.decode('utf-8') if isinstance(unit, bytes) else (unit or GeoUnitEnum.M)
+    if unit.lower() not in GEO_UNIT_METERS:
+        raise DataError("GEO invalid unit")
+    return GEO_UNIT_METERS[unit.lower()]
+
+
+def _spread_bits(values):
+    """
+    第i位移到第2i位
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    for shift, mask in _SPREAD_MASKS:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def _squash_bits(values):
+    """
+    _spread_bits的逆运算, 取出偶数位
+    """
+    values = np.asarray(values, dtype=np.uint64) & np.uint64(_SPREAD_MASKS[-1][1])
+    for shift, mask in _SQUASH_MASKS:
+        values = (values | (values >> np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def _interleave(lat_bits, lon_bits):
+    return _spread_bits(lat_bits) | (_spread_bits(lon_bits) << np.uint64(1))
+
+
+def _get_cell_index(values, min_value, max_value, step):
+    offsets = (np.asarray(values, dtype=float) - min_value) / (max_value - min_value) * (1 << step)
+    return np.clip(offsets, 0, (1 << step) - 1).astype(np.uint64)
+
+
+def _encode_geo_scores(lons, lats):
+    """
+    :return: 52位geohash, 与redis GEOADD写入的score相同
+    """
+    return _interleave(_get_cell_index(lats, GEO_LAT_MIN, GEO_LAT_MAX, GEO_STEP),
+                       _get_cell_index(lons, GEO_LON_MIN, GEO_LON_MAX, GEO_STEP))
+
+
+def _decode_geo_scores(scores):
+    """
+    :return: (lons, lats), geohash格子的中心
+    """
+    scores = np.asarray(scores, dtype=float).astype(np.uint64)
+    lat_bits, lon_bits = _squash_bits(scores), _squash_bits(scores >> np.uint64(1))
+    lats = GEO_LAT_MIN + (lat_bits + 0.5) / (1 << GEO_STEP) * (GEO_LAT_MAX - GEO_LAT_MIN)
+    lons = GEO_LON_MIN + (lon_bits + 0.5) / (1 << GEO_STEP) * (GEO_LON_MAX - GEO_LON_MIN)
+    return np.clip(lons, GEO_LON_MIN, GEO_LON_MAX), np.clip(lats, GEO_LAT_MIN, GEO_LAT_MAX)
+
+
+def _get_geo_search_ranges(lon, lat, radius):
+    """
+    与redis的思路相同: 选择格子边长不小于radius(米)的最大精度, 半径内的点一定落在中心所在格子及周围8个格子中
+    :return: [(min_score, max_score)], 左闭右开
+    """
+    meters_per_degree = math.radians(1) * EARTH_RADIUS_IN_METERS
+    # 经度方向按查找范围内离赤道最远的纬线计算
+    max_lat = min(abs(lat) + math.degrees(radius / EARTH_RADIUS_IN_METERS), 89.0)
+    step = GEO_STEP
+    while step > 1:
+        lat_size = (GEO_LAT_MAX - GEO_LAT_MIN) / (1 << step) * meters_per_degree
+        lon_size = (GEO_LON_MAX - GEO_LON_MIN) / (1 << step) * meters_per_degree * math.cos(math.radians(max_lat))
+        if min(lat_size, lon_size) >= radius:
+            break
+        step -= 1
+    if step <= 1:
+        return [('-inf', '+inf')]
+    lat_index = int(_get_cell_index(lat, GEO_LAT_MIN, GEO_LAT_MAX, step))
+    lon_index = int(_get_cell_index(lon, GEO_LON_MIN, GEO_LON_MAX, step))
+    cells = {(lat_index + lat_delta, (lon_index + lon_delta) % (1 << step))
+             for lat_delta in (-1, 0, 1) for lon_delta in (-1, 0, 1) if 0 <= lat_index + lat_delta < 1 << step}
+    cells = sorted(int(_interleave(*cell)) for cell in cells)
+    shift = 2 * (GEO_STEP - step)
+    return [(cell << shift, '({}'.format((cell + 1) << shift)) for cell in cells]
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    """
+    与redis相同的球面距离, 单位米, 参数可以是numpy数组
+    """
+    lat1, lat2, delta_lon = np.radians(lat1), np.radians(lat2), np.radians(np.subtract(lon2, lon1))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(delta_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_IN_METERS * np.arcsin(np.sqrt(a))
+
+
+class CYFakerPipeline(Pipeline):
+    """
+    fakeredis不支持geo命令, pipeline中的geo命令(包括GEOSEARCH)交给CYFakerRedis的实现
+    其余命令仍由fakeredis执行, geo命令前后的命令分批执行, 结果按命令顺序返回
+    """
+    GEO_COMMANDS = ('geoadd', 'geodist', 'geohash', 'geopos', 'georadius', 'georadiusbymember')
+
+    def __init__(self, client, *args, **kwargs):
+        self.client = client
+        Pipeline.__init__(self, *args, **kwargs)
+
+    def __getattribute__(self, name):
+        if name in CYFakerPipeline.GEO_COMMANDS:
+            def queue_geo_command(*args, **kwargs):
+                self.command_stack.append(((name, ) + args, {'_fake_geo': kwargs}))
+                return self
+            return queue_geo_command
+        return Pipeline.__getattribute__(self, name)
+
+    def pipeline_execute_command(self, *args, **options):
+        if args[0] == 'GEOSEARCH':
+            self.command_stack.append((('execute_command', ) + args, {'_fake_geo': options}))
+            return self
+        return Pipeline.pipeline_execute_command(self, *args, **options)
+
+    def execute(self, raise_on_error=True):
+        stack, result, batch = self.command_stack, [], []
+        try:
+            for args, options in stack + [(None, None)]:
+                if args is not None and '_fake_geo' not in options:
+                    batch.append((args, options))
+                    continue
+                if batch:
+                    self.command_stack = batch
+                    result.extend(Pipeline.execute(self, raise_on_error))
+                    batch = []
+                if args is not None:
+                    result.append(getattr(self.client, args[0])(*args[1:], **options['_fake_geo']))
+            return result
+        finally:
+            self.reset()
 
 
 class FakeSentinel(object):
@@ -3,10 +3,21 @@
 RedisGeo
 Redis对Geo算法的实现封装
 """
+import time
+from collections import namedtuple
+
 from redis import DataError
 
 from redis_utils.container.api_redis_client import redis
-from redis_utils.container.consts import GeoUnitEnum
+from redis_utils.container.consts import GeoUnitEnum, GeoSortEnum
+from utilities.geo import distances_from
+
+# 每个单位对应的米数, 与redis GEODIST一致
+METERS_PER_UNIT = {GeoUnitEnum.M: 1, GeoUnitEnum.KM: 1000, GeoUnitEnum.MI: 1609.34, GeoUnitEnum.FT: 0.3048}
+# search的结果, distance的单位与查询时的unit一致
+GeoMember = namedtuple('GeoMember', ['member', 'distance', 'lon', 'lat'])
+# nearest默认逐步扩大的搜索半径, 对应unit为km
+NEAREST_RADIUS_STEPS = (1, 5, 25, 100)
 
 
 class RedisGeo(object):
@@ -68,6 +79,126 @@ class RedisGeo(object):
         return self.redis.georadius(self.cache_key, longitude, latitude, radius, unit=unit,
                                     withdist=withdist, count=count, sort=sort)
 
+    def _get_query_keys(self):
+        """
+        查询时需要读取的key, 分桶的集合有多个
+        """
+        return [self.cache_key]
+
+    def _search(self, redis_instance, key, longitude, latitude, radius, unit, count, sort):
+        if unit not in GeoUnitEnum.values():
+            raise ValueError("unit is not in GeoUnit")
+        return redis_instance.georadius(key, longitude, latitude, radius, unit=unit,
+                                        withdist=True, withcoord=True, count=count, sort=sort)
+
+    @staticmethod
+    def _parse_search_result(result):
+        return [GeoMember(member.decode('utf-8') if isinstance(member, bytes) else member, distance, lon, lat)
+                for member, distance, (lon, lat) in result]
+
+    @classmethod
+    def _merge_search_results(cls, results, count, sort):
+        """
+        合并同一个集合多个key的查询结果, 排序和数量限制与单个key的查询一致
+        """
+        if len(results) == 1:
+            return cls._parse_search_result(results[0])
+        members = [member for result in results for member in cls._parse_search_result(result)]
+        if sort or count:
+            members.sort(key=lambda member: member.distance, reverse=sort == GeoSortEnum.DESC)
+        return members[:count] if count else members
+
+    @classmethod
+    def _pipeline_search(cls, containers, search_name, longitude, latitude, *args, count=None, sort=None):
+        """
+        在containers的所有key上执行查询, 只有一个key时直接执行, 否则在一个pipeline中完成
+        :return: [[GeoMember, ...], ...], 与containers一一对应
+        """
+        if not containers:
+            return []
+        container_keys = [container._get_query_keys() for container in containers]
+        if len(containers) == 1 and len(container_keys[0]) == 1:
+            container = containers[0]
+            results = [getattr(container, search_name)(container.redis, container_keys[0][0], longitude, latitude,
+                                                       *args, count, sort)]
+        else:
+            pipeline = containers[0].redis.pipeline(transaction=False)
+            for container, keys in zip(containers, container_keys):
+                for key in keys:
+                    getattr(container, search_name)(pipeline, key, longitude, latitude, *args, count, sort)
+            results = pipeline.execute()
+        merged, index = [], 0
+        for keys in container_keys:
+            merged.append(cls._merge_search_results(results[index: index + len(keys)], count, sort))
+            index += len(keys)
+        return merged
+
+    def search(self, longitude, latitude, radius, unit=GeoUnitEnum.KM, count=None, sort=GeoSortEnum.ASC):
+        """
+        一次GEORADIUS(WITHDIST WITHCOORD)同时返回单位、距离和坐标, 不需要再调用get_position
+        :param count: 返回的数量, 指定时只返回最近的count个
+        :param sort: 按距离排序的方式, None为不排序
+        :return: [GeoMember(member, distance, lon, lat), ...]
+        """
+        return self._pipeline_search([self], '_search', longitude, latitude, radius, unit, count=count, sort=sort)[0]
+
+    @classmethod
+    def search_many(cls, containers, longitude, latitude, radius, unit=GeoUnitEnum.KM, count=None,
+                    sort=GeoSortEnum.ASC):
+        """
+        在多个集合中以相同条件查询, 所有GEORADIUS在一次网络往返中完成, 集合需要在同一个redis实例上
+        :return: [[GeoMember, ...], ...], 与containers一一对应
+        """
+        return cls._pipeline_search(containers, '_search', longitude, latitude, radius, unit, count=count, sort=sort)
+
+    def _search_box(self, redis_instance, key, longitude, latitude, width, height, unit, count, sort):
+        if unit not in GeoUnitEnum.values():
+            raise ValueError("unit is not in GeoUnit")
+        pieces = [key, 'FROMLONLAT', longitude, latitude, 'BYBOX', width, height, unit]
+        if sort:
+            pieces.append(sort)
+        if count:
+            pieces.extend(['COUNT', count])
+        pieces.extend(['WITHCOORD', 'WITHDIST'])
+        return redis_instance.execute_command('GEOSEARCH', *pieces, withdist=True, withcoord=True, withhash=False,
+                                              store=None, store_dist=None)
+
+    def search_box(self, longitude, latitude, width, height, unit=GeoUnitEnum.KM, count=None,
+                   sort=GeoSortEnum.ASC):
+        """
+        GEOSEARCH BYBOX: 以(longitude, latitude)为中心, 宽width高height的矩形内的单位, 需要redis 6.2以上
+        :param count: 返回的数量, 指定时只返回离中心最近的count个
+        :return: [GeoMember(member, distance, lon, lat), ...], distance为到中心的距离
+        """
+        return self._pipeline_search([self], '_search_box', longitude, latitude, width, height, unit,
+                                     count=count, sort=sort)[0]
+
+    @classmethod
+    def search_box_many(cls, containers, longitude, latitude, width, height, unit=GeoUnitEnum.KM, count=None,
+                        sort=GeoSortEnum.ASC):
+        """
+        search_box的多集合版本, 一次网络往返
+        :return: [[GeoMember, ...], ...], 与containers一一对应
+        """
+        return cls._pipeline_search(containers, '_search_box', longitude, latitude, width, height, unit,
+                                    count=count, sort=sort)
+
+    def nearest(self, longitude, latitude, k, max_radius, unit=GeoUnitEnum.KM, radius_steps=NEAREST_RADIUS_STEPS):
+        """
+        查找最近的k个单位, 从小半径开始逐步扩大, 找够k个即停止
+        密集区域在小半径内就能找到, 不需要对max_radius内的所有单位排序
+        :param max_radius: 最大搜索半径
+        :param radius_steps: 搜索半径序列, 单位与unit一致, 不小于max_radius的部分不使用, 最后总会搜索一次max_radius
+        :return: [GeoMember, ...], 按距离由近到远排序, 最多k个
+        """
+        radii = [radius for radius in radius_steps if radius < max_radius] + [max_radius]
+        members = []
+        for radius in radii:
+            members = self.search(longitude, latitude, radius, unit, count=k, sort=GeoSortEnum.ASC)
+            if len(members) >= k:
+                break
+        return members
+
     def get_members_within_radius_by_member(self, member, radius, unit=GeoUnitEnum.KM,
                                             withdist=False, count=None, sort=None):
         """
@@ -85,3 +216,141 @@ class RedisGeo(object):
         :return: [hash1, hash2, ...]
         """
         return self.redis.geohash(self.cache_key, *members)
+
+    def cache_exists(self):
+        """
+        判断位置集合是否存在, redis数据丢失或尚未写入时为False
+        :return: bool
+        """
+        return bool(self.redis.exists(self.cache_key))
+
+
+class ShardedRedisGeo(RedisGeo):
+    """
+    按时间分桶的RedisGeo, 每个时间段一个key: "redis_geo_{key}:{桶序号}", 桶序号为 时间戳 // bucket_seconds
+    写入时放进当前时间所在的桶, 每个桶在保留期过后自动过期, 查询时在一个pipeline中读取最近retention_buckets个桶并合并,
+    集合的大小只与保留期内写入的数量有关, 不会随时间无限增长
+
+    查询的代价: 每次search对每个桶各执行一次GEORADIUS, 足迹按天分桶保留30天即30条命令, 仍是一次网络往返.
+    GEORADIUS的代价是O(N + log(M)), M为桶的大小, N为命中的geohash格子内的成员数, 分桶后各桶的N之和与不分桶时相同,
+    多出来的是每条命令的固定开销(解析命令、9个相邻格子的zset范围查找, 空桶也要做), 约为单条命令的几微秒乘以桶数;
+    指定count时每个桶最多返回count个, 在python中合并的数量不超过retention_buckets * count.
+    nearest逐步扩大半径, 最坏情况是len(radius_steps)次往返 * retention_buckets条命令.
+    retention_buckets越大这部分开销越大, 不建议超过60, 需要更长的保留期时应加大bucket_seconds
+    """
+    def __init__(self, key, bucket_seconds, retention_buckets, redis_instance=redis):
+        super(ShardedRedisGeo, self).__init__(key, redis_instance)
+        self.bucket_seconds = bucket_seconds
+        self.retention_buckets = retention_buckets
+
+    def _get_bucket(self, timestamp=None):
+        return int((time.time() if timestamp is None else timestamp) // self.bucket_seconds)
+
+    def get_bucket_key(self, timestamp=None):
+        return '{}:{}'.format(self.cache_key, self._get_bucket(timestamp))
+
+    def get_retention_start(self):
+        """
+        :return: 保留期内最早的桶的开始时间戳, 更早写入的已过期
+        """
+        return (self._get_bucket() - self.retention_buckets + 1) * self.bucket_seconds
+
+    def _get_query_keys(self):
+        """
+        保留期内的所有桶, 新的在前
+        """
+        current_bucket = self._get_bucket()
+        return ['{}:{}'.format(self.cache_key, bucket)
+                for bucket in range(current_bucket, current_bucket - self.retention_buckets, -1)]
+
+    def add(self, *args, **kwargs):
+        """
+        添加位置到timestamp(默认为当前时间)所在的桶, 已超过保留期的不写入
+        :param args: lon, lat, place(如果传多个需要args是3的倍数)，限制为500个
+        :param timestamp: 写入的时间, 重建索引时使用
+        :param pipeline: 传了则只把命令加入这个pipeline(例如MULTI事务中), 由调用方执行, 返回None
+        """
+        if len(args) / 3 > 500:
+            raise DataError(u"一次最多添加500个！")
+        bucket = self._get_bucket(kwargs.get('timestamp'))
+        expire_time = (bucket + self.retention_buckets) * self.bucket_seconds - int(time.time())
+        if expire_time <= 0:
+            return 0
+        key = '{}:{}'.format(self.cache_key, bucket)
+        # 没有排队的命令时pipeline的布尔值为False, 不能用or
+        pipeline = kwargs.get('pipeline')
+        commands = self.redis.pipeline(transaction=False) if pipeline is None else pipeline
+        commands.geoadd(key, *args)
+        commands.expire(key, expire_time)
+        if pipeline is None:
+            return commands.execute()[0]
+
+    def remove(self, *members, pipeline=None):
+        """
+        从保留期内的所有桶中删除
+        :param pipeline: 同add
+        """
+        commands = self.redis.pipeline(transaction=False) if pipeline is None else pipeline
+        for key in self._get_query_keys():
+            commands.zrem(key, *members)
+        if pipeline is None:
+            return sum(commands.execute())
+
+    def get_position(self, *places):
+        """
+        :return: [[lon, lat], ...], 不存在的为None, 同一个地点在多个桶中时以最新的为准
+        """
+        if not places:
+            return []
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in self._get_query_keys():
+            pipeline.geopos(key, *places)
+        positions = [None] * len(places)
+        for bucket_positions in pipeline.execute():
+            positions = [position or bucket_position for position, bucket_position in zip(positions, bucket_positions)]
+        return positions
+
+    def get_hash(self, *members):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in self._get_query_keys():
+            pipeline.geohash(key, *members)
+        hashes = [None] * len(members)
+        for bucket_hashes in pipeline.execute():
+            hashes = [geohash or bucket_hash for geohash, bucket_hash in zip(hashes, bucket_hashes)]
+        return hashes
+
+    def get_members_within_radius(self, longitude, latitude, radius, unit=GeoUnitEnum.KM,
+                                  withdist=False, count=None, sort=None):
+        members = self.search(longitude, latitude, radius, unit, count=count, sort=sort)
+        if withdist:
+            return [[member.member, member.distance] for member in members]
+        return [member.member for member in members]
+
+    def get_members_within_radius_by_member(self, member, radius, unit=GeoUnitEnum.KM,
+                                            withdist=False, count=None, sort=None):
+        position = self.get_position(member)[0]
+        if not position:
+            raise DataError("member does not exist")
+        return self.get_members_within_radius(position[0], position[1], radius, unit, withdist, count, sort)
+
+    def geo_distance(self, place1, place2, unit=GeoUnitEnum.KM):
+        """
+        两个地点可能在不同的桶中, 取出坐标后用haversine计算, 与GEODIST的误差不超过0.5%
+        :return: float distance, 任意一个地点不存在时返回None
+        """
+        if unit not in GeoUnitEnum.values():
+            raise ValueError("unit is not in GeoUnit")
+        position1, position2 = self.get_position(place1, place2)
+        if not position1 or not position2:
+            return None
+        distance = distances_from(position1[1], position1[0], [(position2[1], position2[0])])[0]
+        return distance / METERS_PER_UNIT[unit]
+
+    def cache_exists(self):
+        """
+        保留期内是否有任何一个桶存在
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in self._get_query_keys():
+            pipeline.exists(key)
+        return any(pipeline.execute())
@@ -14,6 +14,7 @@ GeneralListCache: 用来管理一组list列表
 
 RedisCounter: 基于Redis的计数器
 DailyCounter: 每日计数器
+RedisLock: 带token的互斥锁
 
 BasicBadgeManager: Badge管理
 
@@ -25,6 +26,7 @@ import datetime
 import logging
 import pickle
 import time
+import uuid
 import zlib
 from random import randint
 
@@ -763,6 +765,85 @@ class RedisCounter(object):
         self._redis_instance.delete(self._cache_key)
 
 
+class CacheHitCounter(object):
+    """
+    记录缓存的命中/未命中次数, 用于观察命中率
+    创建时按名称登记, CacheHitCounter.all_stats()返回所有缓存的统计
+    """
+    _registry = {}
+
+    def __init__(self, name, redis_instance=redis, expire_time=MONTH_SECONDS):
+        self.name = name
+        self._cache_key = 'cache_hit_counter:{}'.format(name)
+        self._redis_instance = redis_instance
+        self.expire_time = expire_time
+        CacheHitCounter._registry[name] = self
+
+    def record(self, hit=0, miss=0):
+        """
+        一次请求中的命中数和未命中数一起记录, 只有一次网络往返
+        """
+        if not hit and not miss:
+            return
+        pipeline = self._redis_instance.pipeline(transaction=False)
+        pipeline.hincrby(self._cache_key, 'hit', hit)
+        pipeline.hincrby(self._cache_key, 'miss', miss)
+        pipeline.expire(self._cache_key, self.expire_time)
+        pipeline.execute()
+
+    def get_stats(self):
+        """
+        :return: {hit, miss, hit_ratio}
+        """
+        hit, miss = [int(value or 0) for value in self._redis_instance.hmget(self._cache_key, ['hit', 'miss'])]
+        total = hit + miss
+        return {'hit': hit, 'miss': miss, 'hit_ratio': round(hit / total, 4) if total else 0}
+
+    def clear(self):
+        self._redis_instance.delete(self._cache_key)
+
+    @classmethod
+    def all_stats(cls):
+        """
+        :return: {name: {hit, miss, hit_ratio}}
+        """
+        return {name: counter.get_stats() for name, counter in cls._registry.items()}
+
+
+class RedisLock(object):
+    """
+    SET NX EX实现的互斥锁, 值为每次加锁生成的随机token
+    释放时比较token再删除(WATCH + MULTI, key在比较之后被改动时不删除), 持有者超过过期时间才释放时不会删掉下一个持有者的锁
+    """
+
+    def __init__(self, key, expire_time, redis_instance=redis):
+        self.key = key
+        self.expire_time = expire_time
+        self._redis_instance = redis_instance
+
+    def acquire(self):
+        """
+        :return: 加锁成功时返回token, 释放时使用; 锁被其他人持有时返回None
+        """
+        token = uuid.uuid4().hex
+        if self._redis_instance.set(self.key, token, nx=True, ex=self.expire_time):
+            return token
+        return None
+
+    def release(self, token):
+        """
+        :return: 是否释放了token对应的锁, 锁已过期或已被其他人持有时返回False
+        """
+        def release(pipeline):
+            if pipeline.get(self.key) != token.encode('utf-8'):
+                return False
+            pipeline.multi()
+            pipeline.delete(self.key)
+            return True
+
+        return self._redis_instance.transaction(release, self.key, value_from_callable=True)
+
+
 class RedisList(_RedisStorageBase):
     """
     redis list
@@ -17,5 +17,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, '/db.sqlite3'),
+        # 并发测试需要多个连接同时写, 内存数据库(shared cache)遇到锁会直接报错, 改用文件数据库并等待锁
+        'OPTIONS': {'timeout': 30},
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
+
+# 测试时celery任务同步执行
+CELERY_ALWAYS_EAGER = True
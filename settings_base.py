@@ -124,5 +124,22 @@ REDIS = {
 
 BROKER_URL = 'redis://127.0.0.1:6379/0'
 
+# 为True时点赞数、评论数、转发数先累加在redis中, 由celery定时任务每COUNTER_FLUSH_INTERVAL秒批量写回数据库,
+# 必须同时运行celery beat(celery -A celery_apps beat), 否则计数不会写回
+COUNTER_WRITE_BEHIND = False
+COUNTER_FLUSH_INTERVAL = 10
+
+# 足迹的位置索引按天分桶, 只保留最近FOOTPRINT_LOCATION_RETENTION_DAYS天, 更早的足迹不出现在附近
+# 每次附近查询对每个桶各执行一次GEORADIUS(同一个pipeline), 不建议超过60, @see ShardedRedisGeo
+FOOTPRINT_LOCATION_RETENTION_DAYS = 30
+
+# 小程序access_token由celery定时任务每WX_ACCESS_TOKEN_CHECK_INTERVAL秒检查一次, 快过期时提前刷新
+WX_ACCESS_TOKEN_CHECK_INTERVAL = 5 * 60
+
+# 足迹、评论、私信的内容审核由celery任务异步执行, 审核通过前只有作者能看到
+ASYNC_MODERATION = False
+# 检测接口出错、任务重试用完仍在审核中的内容, 由celery定时任务每MODERATION_REQUEUE_INTERVAL秒重新投递
+MODERATION_REQUEUE_INTERVAL = 5 * 60
+
 USE_TZ = False
 TIME_ZONE = 'Asia/Shanghai'
@@ -0,0 +1,108 @@
+"""
+用户资料的两级缓存
+
+评论、私信、会话详情、足迹详情、个人资料页都要读用户的头像昵称, 这里用两级缓存挡在数据库前面:
+进程内LRU(PROFILE_LOCAL_TTL秒) -> redis "user_profile:{user_id}"(pickle, PROFILE_EXPIRE秒过期) -> 数据库, 未命中的逐级写回
+返回只读的UserProfile; 读取不会创建UserBaseInfo, 没有资料的用户返回默认值, 资料在登录时创建
+
+失效: UserBaseInfo保存(update_my_profile_db、创建资料)时删除redis和本进程的缓存,
+其他进程的本地缓存最多延迟PROFILE_LOCAL_TTL秒.
+回写与失效之间没有加锁: 读到旧资料的请求可能在失效之后才写回redis, 每个用户一个key并设置过期时间,
+这种情况下旧资料最多保留PROFILE_EXPIRE秒, 也不会有一个只增不减的大hash
+命中率(redis这一层): user_profile_hit_counter.get_stats(), 或staff访问 /api/cache_stats/
+"""
+import pickle
+from collections import namedtuple
+
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import CacheHitCounter
+from user_info.consts import SexChoices
+from user_info.models import UserBaseInfo
+from utilities.local_cache import LocalLRUCache
+from utilities.time_utils import get_age_by_birthday
+
+USER_PROFILE_KEY = 'user_profile:{}'
+PROFILE_EXPIRE = 60 * 60
+PROFILE_LOCAL_SIZE = 10000
+PROFILE_LOCAL_TTL = 30
+
+PROFILE_FIELDS = ('id', 'user_id', 'sex', 'avatar', 'nickname', 'location', 'signature', 'birthday', 'wechat_no',
+                  'show_wechat_no')
+
+user_profile_hit_counter = CacheHitCounter('user_profile')
+_local_profiles = LocalLRUCache(PROFILE_LOCAL_SIZE, PROFILE_LOCAL_TTL)
+
+
+class UserProfile(namedtuple('UserProfile', PROFILE_FIELDS)):
+    """
+    只读的用户资料, id为UserBaseInfo的id, 没有资料时为None
+    """
+    __slots__ = ()
+
+    @property
+    def age(self):
+        return get_age_by_birthday(self.birthday)
+
+    @classmethod
+    def from_user_info(cls, user_info):
+        return cls(*[getattr(user_info, field) for field in PROFILE_FIELDS])
+
+    @classmethod
+    def empty(cls, user_id):
+        return cls(id=None, user_id=user_id, sex=SexChoices.MALE, avatar=None, nickname=None, location=None,
+                   signature=None, birthday=None, wechat_no=None, show_wechat_no=False)
+
+
+def _load_profiles_db(user_ids):
+    """
+    一次IN查询, 没有资料的用户为默认值
+    """
+    result = {user_info.user_id: UserProfile.from_user_info(user_info)
+              for user_info in UserBaseInfo.objects.filter(user_id__in=user_ids)}
+    result.update({user_id: UserProfile.empty(user_id) for user_id in user_ids if user_id not in result})
+    return result
+
+
+def load_profiles(user_ids):
+    """
+    批量获取用户资料: 本进程命中的直接返回, 其余一次MGET, redis中也没有的一次IN查询, 然后逐级写回
+    :param user_ids: 可以重复
+    :return: {user_id: UserProfile}
+    """
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    result = _local_profiles.get_many(user_ids)
+    missed_ids = [user_id for user_id in user_ids if user_id not in result]
+    if not missed_ids:
+        return result
+    values = redis.mget([USER_PROFILE_KEY.format(user_id) for user_id in missed_ids])
+    loaded = {user_id: pickle.loads(value) for user_id, value in zip(missed_ids, values) if value is not None}
+    missed_ids = [user_id for user_id in missed_ids if user_id not in loaded]
+    user_profile_hit_counter.record(hit=len(loaded), miss=len(missed_ids))
+    if missed_ids:
+        profiles = _load_profiles_db(missed_ids)
+        pipeline = redis.pipeline(transaction=False)
+        for user_id, profile in profiles.items():
+            pipeline.setex(USER_PROFILE_KEY.format(user_id), PROFILE_EXPIRE,
+                           pickle.dumps(profile, pickle.HIGHEST_PROTOCOL))
+        pipeline.execute()
+        loaded.update(profiles)
+    _local_profiles.set_many(loaded)
+    result.update(loaded)
+    return result
+
+
+def get_profile(user_id):
+    """
+    :return: UserProfile
+    """
+    return load_profiles([user_id])[int(user_id)]
+
+
+def invalidate_profiles(*user_ids):
+    """
+    删除redis和本进程中的缓存
+    """
+    if user_ids:
+        user_ids = [int(user_id) for user_id in user_ids]
+        redis.delete(*[USER_PROFILE_KEY.format(user_id) for user_id in user_ids])
+        _local_profiles.delete(*user_ids)
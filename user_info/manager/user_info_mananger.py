@@ -2,8 +2,8 @@ import random
 
 from django.contrib.auth.models import User
 
+from user_info.manager.profile_manager import get_profile
 from user_info.models import UserBaseInfo
-from utilities.time_utils import get_age_by_birthday
 
 
 def random_password():
@@ -18,7 +18,7 @@ def get_or_create_user_db(username):
 
 def get_user_info_by_user_id_db(user_id):
     """
-    获取用户小窗页信息
+    获取用户资料记录, 没有时创建, 只在需要写入的地方使用; 只读时用profile_manager.get_profile
     :param user_id:
     :return:
     """
@@ -26,8 +26,20 @@ def get_user_info_by_user_id_db(user_id):
     return user_info
 
 
+def ensure_user_info_db(user, open_id=None):
+    """
+    登录时保证用户有资料记录, 之后读取资料不会再创建
+    :return: UserBaseInfo
+    """
+    user_info, _ = UserBaseInfo.objects.get_or_create(user=user, defaults={'open_id': open_id})
+    return user_info
+
+
 def get_user_infos_by_user_ids_db(user_ids):
-    return UserBaseInfo.objects.get(user_id__in=user_ids)
+    """
+    只读时用profile_manager.load_profiles, 有缓存且没有资料的用户也有默认值
+    """
+    return UserBaseInfo.objects.filter(user_id__in=user_ids)
 
 
 def update_my_profile_db(user, sex, avatar, location, nickname, wechat_no, show_wechat_no, signature, birthday):
@@ -66,13 +78,13 @@ def get_user_brief_profile(user_id):
     :param user_id:
     :return:
     """
-    user_info = get_user_info_by_user_id_db(user_id)
+    profile = get_profile(user_id)
     return {
-        'avatar': user_info.avatar,
-        'nickname': user_info.nickname,
-        'sex': user_info.sex,
-        'age': get_age_by_birthday(user_info.birthday),
-        'signature': user_info.signature,
+        'avatar': profile.avatar,
+        'nickname': profile.nickname,
+        'sex': profile.sex,
+        'age': profile.age,
+        'signature': profile.signature,
     }
 
 
@@ -26,6 +26,12 @@ class UserBaseInfo(models.Model):
     def age(self):
         return get_age_by_birthday(self.birthday)
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        super(UserBaseInfo, self).save(force_insert, force_update, using, update_fields)
+        from user_info.manager.profile_manager import invalidate_profiles
+        invalidate_profiles(self.user_id)
+
     class Meta:
         verbose_name = u'用户信息'
         verbose_name_plural = u'用户信息'
@@ -0,0 +1,176 @@
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from api.testing import mock
+from chat.manager.chat_manager import build_conversation_list, get_conversation_id_by_user_ids, \
+    get_or_create_conversation_info
+from commercial.manager.activity_manager import build_activity_participants
+from commercial.models import ActivityParticipant
+from commercial.testing.mock import create_activity
+from footprint.manager.footprint_manager import build_footprint_detail
+from footprint.models import Comment, FlowType
+from redis_utils.container.api_redis_client import redis
+from user_info.manager.profile_manager import get_profile, load_profiles, _local_profiles, user_profile_hit_counter, \
+    UserProfile, USER_PROFILE_KEY, PROFILE_EXPIRE
+from user_info.manager.user_info_mananger import update_my_profile_db, ensure_user_info_db
+from user_info.models import UserBaseInfo
+from utilities.local_cache import LocalLRUCache
+from utilities.mock_utility.mock import create_user
+
+
+class ProfileCacheTest(TestCase):
+    """
+    python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        _local_profiles.clear()
+
+    def test_local_lru_cache(self):
+        """
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_local_lru_cache
+        """
+        cache = LocalLRUCache(2, 10)
+        with patch('utilities.local_cache.time.monotonic', return_value=100):
+            cache.set_many({1: 'a', 2: 'b'})
+            self.assertEqual(cache.get(1), 'a')
+            # 1刚被访问过, 淘汰的是2
+            cache.set(3, 'c')
+            self.assertEqual(cache.get_many([1, 2, 3]), {1: 'a', 3: 'c'})
+            cache.delete(1)
+            self.assertIsNone(cache.get(1))
+        with patch('utilities.local_cache.time.monotonic', return_value=110):
+            self.assertIsNone(cache.get(3))
+            self.assertEqual(len(cache), 0)
+
+    def test_profile_cache(self):
+        """
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_profile_cache
+        """
+        user = create_user()
+        user_info = mock.create_user_info(user)
+        user_profile_hit_counter.clear()
+
+        with self.assertNumQueries(1):
+            profile = get_profile(user.id)
+        self.assertEqual((profile.id, profile.nickname, profile.age), (user_info.id, user_info.nickname, user_info.age))
+        with self.assertRaises(AttributeError):
+            profile.nickname = 'changed'
+        # 本进程命中不访问redis, 本地缓存清掉后从redis读取
+        with self.assertNumQueries(0):
+            self.assertEqual(get_profile(user.id), profile)
+        _local_profiles.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_profile(str(user.id)), profile)
+        self.assertEqual(user_profile_hit_counter.get_stats()['hit'], 1)
+        # 每个用户一个key, 有过期时间
+        self.assertTrue(0 < redis.ttl(USER_PROFILE_KEY.format(user.id)) <= PROFILE_EXPIRE)
+
+        # 修改资料后失效
+        update_my_profile_db(user, None, 'new.jpg', None, 'new_name', None, None, None, None)
+        profile = get_profile(user.id)
+        self.assertEqual((profile.avatar, profile.nickname), ('new.jpg', 'new_name'))
+
+    def test_profile_read_without_insert(self):
+        """
+        读取不会创建资料, 登录时创建
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_profile_read_without_insert
+        """
+        user = create_user()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_profile(user.id), UserProfile.empty(user.id))
+        self.assertFalse(UserBaseInfo.objects.filter(user=user).exists())
+
+        user_info = ensure_user_info_db(user, 'open_id')
+        self.assertEqual(get_profile(user.id).id, user_info.id)
+        self.assertEqual(ensure_user_info_db(user).id, user_info.id)
+
+    def test_load_profiles(self):
+        """
+        去重, 本进程和redis命中的不查库, 其余一次IN查询
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_load_profiles
+        """
+        user_infos = [mock.create_user_info(create_user()) for _ in range(5)]
+        user_ids = [user_info.user_id for user_info in user_infos]
+        get_profile(user_ids[0])
+        get_profile(user_ids[1])
+        _local_profiles.delete(user_ids[1])
+        user_profile_hit_counter.clear()
+
+        with self.assertNumQueries(1):
+            profiles = load_profiles(user_ids + user_ids[::-1] + [str(user_ids[2])])
+        self.assertEqual(sorted(profiles), sorted(user_ids))
+        self.assertEqual([profiles[user_info.user_id].nickname for user_info in user_infos],
+                         [user_info.nickname for user_info in user_infos])
+        self.assertEqual(user_profile_hit_counter.get_stats()['hit'], 1)
+        self.assertEqual(user_profile_hit_counter.get_stats()['miss'], 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(load_profiles(user_ids), profiles)
+        self.assertEqual(load_profiles([]), {})
+
+    def _create_user_infos(self, num):
+        return [mock.create_user_info(create_user()) for _ in range(num)]
+
+    def test_comment_fallback(self):
+        """
+        评论者没有资料时用评论时记录的头像昵称
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_comment_fallback
+        """
+        author_info = mock.create_user_info(create_user())
+        footprint = mock.create_footprint(author_info)
+        commenter = create_user()
+        Comment.objects.create(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT, user_id=commenter.id,
+                               comment='comment', name='stored_name', avatar='stored.jpg')
+        comments = build_footprint_detail(footprint, commenter.id)['comments']
+        self.assertEqual([(item['name'], item['avatar']) for item in comments], [('stored_name', 'stored.jpg')])
+
+        mock.create_user_info(commenter)
+        update_my_profile_db(commenter, None, 'new.jpg', None, 'new_name', None, None, None, None)
+        comments = build_footprint_detail(footprint, commenter.id)['comments']
+        self.assertEqual([(item['name'], item['avatar']) for item in comments], [('new_name', 'new.jpg')])
+
+    def test_list_query_count(self):
+        """
+        评论列表、报名者列表、会话详情的查询次数与人数无关
+        python manage.py test --settings=settings-test user_info.testing.test_profile_cache.ProfileCacheTest.test_list_query_count
+        """
+        viewer = create_user()
+        for num in (2, 8):
+            user_infos = self._create_user_infos(num)
+            footprint = mock.create_footprint(user_infos[0])
+            for user_info in user_infos:
+                Comment.objects.create(flow_id=footprint.id, flow_type=FlowType.FOOTPRINT, user_id=user_info.user_id,
+                                       comment='comment')
+            activity = create_activity()
+            for user_info in user_infos:
+                ActivityParticipant.objects.create(activity=activity, user_info=user_info, name='name',
+                                                   cellphone='110', num=1, hint='')
+            redis.flushdb()
+            _local_profiles.clear()
+
+            # 评论列表 + 资料IN查询 + 是否点赞
+            with self.assertNumQueries(3):
+                detail = build_footprint_detail(footprint, viewer.id)
+            self.assertEqual(sorted(comment['name'] for comment in detail['comments']),
+                             sorted(user_info.nickname for user_info in user_infos))
+            _local_profiles.clear()
+            redis.flushdb()
+            # 报名者user_id + 资料IN查询
+            with self.assertNumQueries(2):
+                participants = build_activity_participants(activity.id)
+            self.assertEqual(sorted(item['user_id'] for item in participants),
+                             sorted(user_info.user_id for user_info in user_infos))
+            with self.assertNumQueries(1):
+                build_activity_participants(activity.id)
+
+        sender, receiver = self._create_user_infos(2)
+        conversation_id = get_conversation_id_by_user_ids([sender.user_id, receiver.user_id])
+        conversation_info, _ = get_or_create_conversation_info(conversation_id, sender.user_id, receiver.user_id)
+        _local_profiles.clear()
+        redis.flushdb()
+        # 聊天记录 + 双方资料一次IN查询
+        with self.assertNumQueries(2):
+            result = build_conversation_list(sender.user_id, conversation_id, conversation_info, 0, 0)
+        self.assertEqual(result['receiver_info'], {'user_id': receiver.user_id, 'avatar': receiver.avatar})
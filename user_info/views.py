@@ -1,11 +1,11 @@
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 
-from user_info.manager.user_info_mananger import update_my_profile_db, get_user_info_by_user_id_db, \
-    get_user_brief_profile
+from user_info.manager.profile_manager import get_profile
+from user_info.manager.user_info_mananger import update_my_profile_db, get_user_brief_profile
 from utilities.content_check import is_content_valid
 from utilities.date_time import str_to_datetime, datetime_to_str
-from utilities.image_check import is_image_valid
+from utilities.image_check import are_images_valid
 from utilities.request_utils import get_data_from_request
 from utilities.response import json_http_success, json_http_error
 
@@ -25,9 +25,10 @@ def set_my_profile_view(request):
     avatar = post_data.get('avatar')
     location = post_data.get('location')
     nickname = post_data.get('nickname')
-    if not is_content_valid(nickname):
+    if nickname and not is_content_valid(nickname):
         return json_http_error(u'不合法')
-    if not is_image_valid(avatar):
+    # 头像没有修改时命中审核缓存
+    if avatar and not are_images_valid([avatar]):
         return json_http_error(u'不合法')
     birthday = post_data.get('birthday')
     wechat_no = post_data.get('wechat_no')
@@ -50,7 +51,7 @@ def get_my_profile_view(request):
     :param request:
     :return:
     """
-    user_info = get_user_info_by_user_id_db(request.user.id)
+    user_info = get_profile(request.user.id)
     result = {
         'avatar': user_info.avatar or '',
         'nickname': user_info.nickname or '',
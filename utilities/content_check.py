@@ -1,43 +1,149 @@
 """
 内容检测相关
+
+文本检测的结果缓存
+昵称、评论、私信、足迹正文每次都同步调用微信msg_sec_check, 一次HTTPS往返约100~300ms,
+而"你好"、表情、重复的昵称这类相同文本会被反复检测. 这里按文本的sha1缓存检测结论:
+进程内LRU(VERDICT_LOCAL_TTL秒) -> redis "content_verdict:{sha1}" -> 微信接口, 未命中的逐级写回
+缓存key只去掉首尾空白, 不做全角转半角、合并空白等规范化: 微信检测的是原文, 规范化后相同的两段文本结论可能不同,
+用一段文本的结论代替另一段会被用来绕过检测
+redis中合规的结论保存CONTENT_VALID_EXPIRE秒, 违规的保存更久(CONTENT_INVALID_EXPIRE秒), 违规文本往往会被反复提交;
+只缓存微信给出的结论(合规, 或errcode为87014), access_token失效、系统繁忙等错误不缓存;
+get_content_verdict在出错时返回None, 由异步审核重试, 同步检测的is_content_valid仍按不合规处理
+
+命中率(redis这一层): content_verdict_hit_counter.get_stats(), 或staff访问 /api/cache_stats/
+基准(模拟微信接口延迟200ms, footprint.testing.benchmark_content_check):
+评论接口/私信接口, 相同文本第二次起的耗时由 ~200ms 降到 ~5ms
 """
+import hashlib
 import json
 
-import qiniu
 import requests
+from django.conf import settings
 
 from log_utils.loggers import info_logger
-from utilities.upload_utils import QINIU_ACCESS_KEY, QINIU_SECRET_KEY
-from weixin.manager.token import get_access_token
+from redis_utils.container.api_redis_client import redis
+from redis_utils.container.api_redis_container import CacheHitCounter, DAY_SECONDS
+from utilities.local_cache import LocalLRUCache
+from weixin.consts import SYNC_REQUEST_TIME_OUT
+from weixin.manager.token import get_access_token, refresh_access_token, INVALID_TOKEN_ERRCODES
 
 MSG_URL = 'https://api.weixin.qq.com/wxa/msg_sec_check?access_token={}'
+# 内容含有违法违规内容
+RISKY_CONTENT_ERRCODE = 87014
 
+CONTENT_VERDICT_KEY = 'content_verdict:{}'
+CONTENT_VALID_EXPIRE = DAY_SECONDS
+CONTENT_INVALID_EXPIRE = 7 * DAY_SECONDS
+VERDICT_LOCAL_SIZE = 10000
+VERDICT_LOCAL_TTL = 600
 
-def is_content_valid(content):
+
+class VerdictCache(object):
     """
-    检查内容是否合规
-    :param content:
-    :return:
+    审核结论的两级缓存: 进程内LRU -> redis "{name}:{digest}", 合规和违规的结论在redis中保存不同的时间
+    命中率统计redis这一层, 名称为name
+    """
+
+    def __init__(self, name, valid_expire, invalid_expire):
+        self._key = name + ':{}'
+        self.valid_expire = valid_expire
+        self.invalid_expire = invalid_expire
+        self.hit_counter = CacheHitCounter(name)
+        self.local = LocalLRUCache(VERDICT_LOCAL_SIZE, VERDICT_LOCAL_TTL)
+
+    def get_many(self, digests):
+        """
+        本进程未命中的一次MGET
+        :return: {digest: True/False}, 只包含命中的
+        """
+        result = self.local.get_many(digests)
+        missed = [digest for digest in digests if digest not in result]
+        if not missed:
+            return result
+        values = redis.mget([self._key.format(digest) for digest in missed])
+        loaded = {digest: bool(int(value)) for digest, value in zip(missed, values) if value is not None}
+        self.hit_counter.record(hit=len(loaded), miss=len(missed) - len(loaded))
+        self.local.set_many(loaded)
+        result.update(loaded)
+        return result
+
+    def get(self, digest):
+        return self.get_many([digest]).get(digest)
+
+    def set(self, digest, verdict):
+        redis.setex(self._key.format(digest), self.valid_expire if verdict else self.invalid_expire, int(verdict))
+        self.local.set(digest, verdict)
+
+
+content_verdict_cache = VerdictCache('content_verdict', CONTENT_VALID_EXPIRE, CONTENT_INVALID_EXPIRE)
+content_verdict_hit_counter = content_verdict_cache.hit_counter
+_local_verdicts = content_verdict_cache.local
+
+
+def is_async_moderation_enabled():
+    """
+    足迹、评论、私信是否异步审核, @see footprint.manager.moderation_manager
+    """
+    return getattr(settings, 'ASYNC_MODERATION', False)
+
+
+def get_content_digest(content):
+    """
+    去掉首尾空白后文本的sha1, 作为检测结论的缓存key
+    """
+    return hashlib.sha1(content.strip().encode('utf-8')).hexdigest()
+
+
+def _check_content(content):
+    """
+    调用微信接口检测, access_token失效时刷新后重试一次
+    :return: True/False, 接口出错时返回None
     """
-    access_token = get_access_token()
     data = {"content": content}
     data = json.dumps(data, ensure_ascii=False)
     headers = {'Content-Type': 'application/json'}
-    result = requests.post(MSG_URL.format(access_token), data.encode('utf-8'), headers=headers).json()
-    if result['errcode'] != 0:
-        info_logger.info('content:{}, check result: {}'.format(content, result['errmsg']))
+    access_token = get_access_token()
+    for _ in range(2):
+        if access_token is None:
+            return None
+        try:
+            result = requests.post(MSG_URL.format(access_token), data.encode('utf-8'), headers=headers,
+                                   timeout=SYNC_REQUEST_TIME_OUT).json()
+        except (requests.RequestException, ValueError) as e:
+            info_logger.info('content:{}, check failed: {}'.format(content, e))
+            return None
+        if result['errcode'] not in INVALID_TOKEN_ERRCODES:
+            break
+        access_token = refresh_access_token(stale_token=access_token)
+    if result['errcode'] == 0:
+        return True
+    info_logger.info('content:{}, check result: {}'.format(content, result['errmsg']))
+    if result['errcode'] == RISKY_CONTENT_ERRCODE:
         return False
-    return True
-
-
-def is_image_valid(image_url):
-    url = "http://ai.qiniuapi.com/v3/image/censor"
-    body = {'data': {'uri': image_url}, "params": {"scene": ['pulp', 'terror', 'politician']}}
-    q = qiniu.Auth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY)
-    header = {'Content-Type': 'application/json',
-              'Authorization': 'Qiniu {}'.format(q.token_of_request(url, body, 'application/json'))}
-    print(header)
-    result = requests.post(url, {'data': {'uri': image_url},
-                                 "params": {"scene": ['pulp', 'terror', 'politician']}}, headers=header).json()
-    print(result)
+    return None
+
+
+def get_content_verdict(content):
+    """
+    检查内容是否合规, 相同文本的结论走缓存
+    :return: True/False, 检测接口出错时返回None
+    """
+    digest = get_content_digest(content)
+    verdict = content_verdict_cache.get(digest)
+    if verdict is not None:
+        return verdict
+    verdict = _check_content(content)
+    if verdict is not None:
+        content_verdict_cache.set(digest, verdict)
+    return verdict
+
+
+def is_content_valid(content):
+    """
+    检查内容是否合规, 检测接口出错时按不合规处理
+    :param content:
+    :return:
+    """
+    return bool(get_content_verdict(content))
 
@@ -0,0 +1,52 @@
+"""
+数据库计数字段的原子更新
+
+点赞数、评论数等计数如果先读出整行再save, 并发时会丢失更新, 且会把整行所有字段都重写一遍
+这里只用一条UPDATE完成自增, 并且不需要再SELECT一次就能拿到新值:
+sqlite/postgresql: UPDATE ... RETURNING
+mysql: UPDATE ... SET field = LAST_INSERT_ID(expr), 新值通过同一连接的cursor.lastrowid返回
+其他数据库退化为F表达式更新后再查询
+"""
+from django.db import connections, router
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+def _build_update_sql(connection, table, column, pk_column):
+    quote_name = connection.ops.quote_name
+    table, column, pk_column = quote_name(table), quote_name(column), quote_name(pk_column)
+    if connection.vendor == 'mysql':
+        return 'UPDATE {table} SET {column} = LAST_INSERT_ID(GREATEST({column} + %s, 0)) WHERE {pk} = %s'.format(
+            table=table, column=column, pk=pk_column)
+    # sqlite的多参数MAX即为取最大值
+    greatest = 'GREATEST' if connection.vendor == 'postgresql' else 'MAX'
+    return 'UPDATE {table} SET {column} = {greatest}({column} + %s, 0) WHERE {pk} = %s RETURNING {column}'.format(
+        table=table, column=column, greatest=greatest, pk=pk_column)
+
+
+def incr_counter_db(model, pk, field_name, delta=1):
+    """
+    原子地给计数字段加上delta, 结果不会小于0
+    :param model: Model类
+    :param pk: 记录主键
+    :param field_name: 计数字段名
+    :param delta: 增量, 可以为负数
+    :return: 更新后的值, 记录不存在时返回None
+    """
+    db_alias = router.db_for_write(model)
+    connection = connections[db_alias]
+    column = model._meta.get_field(field_name).column
+    if connection.vendor not in ('mysql', 'postgresql', 'sqlite'):
+        updated = model.objects.using(db_alias).filter(pk=pk).update(
+            **{field_name: Greatest(F(field_name) + delta, 0)})
+        if not updated:
+            return None
+        return model.objects.using(db_alias).values_list(field_name, flat=True).get(pk=pk)
+
+    sql = _build_update_sql(connection, model._meta.db_table, column, model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [delta, pk])
+        if connection.vendor == 'mysql':
+            return cursor.lastrowid if cursor.rowcount else None
+        row = cursor.fetchone()
+    return row[0] if row else None
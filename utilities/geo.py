@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+地理位置相关计算
+
+distances_from: 计算一个原点到一组点的距离, 使用NumPy一次向量化完成(haversine公式)
+
+精度说明:
+haversine把地球当作半径为EARTH_RADIUS的正球体, 而geopy.distance.geodesic使用WGS84椭球,
+两者的相对误差不超过0.6%(南北方向、低纬度时误差最大), 即10km的距离误差不超过60m,
+对于列表里展示"距离xx"完全足够. 需要精确距离的地方仍然使用geodesic
+可以直接运行本文件查看误差和耗时对比: python utilities/geo.py
+"""
+import math
+
+import numpy as np
+from django.db.models import Q
+
+EARTH_RADIUS = 6371008.8  # 地球平均半径, 单位米
+MAX_RELATIVE_ERROR = 0.006  # 与geodesic相比的最大相对误差
+METERS_PER_LAT_DEGREE = math.pi * EARTH_RADIUS / 180
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_MAX_PRECISION = 12
+
+
+def _to_float(value):
+    """
+    经纬度转为float, 无法解析时返回nan
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def distances_from(lat, lon, points):
+    """
+    计算(lat, lon)到points中每个点的距离, 一次向量化计算完成
+    :param lat: 原点纬度
+    :param lon: 原点经度
+    :param points: [(lat, lon), ...], 经纬度可以是字符串, 缺失或无法解析的点距离为0
+    :return: [meters, ...], 与points一一对应
+    """
+    if not points:
+        return []
+    coordinates = np.radians(np.array([(_to_float(p_lat), _to_float(p_lon)) for p_lat, p_lon in points],
+                                      dtype=np.float64))
+    origin_lat, origin_lon = math.radians(float(lat)), math.radians(float(lon))
+    delta_lat = coordinates[:, 0] - origin_lat
+    delta_lon = coordinates[:, 1] - origin_lon
+    a = np.sin(delta_lat / 2) ** 2 + math.cos(origin_lat) * np.cos(coordinates[:, 0]) * np.sin(delta_lon / 2) ** 2
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return np.nan_to_num(distances).tolist()
+
+
+def encode_geohash(lat, lon, precision=GEOHASH_MAX_PRECISION):
+    """
+    经纬度转换为geohash, 前缀相同的点在同一个格子里
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    result, bits, bit_count, is_lon = [], 0, 0, True
+    while len(result) < precision:
+        value_range, value = (lon_range, lon) if is_lon else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        is_lon = not is_lon
+        bit_count += 1
+        if bit_count == 5:
+            result.append(GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(result)
+
+
+def decode_geohash(geohash):
+    """
+    :return: 格子的范围 (min_lat, max_lat, min_lon, max_lon)
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    is_lon = True
+    for char in geohash:
+        bits = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if is_lon else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            is_lon = not is_lon
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def get_geohash_cell_size(precision):
+    """
+    :return: 指定精度下格子的(纬度跨度, 经度跨度), 单位度
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def get_geohash_precision(lat, radius):
+    """
+    获取能让3x3个格子覆盖半径radius(米)的最大精度
+    """
+    lon_scale = max(math.cos(math.radians(lat)), 0.01)
+    for precision in range(GEOHASH_MAX_PRECISION, 0, -1):
+        lat_size, lon_size = get_geohash_cell_size(precision)
+        if min(lat_size, lon_size * lon_scale) * METERS_PER_LAT_DEGREE >= radius:
+            return precision
+    return 1
+
+
+def get_geohash_neighbors(geohash, steps=1):
+    """
+    :param steps: 向外扩展的圈数
+    :return: 包括自身在内的周围(2 * steps + 1) ** 2个格子, 位于两极时会更少
+    """
+    min_lat, max_lat, min_lon, max_lon = decode_geohash(geohash)
+    lat_size, lon_size = max_lat - min_lat, max_lon - min_lon
+    center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    neighbors = []
+    for lat_step in range(-steps, steps + 1):
+        lat = center_lat + lat_step * lat_size
+        if not -90 < lat < 90:
+            continue
+        for lon_step in range(-steps, steps + 1):
+            lon = (center_lon + lon_step * lon_size + 180) % 360 - 180
+            neighbor = encode_geohash(lat, lon, len(geohash))
+            if neighbor not in neighbors:
+                neighbors.append(neighbor)
+    return neighbors
+
+
+def get_bounding_box(lat, lon, radius):
+    """
+    :param radius: 半径, 单位米
+    :return: 包含以(lat, lon)为圆心的圆的矩形 (min_lat, max_lat, min_lon, max_lon)
+    """
+    lat_delta = radius / METERS_PER_LAT_DEGREE
+    lon_delta = radius / (METERS_PER_LAT_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return max(lat - lat_delta, -90), min(lat + lat_delta, 90), lon - lon_delta, lon + lon_delta
+
+
+def get_cluster_precision(zoom, cell_pixels=64, area=None, lat=0, max_cells=None):
+    """
+    根据地图缩放级别选择聚合用的geohash精度, 使每个格子在屏幕上约cell_pixels像素宽
+    缩放级别与web墨卡托一致: zoom级时256像素对应360 / 2 ** zoom度经度
+    :param area: 聚合区域的面积, 单位平方米, 与max_cells一起传时区域内的格子数超过max_cells就降低精度,
+                 避免放大地图查询大半径时每个点各成一个格子
+    :param lat: 区域中心的纬度, 用于计算格子面积
+    """
+    target_lon_size = 360.0 / 2 ** zoom * cell_pixels / 256
+    precision = 1
+    for precision in range(GEOHASH_MAX_PRECISION, 0, -1):
+        if get_geohash_cell_size(precision)[1] >= target_lon_size:
+            break
+    if area is None or max_cells is None:
+        return precision
+    lon_scale = max(math.cos(math.radians(lat)), 0.01)
+    while precision > 1:
+        lat_size, lon_size = get_geohash_cell_size(precision)
+        if area <= max_cells * lat_size * lon_size * lon_scale * METERS_PER_LAT_DEGREE ** 2:
+            break
+        precision -= 1
+    return precision
+
+
+def cluster_points(points, precision, sample_size=3):
+    """
+    按geohash格子聚合, 一次向量化计算完成
+    精度为precision的geohash格子就是把经度等分2 ** lon_bits份、纬度等分2 ** lat_bits份的网格,
+    所以只需要算出每个点所在的行列号, 不需要逐个计算geohash字符串
+    :param points: [(id, lon, lat), ...]
+    :param sample_size: 每个格子返回的示例id数量
+    :return: [{geohash, count, lon, lat, sample_ids}, ...], lon/lat为格子内点的中心, 按数量由多到少排序
+    """
+    if not points:
+        return []
+    ids = np.array([point[0] for point in points])
+    coordinates = np.array([(point[1], point[2]) for point in points], dtype=np.float64)
+    lat_size, lon_size = get_geohash_cell_size(precision)
+    lon_index = np.floor((coordinates[:, 0] + 180) / lon_size).astype(np.int64)
+    lat_index = np.floor((coordinates[:, 1] + 90) / lat_size).astype(np.int64)
+    cells, inverse, counts = np.unique(lon_index * 2 ** 32 + lat_index, return_inverse=True, return_counts=True)
+    lon_centers = np.bincount(inverse, weights=coordinates[:, 0]) / counts
+    lat_centers = np.bincount(inverse, weights=coordinates[:, 1]) / counts
+    # 同一格子的点排在一起, 取每组的前sample_size个
+    grouped_ids = np.split(ids[np.argsort(inverse, kind='stable')], np.cumsum(counts)[:-1])
+
+    clusters = []
+    for cell_index in np.argsort(-counts, kind='stable'):
+        cell_lon_index, cell_lat_index = divmod(int(cells[cell_index]), 2 ** 32)
+        clusters.append({
+            'geohash': encode_geohash((cell_lat_index + 0.5) * lat_size - 90,
+                                      (cell_lon_index + 0.5) * lon_size - 180, precision),
+            'count': int(counts[cell_index]),
+            'lon': float(lon_centers[cell_index]),
+            'lat': float(lat_centers[cell_index]),
+            'sample_ids': grouped_ids[cell_index][:sample_size].tolist(),
+        })
+    return clusters
+
+
+def get_viewport_size(min_lon, min_lat, max_lon, max_lat):
+    """
+    :return: 矩形的(宽, 高), 单位米, 宽按中心纬线计算
+    """
+    center_lat = math.radians((min_lat + max_lat) / 2)
+    return (max_lon - min_lon) * METERS_PER_LAT_DEGREE * math.cos(center_lat), \
+        (max_lat - min_lat) * METERS_PER_LAT_DEGREE
+
+
+def bounding_box_filter(lat, lon, radius, lat_field='latitude', lon_field='longitude'):
+    """
+    矩形范围过滤条件, 跨越180度经线时不做经度过滤
+    :return: Q
+    """
+    min_lat, max_lat, min_lon, max_lon = get_bounding_box(lat, lon, radius)
+    query = Q(**{lat_field + '__range': (min_lat, max_lat)})
+    if min_lon >= -180 and max_lon <= 180:
+        query &= Q(**{lon_field + '__range': (min_lon, max_lon)})
+    return query
+
+
+def geohash_filter(lat, lon, radius, field='geohash'):
+    """
+    geohash前缀过滤条件, 周围9个格子的前缀匹配, 可以走geohash字段的索引
+    :return: Q
+    """
+    precision = get_geohash_precision(lat, radius)
+    query = Q()
+    for neighbor in get_geohash_neighbors(encode_geohash(lat, lon, precision)):
+        query |= Q(**{field + '__startswith': neighbor})
+    return query
+
+
+if __name__ == "__main__":
+    # 精度及耗时对比: 逐条geodesic vs 向量化haversine
+    import random
+    import timeit
+
+    from geopy.distance import geodesic
+
+    origin = (39.9, 116.4)
+    for size in (20, 1000, 100000):
+        sample = [(random.uniform(-80, 80), random.uniform(-180, 180)) for _ in range(size)]
+        geodesic_cost = timeit.timeit(lambda: [geodesic(origin, point).meters for point in sample], number=1)
+        haversine_cost = timeit.timeit(lambda: distances_from(origin[0], origin[1], sample), number=1)
+        exact = [geodesic(origin, point).meters for point in sample[:1000]]
+        approx = distances_from(origin[0], origin[1], sample[:1000])
+        max_error = max(abs(a - e) / e for a, e in zip(approx, exact) if e)
+        assert max_error < MAX_RELATIVE_ERROR
+        print('points: {:>6}  geodesic: {:.4f}s  haversine: {:.4f}s  speedup: {:.0f}x  max relative error: {:.4%}'
+              .format(size, geodesic_cost, haversine_cost, geodesic_cost / haversine_cost, max_error))
@@ -1,25 +1,133 @@
-from qiniu import QiniuMacAuth, http
+"""
+图片审核
 
+七牛的图片审核一张图一次HTTP请求, 发一条9张图的足迹原来要串行等9次往返. are_images_valid批量审核:
+- 先按图片URL的sha1查审核结论缓存(进程内LRU -> redis "image_verdict:{sha1}", @see utilities.content_check.VerdictCache),
+  头像没改、同一张图重复发送都不会再请求七牛
+- 未命中的图片提交到进程内有界线程池(IMAGE_CHECK_WORKERS)并发审核, 任意一张不通过立即返回, 还没开始的审核直接取消,
+  已经在进行的审核完成后仍会写入缓存
+- 七牛返回错误、抛出异常或超过IMAGE_CHECK_TIMEOUT秒时不缓存, get_images_verdict返回None(异步审核据此重试),
+  are_images_valid按不通过处理
+- 只有一张图未命中(修改头像、私信图片)时也提交到线程池, 请求线程最多等待IMAGE_CHECK_TIMEOUT秒, 小于uwsgi的harakiri;
+  每次请求七牛的连接和读取超时也是IMAGE_CHECK_TIMEOUT秒, 超时后仍在进行的审核不会长时间占用线程池
+
+命中率(redis这一层): image_verdict_cache.hit_counter.get_stats(), 或staff访问 /api/cache_stats/
+基准(模拟七牛延迟200ms, footprint.testing.benchmark_content_check.ImageCheckBenchmark): 9张图 串行 ~1800ms -> 并发 ~200ms, 再次审核 <5ms
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+import requests
+from qiniu import QiniuMacAuth
+from qiniu.auth import QiniuMacRequestsAuth
+
+from log_utils.loggers import info_logger
+from redis_utils.container.api_redis_container import DAY_SECONDS
+from utilities.content_check import VerdictCache
 from utilities.upload_utils import QINIU_ACCESS_KEY, QINIU_SECRET_KEY
 
+CENSOR_URL = 'http://ai.qiniuapi.com/v3/image/censor'
+CENSOR_SCENES = ['pulp', 'terror', 'politician']
 
-def is_image_valid(image_url):
-    url = 'http://ai.qiniuapi.com/v3/image/censor'
-    auth = QiniuMacAuth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY)
+IMAGE_VALID_EXPIRE = 7 * DAY_SECONDS
+IMAGE_INVALID_EXPIRE = 30 * DAY_SECONDS
+# 一条足迹最多9张图, 每个进程的审核线程数
+IMAGE_CHECK_WORKERS = 9
+IMAGE_CHECK_TIMEOUT = 5
+
+image_verdict_cache = VerdictCache('image_verdict', IMAGE_VALID_EXPIRE, IMAGE_INVALID_EXPIRE)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    线程池在第一次审核时才创建, 避免uwsgi master加载应用后fork出的worker继承不能用的线程
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=IMAGE_CHECK_WORKERS, thread_name_prefix='image_check')
+    return _executor
+
+
+def get_image_digest(image_url):
+    return hashlib.sha1(image_url.encode('utf-8')).hexdigest()
+
+
+def _check_image(image_url):
+    """
+    调用七牛审核一张图片
+    :return: True/False, 接口出错时返回None
+    """
+    auth = QiniuMacRequestsAuth(QiniuMacAuth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY))
     body = {
         "data": {
-            "uri": "<uri>"
+            "uri": image_url
         },
         "params": {
-            "scenes": []
+            "scenes": CENSOR_SCENES
         }
     }
-    body["params"]["scenes"] = ['pulp', 'terror', 'politician']
-    body["data"]["uri"] = image_url
-    ret, res = http._post_with_qiniu_mac(url, body, auth)
-
-    if res.status_code == 200:
-        is_valid = ret['result']['suggestion'] == 'pass'
-    else:
-        is_valid = False
-    return is_valid
+    try:
+        # qiniu.http的请求用的是全局的connection_timeout(默认30秒), 这里单独指定超时
+        res = requests.post(CENSOR_URL, json=body, auth=auth, timeout=IMAGE_CHECK_TIMEOUT)
+        if res.status_code != 200:
+            info_logger.info('image:{}, censor failed: {}'.format(image_url, res.status_code))
+            return None
+        return res.json()['result']['suggestion'] == 'pass'
+    except Exception as e:
+        info_logger.info('image:{}, censor failed: {}'.format(image_url, e))
+        return None
+
+
+def _check_and_cache(image_url, digest):
+    verdict = _check_image(image_url)
+    if verdict is not None:
+        image_verdict_cache.set(digest, verdict)
+    return verdict
+
+
+def get_images_verdict(image_urls):
+    """
+    批量审核图片
+    :param image_urls: 可以重复, 空值忽略
+    :return: 全部通过为True, 任意一张不通过为False, 没有不通过但有图片审核出错或超时为None
+    """
+    url_2_digest = {image_url: get_image_digest(image_url) for image_url in image_urls if image_url}
+    verdicts = image_verdict_cache.get_many(list(url_2_digest.values()))
+    if not all(verdicts.values()):
+        return False
+    missed = [(image_url, digest) for image_url, digest in url_2_digest.items() if digest not in verdicts]
+    if not missed:
+        return True
+    futures = [_get_executor().submit(_check_and_cache, image_url, digest) for image_url, digest in missed]
+    result = True
+    try:
+        for future in as_completed(futures, timeout=IMAGE_CHECK_TIMEOUT):
+            verdict = future.result()
+            if verdict is False:
+                return False
+            if verdict is None:
+                result = None
+    except TimeoutError:
+        info_logger.info('image censor timeout: {}'.format([image_url for image_url, _ in missed]))
+        return None
+    finally:
+        for future in futures:
+            future.cancel()
+    return result
+
+
+def are_images_valid(image_urls):
+    """
+    批量审核图片, 全部通过才返回True, 审核出错时按不通过处理
+    """
+    return bool(get_images_verdict(image_urls))
+
+
+def is_image_valid(image_url):
+    return are_images_valid([image_url])
@@ -0,0 +1,66 @@
+"""
+进程内缓存
+
+放在redis前面挡掉热点读取, 每个worker各有一份, 所以只适合能容忍短暂不一致的数据:
+条目TTL秒后过期, 写入方只能删除本进程的条目, 其他进程最多延迟TTL秒看到新值
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalLRUCache(object):
+    """
+    容量为max_size的LRU缓存, 每个条目ttl秒后过期, 线程安全
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        :return: {key: value}, 只包含命中的
+        """
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    continue
+                if item[0] <= now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                result[key] = item[1]
+        return result
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, mapping):
+        expire_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (expire_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,40 @@
+"""
+列投影查询
+
+卡片和列表只用到模型的少数几列, 实例化完整的Model(含detail等大文本字段)既费内存又费时间,
+这里用values_list只取需要的列, 每行放进一个__slots__对象, 没有Model实例的__dict__、_state和信号开销
+"""
+
+
+class ProjectedRow(object):
+    """
+    只读的查询结果行
+    子类用COLUMNS声明需要的列, 并声明__slots__ = ProjectedRow.get_attrs(COLUMNS) + 其他缓存用的属性
+    跨表的列(如club__name)对应的属性名为club_name
+    """
+    __slots__ = ()
+    COLUMNS = ()
+    _ATTRS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._ATTRS = cls.get_attrs(cls.COLUMNS)
+
+    @staticmethod
+    def get_attrs(columns):
+        return tuple(column.replace('__', '_') for column in columns)
+
+    def __init__(self, values):
+        for attr, value in zip(self._ATTRS, values):
+            setattr(self, attr, value)
+
+    @classmethod
+    def project(cls, queryset):
+        """
+        :param queryset: 未切片的QuerySet, 只查询COLUMNS中的列
+        :return: [row]
+        """
+        return [cls(values) for values in queryset.values_list(*cls.COLUMNS)]
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, getattr(self, 'id', ''))
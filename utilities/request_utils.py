@@ -1,4 +1,10 @@
+import base64
 import json
+
+from django.db.models import Q
+
+from utilities.date_time import datetime_to_str, str_to_datetime, FORMAT_DATETIME_MSEC
+
 PAGE_SIZE = 20
 
 
@@ -29,3 +35,41 @@ def get_page_range(page, count_per_page=PAGE_SIZE):
     start_num = (page - 1) * count_per_page
     end_num = start_num + count_per_page
     return start_num, end_num
+
+
+def encode_cursor(created_time, item_id):
+    """
+    生成翻页游标，内容为最后一条的(created_time, id)，对客户端不透明
+    """
+    raw = '{}|{}'.format(datetime_to_str(created_time, FORMAT_DATETIME_MSEC), item_id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """
+    解析翻页游标，游标不合法时抛出ValueError
+    :return: (created_time, id), 第一页返回None
+    """
+    if not cursor:
+        return None
+    raw = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+    time_str, item_id = raw.split('|')
+    return str_to_datetime(time_str, FORMAT_DATETIME_MSEC), int(item_id)
+
+
+def get_page_by_cursor(query, cursor, count=PAGE_SIZE):
+    """
+    基于(created_time, id)的游标翻页，翻页深度不影响查询耗时
+    多取一条用于判断has_more
+    :param query: QuerySet, 需要有(created_time, id)的联合索引
+    :param cursor: decode_cursor的结果
+    :return: items, next_cursor, has_more
+    """
+    if cursor:
+        created_time, item_id = cursor
+        query = query.filter(Q(created_time__lt=created_time) | Q(created_time=created_time, id__lt=item_id))
+    items = list(query.order_by('-created_time', '-id')[:count + 1])
+    has_more = len(items) > count
+    items = items[:count]
+    next_cursor = encode_cursor(items[-1].created_time, items[-1].id) if has_more else ''
+    return items, next_cursor, has_more
@@ -1,24 +1,135 @@
+"""
+小程序access_token
+
+access_token有效期2小时, 同一时刻只有最新获取的一个有效(旧的在新token生成后5分钟内仍可用),
+所以所有worker共用redis中的一份: hash "wx_access_token" {token, expire_at}, key在expire_at时过期
+
+- 热点路径: 每个进程保留一份副本, ACCESS_TOKEN_LOCAL_TTL秒内直接使用, 不访问redis;
+  副本的有效期远小于旧token的5分钟宽限期, 其他进程刷新后本进程最多延迟ACCESS_TOKEN_LOCAL_TTL秒换用新token
+- 提前刷新: celery定时任务每WX_ACCESS_TOKEN_CHECK_INTERVAL秒检查一次, 剩余有效期不足ACCESS_TOKEN_REFRESH_AHEAD秒时刷新,
+  正常情况下请求永远不会等待获取token
+- 单飞: 刷新前先抢redis锁(RedisLock, 只释放自己持有的锁), 同一时刻只有一个进程请求微信; 没抢到的在redis中等待新token
+- 调用方发现token失效(errcode 40001/42001)时调用refresh_access_token(stale_token)强制刷新
+"""
+import threading
+import time
+
 import requests
+from django.conf import settings
 
+from log_utils.loggers import info_logger
 from redis_utils.container.api_redis_client import redis
-from weixin.consts import APP_ID, APP_SECRET
-
+from redis_utils.container.api_redis_container import RedisLock
+from weixin.consts import APP_ID, APP_SECRET, SYNC_REQUEST_TIME_OUT
 
 URL = "https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={}&secret={}"
 ACCESS_TOKEN_KEY = 'wx_access_token'
+ACCESS_TOKEN_LOCK_KEY = 'wx_access_token_lock'
+# 剩余有效期不足时提前刷新, 需要大于定时任务的检查周期
+ACCESS_TOKEN_REFRESH_AHEAD = 3 * settings.WX_ACCESS_TOKEN_CHECK_INTERVAL
+ACCESS_TOKEN_LOCAL_TTL = 60
+# 没抢到锁时等待其他进程刷新的时间和轮询间隔
+ACCESS_TOKEN_WAIT_SECONDS = SYNC_REQUEST_TIME_OUT
+ACCESS_TOKEN_WAIT_INTERVAL = 0.05
+# access_token无效、过期
+INVALID_TOKEN_ERRCODES = (40001, 42001)
 
+access_token_lock = RedisLock(ACCESS_TOKEN_LOCK_KEY, 2 * SYNC_REQUEST_TIME_OUT)
 
-def get_access_token():
+# 本进程的副本: (token, expire_at, local_expire_at)
+_local_token = None
+_local_lock = threading.Lock()
+
+
+def _load_token():
+    """
+    :return: (token, expire_at), 没有时返回(None, 0)
+    """
+    value = redis.hgetall(ACCESS_TOKEN_KEY)
+    if not value or b'token' not in value:
+        return None, 0
+    return value[b'token'].decode('utf-8'), float(value[b'expire_at'])
+
+
+def _save_local_token(token, expire_at, now):
+    global _local_token
+    with _local_lock:
+        _local_token = (token, expire_at, min(now + ACCESS_TOKEN_LOCAL_TTL, expire_at))
+
+
+def clear_local_token():
+    global _local_token
+    with _local_lock:
+        _local_token = None
+
+
+def _fetch_token():
     """
-    获取access_token
+    请求微信获取新的access_token并写入redis
+    :return: (token, expire_at), 失败时返回(None, 0)
     """
-    access_token = redis.get('access_token')
-    if access_token:
-        return access_token
     try:
-        result = requests.get(URL.format(APP_ID, APP_SECRET)).json()
+        result = requests.get(URL.format(APP_ID, APP_SECRET), timeout=SYNC_REQUEST_TIME_OUT).json()
         access_token, expires_in = result['access_token'], result['expires_in']
-        # redis.setex('access_token', expires_in, access_token)
-        return access_token
-    except:
-        return None
+    except Exception as e:
+        info_logger.info('fetch access_token failed: {}'.format(e))
+        return None, 0
+    expire_at = time.time() + expires_in
+    pipeline = redis.pipeline(transaction=True)
+    pipeline.hmset(ACCESS_TOKEN_KEY, {'token': access_token, 'expire_at': expire_at})
+    pipeline.expireat(ACCESS_TOKEN_KEY, int(expire_at))
+    pipeline.execute()
+    return access_token, expire_at
+
+
+def refresh_access_token(stale_token=None, force=False):
+    """
+    单飞刷新: 抢到锁的进程请求微信, 其余进程等待redis中出现新token
+    :param stale_token: 调用方发现已失效的token, redis中仍是它时刷新
+    :param force: 为True时总是刷新redis中当前的token, 否则只在剩余有效期不足ACCESS_TOKEN_REFRESH_AHEAD秒时刷新
+    :return: 当前有效的token, 获取失败时返回None
+    """
+    deadline = time.time() + ACCESS_TOKEN_WAIT_SECONDS
+    token, expire_at = _load_token()
+    if force:
+        stale_token = token
+    while True:
+        now = time.time()
+        if token is not None and token != stale_token and expire_at - now >= ACCESS_TOKEN_REFRESH_AHEAD:
+            _save_local_token(token, expire_at, now)
+            return token
+        lock_token = access_token_lock.acquire()
+        if lock_token is not None:
+            try:
+                # 抢到锁之前其他进程可能刚刚刷新完
+                token, expire_at = _load_token()
+                if token is None or token == stale_token or expire_at - time.time() < ACCESS_TOKEN_REFRESH_AHEAD:
+                    token, expire_at = _fetch_token()
+            finally:
+                access_token_lock.release(lock_token)
+            if token is not None:
+                _save_local_token(token, expire_at, time.time())
+            return token
+        # 其他进程正在刷新, 旧token还没过期就先用旧的
+        if token is not None and token != stale_token and expire_at > now:
+            _save_local_token(token, expire_at, now)
+            return token
+        if now >= deadline:
+            return None
+        time.sleep(ACCESS_TOKEN_WAIT_INTERVAL)
+        token, expire_at = _load_token()
+
+
+def get_access_token():
+    """
+    获取access_token, 优先使用本进程的副本
+    """
+    local_token = _local_token
+    now = time.time()
+    if local_token is not None and now < local_token[2]:
+        return local_token[0]
+    token, expire_at = _load_token()
+    if token is not None and expire_at > now:
+        _save_local_token(token, expire_at, now)
+        return token
+    return refresh_access_token()
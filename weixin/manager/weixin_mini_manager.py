@@ -15,7 +15,7 @@ from django.contrib.auth import login
 
 # from redis_utils.container.api_redis_client import redis
 from user_info.manager.user_info_mananger import get_user_info_by_open_id_db, create_user_info_db, \
-    get_user_by_open_id_db
+    get_user_by_open_id_db, ensure_user_info_db
 from utilities.enum import EnumBase
 from weixin.consts import APP_ID
 from weixin.manager.login_manager import get_wechat_mini_session_by_code
@@ -98,6 +98,8 @@ class WxminiAuthManager(object):
             return None, ""
         if not encrypted_data:
             user, created = get_user_by_open_id_db(open_id)
+            # 资料在登录时创建, 读取资料时不再创建
+            ensure_user_info_db(user, open_id)
             return user, session_key
         # 解密用户详细信息
         user_info = cls.decrypt_mini_user_info(session_key, encrypted_data, iv)
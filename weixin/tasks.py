@@ -0,0 +1,10 @@
+from celery_apps import app
+from weixin.manager.token import refresh_access_token
+
+
+@app.task
+def refresh_access_token_task():
+    """
+    定时检查access_token, 快过期时提前刷新, 周期见settings.WX_ACCESS_TOKEN_CHECK_INTERVAL
+    """
+    return bool(refresh_access_token())
@@ -0,0 +1,122 @@
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+from django.test import TestCase
+
+from redis_utils.container.api_redis_client import redis
+from utilities.content_check import is_content_valid, _local_verdicts
+from weixin.manager import token as token_manager
+from weixin.manager.token import get_access_token, refresh_access_token, clear_local_token, \
+    ACCESS_TOKEN_KEY, ACCESS_TOKEN_LOCK_KEY, ACCESS_TOKEN_REFRESH_AHEAD, access_token_lock
+
+
+def _mock_token_response(latency=0):
+    tokens = iter('token{}'.format(index) for index in range(100))
+
+    def get(*args, **kwargs):
+        time.sleep(latency)
+        response = MagicMock()
+        response.json.return_value = {'access_token': next(tokens), 'expires_in': 7200}
+        return response
+    return MagicMock(side_effect=get)
+
+
+class AccessTokenTest(TestCase):
+    """
+    python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest
+    """
+
+    def setUp(self):
+        redis.flushdb()
+        clear_local_token()
+
+    def _set_token(self, token, expires_in):
+        redis.hmset(ACCESS_TOKEN_KEY, {'token': token, 'expire_at': time.time() + expires_in})
+
+    def test_get_access_token(self):
+        """
+        只请求一次微信, 本进程的副本有效时不访问redis
+        python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest.test_get_access_token
+        """
+        with patch('weixin.manager.token.requests.get', _mock_token_response()) as get:
+            self.assertEqual(get_access_token(), 'token0')
+            with patch('weixin.manager.token._load_token', wraps=token_manager._load_token) as load_token:
+                self.assertEqual(get_access_token(), 'token0')
+                self.assertEqual(load_token.call_count, 0)
+            clear_local_token()
+            self.assertEqual(get_access_token(), 'token0')
+        self.assertEqual(get.call_count, 1)
+        self.assertGreater(redis.ttl(ACCESS_TOKEN_KEY), 7000)
+
+    def test_refresh_access_token(self):
+        """
+        python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest.test_refresh_access_token
+        """
+        with patch('weixin.manager.token.requests.get', _mock_token_response()) as get:
+            self._set_token('fresh', 7200)
+            self.assertEqual(refresh_access_token(), 'fresh')
+            # 别的进程已经换过的token不再刷新
+            self.assertEqual(refresh_access_token(stale_token='old'), 'fresh')
+            self.assertEqual(get.call_count, 0)
+
+            # 快过期时提前刷新, 请求仍可使用旧token
+            self._set_token('expiring', ACCESS_TOKEN_REFRESH_AHEAD - 10)
+            clear_local_token()
+            self.assertEqual(get_access_token(), 'expiring')
+            self.assertEqual(refresh_access_token(), 'token0')
+            self.assertEqual(refresh_access_token(stale_token='token0'), 'token1')
+            self.assertEqual(refresh_access_token(force=True), 'token2')
+            self.assertEqual(get_access_token(), 'token2')
+        self.assertEqual(get.call_count, 3)
+
+    def test_single_flight(self):
+        """
+        多个进程同时发现没有token时只有一个请求微信
+        python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest.test_single_flight
+        """
+        results = []
+
+        def worker():
+            results.append(refresh_access_token())
+
+        with patch('weixin.manager.token.requests.get', _mock_token_response(latency=0.2)) as get:
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(results, ['token0'] * 8)
+
+    def test_lock_release(self):
+        """
+        请求微信超过锁的有效期时, 不会删掉之后刷新的进程持有的锁
+        python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest.test_lock_release
+        """
+        next_tokens = []
+
+        def fetch():
+            # 锁已过期, 另一个进程开始刷新
+            redis.delete(ACCESS_TOKEN_LOCK_KEY)
+            next_tokens.append(access_token_lock.acquire())
+            return 'token', time.time() + 7200
+
+        with patch('weixin.manager.token._fetch_token', side_effect=fetch):
+            self.assertEqual(refresh_access_token(), 'token')
+        self.assertEqual(redis.get(ACCESS_TOKEN_LOCK_KEY), next_tokens[0].encode('utf-8'))
+
+    def test_content_check_retry(self):
+        """
+        检测接口返回token失效时刷新token后重试
+        python manage.py test --settings=settings-test weixin.testing.test_token.AccessTokenTest.test_content_check_retry
+        """
+        _local_verdicts.clear()
+        self._set_token('revoked', 7200)
+        responses = iter([{'errcode': 40001, 'errmsg': 'invalid credential'}, {'errcode': 0, 'errmsg': 'ok'}])
+        post = MagicMock(side_effect=lambda *args, **kwargs: MagicMock(json=MagicMock(return_value=next(responses))))
+        with patch('weixin.manager.token.requests.get', _mock_token_response()) as get, \
+                patch('utilities.content_check.requests.post', post):
+            self.assertTrue(is_content_valid('retry'))
+        self.assertEqual(get.call_count, 1)
+        self.assertIn('token0', post.call_args[0][0])